@@ -16,19 +16,60 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 """Time series data manipulation, better with pancetta."""
+import bz2
+import collections
 import functools
 import operator
 import re
+import zlib
 
 import msgpack
 import numpy
+from oslo.utils import importutils
 import pandas
 import six
 
+lzma = importutils.try_import('lzma')
+
 
 AGGREGATION_METHODS = set(('mean', 'sum', 'last', 'max', 'min',
                            'std', 'median', 'first', 'count'))
 
+# NOTE(jd) The aggregation methods whose aggregates can be aggregated again
+# exactly, with the method to use to do so. A mean, a median or a percentile
+# cannot be computed from the aggregates of smaller buckets.
+RESAMPLE_METHODS = {
+    'sum': 'sum',
+    'count': 'sum',
+    'min': 'min',
+    'max': 'max',
+    'first': 'first',
+    'last': 'last',
+}
+
+# NOTE(jd) 0xc1 is never used by msgpack, so a payload starting with it cannot
+# be mistaken for a legacy msgpack encoded archive.
+SERIALIZATION_MAGIC = b"\xc1CBN"
+# Version 1 payloads have no compression codec byte after the version.
+SERIALIZATION_VERSION = 2
+_SERIALIZATION_HEADER = SERIALIZATION_MAGIC + six.int2byte(
+    SERIALIZATION_VERSION)
+
+# Compression codecs applied to serialized payloads, by name:
+# (identifier stored in the payload header, compress, decompress)
+COMPRESSION_CODECS = {
+    'none': (0, None, None),
+    'zlib': (1, zlib.compress, zlib.decompress),
+    'bz2': (2, bz2.compress, bz2.decompress),
+}
+if lzma is not None:
+    COMPRESSION_CODECS['lzma'] = (3, lzma.compress, lzma.decompress)
+_COMPRESSION_CODECS_BY_ID = dict((codec[0], codec)
+                                 for codec in COMPRESSION_CODECS.values())
+
+TIMESTAMP_DTYPE = numpy.dtype('<i8')
+VALUE_DTYPE = numpy.dtype('<f8')
+
 
 class NoDeloreanAvailable(Exception):
     """Error raised when trying to insert a value that is too old."""
@@ -39,6 +80,10 @@ class NoDeloreanAvailable(Exception):
         super(NoDeloreanAvailable, self).__init__(
             "%s is before %s" % (bad_timestamp, first_timestamp))
 
+    def __reduce__(self):
+        # NOTE(jd) Allow to raise it from another process
+        return self.__class__, (self.first_timestamp, self.bad_timestamp)
+
 
 class UnAggregableTimeseries(Exception):
     """Error raised when timeseries cannot be aggregated."""
@@ -59,19 +104,60 @@ class TimeSerie(object):
     def __getitem__(self, key):
         return self.ts[key]
 
+    @staticmethod
+    def _to_series(values):
+        """Return a Series out of a list of (timestamp, value) or a Series."""
+        if isinstance(values, pandas.Series):
+            return values
+        return pandas.Series(*reversed(list(zip(*values))))
+
     def set_values(self, values):
-        t = pandas.Series(*reversed(list(zip(*values))))
+        t = self._to_series(values)
         self.ts = t.combine_first(self.ts).sort_index()
 
     def __len__(self):
         return len(self.ts)
 
     @staticmethod
-    def _timestamps_and_values_from_dict(values):
+    def _timestamps_and_values_from_dict(d, from_timestamp=None,
+                                         to_timestamp=None):
+        """Return the timestamps and values of a dict within a range.
+
+        This slices the points after a full decode: the payload the dict
+        comes from has been entirely decompressed and unpacked, only the
+        arrays and pandas objects built are limited to the range.
+        """
+        if from_timestamp is not None:
+            from_timestamp = pandas.Timestamp(from_timestamp)
+        if to_timestamp is not None:
+            to_timestamp = pandas.Timestamp(to_timestamp)
+        if 'timestamps' in d:
+            # Packed format: timestamps and values are stored as two arrays of
+            # int64 nanoseconds and float64, so there is no need to build any
+            # Python object per point.
+            timestamps = numpy.frombuffer(d['timestamps'],
+                                          dtype=TIMESTAMP_DTYPE)
+            start = 0
+            stop = len(timestamps)
+            if from_timestamp is not None:
+                start = timestamps.searchsorted(from_timestamp.value, 'left')
+            if to_timestamp is not None:
+                stop = timestamps.searchsorted(to_timestamp.value, 'right')
+            stop = max(start, stop)
+            # NOTE(jd) Values have a fixed width, so the offset of the first
+            # value of the range is known without decoding the others.
+            values = numpy.frombuffer(d['values'], dtype=VALUE_DTYPE,
+                                      count=stop - start,
+                                      offset=start * VALUE_DTYPE.itemsize)
+            return pandas.to_datetime(timestamps[start:stop]), values
         v = tuple(
             zip(*dict(
                 (pandas.Timestamp(k), v)
-                for k, v in six.iteritems(values)).items()))
+                for k, v in six.iteritems(d['values'])
+                if ((from_timestamp is None
+                     or pandas.Timestamp(k) >= from_timestamp)
+                    and (to_timestamp is None
+                         or pandas.Timestamp(k) <= to_timestamp))).items()))
         if v:
             return v
         return (), ()
@@ -80,20 +166,90 @@ class TimeSerie(object):
     def from_dict(cls, d):
         """Build a time series from a dict.
 
-        The dict format must be datetime as key and values as values.
+        The dict format must be datetime as key and values as values, or
+        the packed format returned by `to_dict(packed=True)`.
 
         :param d: The dict.
         :returns: A TimeSerie object
         """
-        return cls(*cls._timestamps_and_values_from_dict(d['values']))
+        return cls(*cls._timestamps_and_values_from_dict(d))
+
+    def _segments(self):
+        """Return the points as a list of (timestamps, values) arrays.
+
+        Timestamps are nanoseconds. The points of all the segments, one
+        after the other, are sorted.
+        """
+        ts = self.ts.dropna()
+        return [(ts.index.asi8, ts.values)]
 
-    def to_dict(self):
+    def to_dict(self, packed=False):
+        """Return a dict representation of the time serie.
+
+        :param packed: If True, timestamps and values are stored as binary
+                       arrays rather than as a dict of values.
+        """
+        segments = self._segments()
+        if packed:
+            return {
+                'timestamps': b"".join(
+                    timestamps.astype(TIMESTAMP_DTYPE, copy=False).tobytes()
+                    for timestamps, __ in segments),
+                'values': b"".join(
+                    values.astype(VALUE_DTYPE, copy=False).tobytes()
+                    for __, values in segments),
+            }
         return {
-            'values': dict((timestamp.value, float(v))
+            'values': dict((int(timestamp), float(v))
+                           for timestamps, values in segments
                            for timestamp, v
-                           in six.iteritems(self.ts.dropna())),
+                           in six.moves.zip(timestamps, values)),
         }
 
+    @staticmethod
+    def _pack(d, codec='none'):
+        """Serialize a dict with our header.
+
+        :param d: The dict.
+        :param codec: The name of the compression codec to use, one of
+                      COMPRESSION_CODECS.
+        """
+        codec_id, compress, __ = COMPRESSION_CODECS[codec]
+        data = msgpack.dumps(d, use_bin_type=True)
+        if compress is not None:
+            data = compress(data)
+        return _SERIALIZATION_HEADER + six.int2byte(codec_id) + data
+
+    @staticmethod
+    def _unpack(data):
+        if data.startswith(SERIALIZATION_MAGIC):
+            version = six.indexbytes(data, len(SERIALIZATION_MAGIC))
+            if version == 1:
+                data = data[len(SERIALIZATION_MAGIC) + 1:]
+            elif version == SERIALIZATION_VERSION:
+                codec_id = six.indexbytes(data, len(_SERIALIZATION_HEADER))
+                try:
+                    __, __, decompress = _COMPRESSION_CODECS_BY_ID[codec_id]
+                except KeyError:
+                    raise ValueError("Unknown compression codec %d"
+                                     % codec_id)
+                data = data[len(_SERIALIZATION_HEADER) + 1:]
+                if decompress is not None:
+                    data = decompress(data)
+            else:
+                raise ValueError("Unknown serialization version %d"
+                                 % version)
+        # NOTE(jd) Anything without our header is a legacy msgpack payload,
+        # which is still readable so archives can be migrated lazily.
+        return msgpack.loads(data, encoding='utf-8')
+
+    @classmethod
+    def unserialize(cls, data):
+        return cls.from_dict(cls._unpack(data))
+
+    def serialize(self, codec='none'):
+        return self._pack(self.to_dict(packed=True), codec)
+
     @staticmethod
     def _serialize_time_period(value):
         if value:
@@ -130,11 +286,12 @@ class BoundTimeSerie(TimeSerie):
                 and self.back_window == other.back_window)
 
     def set_values(self, values, before_truncate_callback=None):
+        values = self._to_series(values)
         if self.block_size is not None and not self.ts.empty:
             # Check that the smallest timestamp does not go too much back in
             # time.
             # TODO(jd) convert keys to timestamp to be sure we can subtract?
-            smallest_timestamp = min(map(operator.itemgetter(0), values))
+            smallest_timestamp = values.index.min()
             first_block_timestamp = self._first_block_timestamp()
             if smallest_timestamp < first_block_timestamp:
                 raise NoDeloreanAvailable(first_block_timestamp,
@@ -153,13 +310,13 @@ class BoundTimeSerie(TimeSerie):
         :param d: The dict.
         :returns: A TimeSerie object
         """
-        timestamps, values = cls._timestamps_and_values_from_dict(d['values'])
+        timestamps, values = cls._timestamps_and_values_from_dict(d)
         return cls(timestamps, values,
                    block_size=d.get('block_size'),
                    back_window=d.get('back_window'))
 
-    def to_dict(self):
-        basic = super(BoundTimeSerie, self).to_dict()
+    def to_dict(self, packed=False):
+        basic = super(BoundTimeSerie, self).to_dict(packed)
         basic.update({
             'block_size': self._serialize_time_period(self.block_size),
             'back_window': self.back_window,
@@ -179,16 +336,184 @@ class BoundTimeSerie(TimeSerie):
             self.ts = self.ts[self._first_block_timestamp():]
 
 
+class RingBuffer(object):
+    def __init__(self, capacity):
+        """A fixed-capacity buffer of points.
+
+        Timestamps and values are stored in two arrays preallocated for
+        `capacity` points and used circularly: once the buffer is full,
+        adding points overwrites the oldest ones. Adding or replacing a batch
+        of points therefore costs O(batch) and does not allocate new arrays.
+
+        :param capacity: The maximum number of points of the buffer.
+        """
+        self.capacity = capacity
+        self.timestamps = numpy.empty(capacity, dtype=TIMESTAMP_DTYPE)
+        self.values = numpy.empty(capacity, dtype=VALUE_DTYPE)
+        # Position of the oldest point in the arrays
+        self.head = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _segments(self, array):
+        # The points, oldest first, are array[head:] followed by array[:head]
+        end = self.head + self.size
+        if end <= self.capacity:
+            return array[self.head:end], array[:0]
+        return array[self.head:], array[:end - self.capacity]
+
+    def _ordered(self, array):
+        first, second = self._segments(array)
+        if len(second):
+            return numpy.concatenate((first, second))
+        return first.copy()
+
+    def searchsorted(self, timestamp):
+        """Return the number of points older than a timestamp.
+
+        :param timestamp: A timestamp as nanoseconds since epoch.
+        """
+        first, second = self._segments(self.timestamps)
+        position = numpy.searchsorted(first, timestamp)
+        if position < len(first):
+            return int(position)
+        return len(first) + int(numpy.searchsorted(second, timestamp))
+
+    def extend(self, timestamps, values):
+        """Add points more recent than all the ones of the buffer.
+
+        If the buffer is full, the oldest points are dropped.
+
+        :param timestamps: An array of nanoseconds since epoch.
+        :param values: An array of values.
+        """
+        count = len(timestamps)
+        if count >= self.capacity:
+            self.timestamps[:] = timestamps[-self.capacity:]
+            self.values[:] = values[-self.capacity:]
+            self.head = 0
+            self.size = self.capacity
+            return
+        positions = ((self.head + self.size + numpy.arange(count))
+                     % self.capacity)
+        self.timestamps[positions] = timestamps
+        self.values[positions] = values
+        self.size += count
+        if self.size > self.capacity:
+            self.head = (self.head + self.size - self.capacity) % self.capacity
+            self.size = self.capacity
+
+    def assign(self, timestamps, values):
+        """Replace all the points of the buffer, reusing its arrays.
+
+        :param timestamps: A sorted array of nanoseconds since epoch.
+        :param values: An array of values.
+        """
+        self.head = 0
+        self.size = 0
+        self.extend(timestamps, values)
+
+    def splice(self, start, stop, timestamps, values):
+        """Replace the points between `start` and `stop` by new ones.
+
+        :param start: The first timestamp to replace, in nanoseconds.
+        :param stop: The timestamp to stop at (excluded), in nanoseconds.
+        :param timestamps: The new timestamps, within [start, stop[.
+        :param values: The new values.
+        """
+        position = self.searchsorted(start)
+        after = self.searchsorted(stop)
+        if after < self.size:
+            # Only out of order updates have points after the replaced ones
+            tail = (self.head + numpy.arange(after, self.size)) % self.capacity
+            timestamps = numpy.concatenate((timestamps,
+                                            self.timestamps[tail]))
+            values = numpy.concatenate((values, self.values[tail]))
+        self.size = position
+        self.extend(timestamps, values)
+
+    def arrays(self):
+        """Return the timestamps and values of the points, oldest first."""
+        return self._ordered(self.timestamps), self._ordered(self.values)
+
+    def segments(self):
+        """Return the points as they are stored, without copying them.
+
+        :return: A list of at most two (timestamps, values), oldest first.
+        """
+        return [segment for segment in six.moves.zip(
+            self._segments(self.timestamps), self._segments(self.values))
+            if len(segment[0])]
+
+    def to_series(self):
+        timestamps, values = self.arrays()
+        return pandas.Series(values, pandas.to_datetime(timestamps))
+
+    def assign_series(self, ts):
+        """Replace the points of the buffer by the last ones of a Series."""
+        ts = ts.dropna()
+        self.assign(pandas.DatetimeIndex(ts.index).asi8,
+                    ts.values.astype(VALUE_DTYPE))
+
+    @classmethod
+    def from_series(cls, capacity, ts):
+        """Build a buffer holding the last `capacity` points of a Series."""
+        buf = cls(capacity)
+        buf.assign_series(ts)
+        return buf
+
+
 class AggregatedTimeSerie(TimeSerie):
 
     _AGG_METHOD_PCT_RE = re.compile(r"([1-9][0-9]?)pct")
 
+    # Number of points stored in each split of a time serie
+    POINTS_PER_SPLIT = 3600
+
     @staticmethod
-    def _percentile(a, q):
-        # TODO(jd) Find a way to compute all the percentile in one pass as
-        # numpy can do numpy.percentile(a, q=[75, 90, 95])
-        if len(a) > 0:
-            return numpy.percentile(a, q)
+    def _grouped_percentiles(keys, values, percentiles):
+        """Compute several percentiles of grouped values in one pass.
+
+        Values of each group are sorted once, then every percentile is
+        interpolated linearly, the same way `numpy.percentile` does.
+
+        :param keys: Sorted array of group keys, one per value.
+        :param values: Array of values.
+        :param percentiles: List of percentiles to compute, in [0, 100].
+        :returns: A tuple (unique keys, array of shape keys × percentiles).
+        """
+        if len(keys) == 0:
+            return keys, numpy.empty((0, len(percentiles)))
+        starts = numpy.concatenate(
+            ([0], numpy.flatnonzero(numpy.diff(keys)) + 1))
+        counts = numpy.diff(numpy.append(starts, len(keys)))
+        sorted_values = values[numpy.lexsort((values, keys))]
+        indices = (numpy.asarray(percentiles, dtype=float)[numpy.newaxis, :]
+                   / 100.0 * (counts - 1)[:, numpy.newaxis])
+        indices_below = numpy.floor(indices).astype(int)
+        indices_above = numpy.ceil(indices).astype(int)
+        weights_above = indices - indices_below
+        starts = starts[:, numpy.newaxis]
+        return keys[starts[:, 0]], (
+            sorted_values[starts + indices_below] * (1 - weights_above)
+            + sorted_values[starts + indices_above] * weights_above)
+
+    @classmethod
+    def _aggregate_percentiles(cls, points, sampling, percentiles):
+        """Resample points for several percentiles at once.
+
+        :returns: A list of pandas.Series, one per percentile.
+        """
+        freq = sampling.nanos
+        keys, values = cls._grouped_percentiles(
+            points.index.asi8 // freq,
+            points.values.astype(float),
+            percentiles)
+        index = pandas.to_datetime(keys * freq)
+        return [pandas.Series(values[:, i], index)
+                for i in six.moves.range(len(percentiles))]
 
     def __init__(self, timestamps=None, values=None,
                  max_size=None,
@@ -198,7 +523,13 @@ class AggregatedTimeSerie(TimeSerie):
         Used to represent the downsampled timeserie for a single
         granularity/aggregation-function pair stored for a metric.
 
+        If `max_size` is set, the points are held by a RingBuffer of that
+        capacity, so only the last `max_size` points are kept.
+
         """
+        self.max_size = max_size
+        self._buffer = None
+        self._ts = None
         super(AggregatedTimeSerie, self).__init__(timestamps, values)
 
         self.aggregation_method = aggregation_method
@@ -206,13 +537,42 @@ class AggregatedTimeSerie(TimeSerie):
         m = self._AGG_METHOD_PCT_RE.match(aggregation_method)
 
         if m:
-            self.aggregation_method_func = functools.partial(
-                self._percentile, q=float(m.group(1)))
+            self.percentile = float(m.group(1))
         else:
-            self.aggregation_method_func = aggregation_method
+            self.percentile = None
+        self.aggregation_method_func = aggregation_method
 
         self.sampling = pandas.tseries.frequencies.to_offset(sampling)
-        self.max_size = max_size
+
+    @property
+    def ts(self):
+        # NOTE(jd) Only build a Series out of the buffer once after each
+        # change of its points.
+        if self._ts is None and self._buffer is not None:
+            self._ts = self._buffer.to_series()
+        return self._ts
+
+    @ts.setter
+    def ts(self, ts):
+        if self.max_size is None:
+            self._ts = ts
+            return
+        if self._buffer is None:
+            self._buffer = RingBuffer(self.max_size)
+        self._buffer.assign_series(ts)
+        self._ts = None
+
+    def _segments(self):
+        # NOTE(jd) Use the arrays of the buffer as they are, so that
+        # serializing or splitting the points does not copy them all.
+        if self._buffer is not None:
+            return self._buffer.segments()
+        return super(AggregatedTimeSerie, self)._segments()
+
+    def __len__(self):
+        if self._buffer is not None:
+            return len(self._buffer)
+        return len(self._ts)
 
     def __eq__(self, other):
         return (isinstance(other, AggregatedTimeSerie)
@@ -222,28 +582,38 @@ class AggregatedTimeSerie(TimeSerie):
                 and self.aggregation_method == other.aggregation_method)
 
     def set_values(self, values):
-        super(AggregatedTimeSerie, self).set_values(values)
-        # See comments in update()
-        self._resample(min(values, key=operator.itemgetter(0))[0])
-        self._truncate()
+        t = pandas.Series(*reversed(list(zip(*values))))
+        # NOTE(jd) Resample before storing the points, as a bounded time
+        # serie cannot hold more than max_size of the raw points.
+        self.ts = self._resample(
+            t.combine_first(self.ts).sort_index(),
+            min(values, key=operator.itemgetter(0))[0])
 
     @classmethod
-    def from_dict(cls, d):
+    def from_dict(cls, d, from_timestamp=None, to_timestamp=None):
         """Build a time series from a dict.
 
         The dict format must be datetime as key and values as values.
 
         :param d: The dict.
+        :param from_timestamp: Only build the points after this timestamp.
+        :param to_timestamp: Only build the points before this timestamp.
+                             The whole dict is decoded all the same.
         :returns: A TimeSerie object
         """
-        timestamps, values = cls._timestamps_and_values_from_dict(d['values'])
+        timestamps, values = cls._timestamps_and_values_from_dict(
+            d, from_timestamp, to_timestamp)
         return cls(timestamps, values,
                    max_size=d.get('max_size'),
                    sampling=d.get('sampling'),
                    aggregation_method=d.get('aggregation_method', 'mean'))
 
-    def to_dict(self):
-        d = super(AggregatedTimeSerie, self).to_dict()
+    @classmethod
+    def unserialize(cls, data, from_timestamp=None, to_timestamp=None):
+        return cls.from_dict(cls._unpack(data), from_timestamp, to_timestamp)
+
+    def to_dict(self, packed=False):
+        d = super(AggregatedTimeSerie, self).to_dict(packed)
         d.update({
             'aggregation_method': self.aggregation_method,
             'max_size': self.max_size,
@@ -251,39 +621,187 @@ class AggregatedTimeSerie(TimeSerie):
         })
         return d
 
-    def _truncate(self):
-        """Truncate the timeserie."""
-        if self.max_size is not None:
-            # Remove empty points if any that could be added by aggregation
-            self.ts = self.ts.dropna()[-self.max_size:]
+    def _aggregate(self, points):
+        if not self.sampling:
+            return points
+        if self.percentile is not None:
+            return self._aggregate_percentiles(
+                points, self.sampling, [self.percentile])[0]
+        return points.resample(
+            self.sampling,
+            how=self.aggregation_method_func).dropna()
+
+    def resample(self, sampling):
+        """Return the points aggregated again at a coarser sampling.
+
+        Only the aggregation methods in RESAMPLE_METHODS can be resampled.
 
-    def _resample(self, after):
+        :param sampling: The new sampling, in seconds.
+        """
+        if self.aggregation_method not in RESAMPLE_METHODS:
+            raise ValueError("Aggregation method %s cannot be resampled"
+                             % self.aggregation_method)
+        resampled = AggregatedTimeSerie(
+            sampling=pandas.tseries.offsets.Nano(sampling * 10e8),
+            aggregation_method=self.aggregation_method)
+        resampled.aggregation_method_func = RESAMPLE_METHODS[
+            self.aggregation_method]
+        resampled.ts = resampled._aggregate(self.ts)
+        return resampled
+
+    def _resample(self, ts, after):
         if self.sampling:
-            self.ts = self.ts[after:].resample(
-                self.sampling,
-                how=self.aggregation_method_func).combine_first(
-                    self.ts[:after][:-1])
+            return self._aggregate(ts[after:]).combine_first(ts[:after][:-1])
+        return ts
+
+    @staticmethod
+    def _round_timestamp(ts, freq):
+        return pandas.Timestamp(
+            (pandas.Timestamp(ts).value // freq) * freq)
+
+    @classmethod
+    def _buckets_range(cls, sampling, first_timestamp, last_timestamp):
+        if sampling:
+            freq = sampling.nanos
+            return (cls._round_timestamp(first_timestamp, freq),
+                    cls._round_timestamp(last_timestamp, freq) + sampling)
+        return (pandas.Timestamp(first_timestamp),
+                pandas.Timestamp(last_timestamp) + pandas.Timedelta(1))
+
+    def _splice(self, start, stop, points):
+        # Replace the buckets in [start, stop[ by the freshly computed ones,
+        # leaving the rest of the time serie untouched
+        if self._buffer is not None:
+            self._buffer.splice(pandas.Timestamp(start).value,
+                                pandas.Timestamp(stop).value,
+                                points.index.asi8,
+                                points.values.astype(VALUE_DTYPE))
+            self._ts = None
+            return
+        index = self.ts.index
+        self.ts = pandas.concat([
+            self.ts.iloc[:index.searchsorted(start)],
+            points,
+            self.ts.iloc[index.searchsorted(stop):],
+        ])
+
+    @classmethod
+    def get_split_key(cls, timestamp, sampling):
+        """Return the key of the split a timestamp belongs to.
+
+        :param timestamp: The timestamp.
+        :param sampling: The sampling of the time serie.
+        """
+        return cls._round_timestamp(timestamp,
+                                    sampling.nanos * cls.POINTS_PER_SPLIT)
+
+    def split(self):
+        """Split the time serie in chunks of POINTS_PER_SPLIT points.
+
+        :return: An iterator of (split key, AggregatedTimeSerie).
+        """
+        span = self.sampling.nanos * self.POINTS_PER_SPLIT
+        # The points are sorted, so each split is a slice of a segment, but
+        # for the one spanning over two segments
+        chunks = []
+        for timestamps, values in self._segments():
+            keys = timestamps // span * span
+            bounds = numpy.concatenate(
+                ([0], numpy.flatnonzero(numpy.diff(keys)) + 1, [len(keys)]))
+            for start, stop in six.moves.zip(bounds[:-1], bounds[1:]):
+                if chunks and chunks[-1][0] != keys[start]:
+                    yield self._split_from_chunks(chunks)
+                    chunks = []
+                chunks.append((keys[start], timestamps[start:stop],
+                               values[start:stop]))
+        if chunks:
+            yield self._split_from_chunks(chunks)
+
+    def _split_from_chunks(self, chunks):
+        """Return a split out of a list of (key, timestamps, values)."""
+        if len(chunks) == 1:
+            __, timestamps, values = chunks[0]
+        else:
+            timestamps = numpy.concatenate([chunk[1] for chunk in chunks])
+            values = numpy.concatenate([chunk[2] for chunk in chunks])
+        return pandas.Timestamp(chunks[0][0]), AggregatedTimeSerie(
+            pandas.to_datetime(timestamps), values,
+            sampling=self.sampling,
+            aggregation_method=self.aggregation_method)
+
+    @classmethod
+    def from_timeseries(cls, timeseries, sampling, aggregation_method,
+                        max_size=None):
+        """Build a time serie by concatenating other ones.
 
-    def update(self, ts):
+        :param timeseries: A list of AggregatedTimeSerie, e.g. splits.
+        """
+        if timeseries:
+            ts = pandas.concat([t.ts for t in timeseries])
+            return cls(ts.index, ts.values,
+                       max_size=max_size,
+                       sampling=sampling,
+                       aggregation_method=aggregation_method)
+        return cls(max_size=max_size,
+                   sampling=sampling,
+                   aggregation_method=aggregation_method)
+
+    def update(self, ts, first_timestamp=None, last_timestamp=None):
+        """Update the aggregated buckets from a full resolution time serie.
+
+        Only the buckets covering `first_timestamp` to `last_timestamp` are
+        recomputed and spliced into this time serie, so the cost of an update
+        depends on the size of the incoming batch rather than on the size of
+        the archive.
+
+        :param ts: The BoundTimeSerie holding the raw points.
+        :param first_timestamp: The first timestamp that changed in `ts`.
+        :param last_timestamp: The last timestamp that changed in `ts`.
+        """
+        self.update_all([self], ts, first_timestamp, last_timestamp)
+
+    @classmethod
+    def update_all(cls, timeseries, ts,
+                   first_timestamp=None, last_timestamp=None):
+        """Update several aggregated time series from the same raw points.
+
+        The raw points of each bucket are selected once per sampling, and all
+        the percentiles sharing a sampling are computed in a single pass.
+
+        :param timeseries: An iterable of AggregatedTimeSerie.
+        :param ts: The BoundTimeSerie holding the raw points.
+        :param first_timestamp: The first timestamp that changed in `ts`.
+        :param last_timestamp: The last timestamp that changed in `ts`.
+        """
         index = ts.ts.index
-        first_timestamp = index[0]
-        last_timestamp = index[-1]
-        # Build a new time serie excluding all data points in the range of the
-        # timeserie passed as argument
-        new_ts = self.ts[:first_timestamp].combine_first(
-            self.ts[last_timestamp:])
-
-        # Build a new timeserie where we replaced the timestamp range covered
-        # by the timeserie passed as argument
-        self.ts = ts.ts.combine_first(new_ts)
-
-        # Resample starting from the first timestamp we received
-        # TODO(jd) So this only works correctly because we expect that we are
-        # not going to replace a range in the middle of our timeserie. So we re
-        # resample EVERYTHING FROM first timestamp. We should rather resample
-        # from first timestamp AND TO LAST TIMESTAMP!
-        self._resample(first_timestamp)
-        self._truncate()
+        if index.empty:
+            return
+        if first_timestamp is None:
+            first_timestamp = index[0]
+        if last_timestamp is None:
+            last_timestamp = index[-1]
+
+        by_sampling = collections.defaultdict(list)
+        for agg in timeseries:
+            by_sampling[agg.sampling].append(agg)
+
+        for sampling, aggs in six.iteritems(by_sampling):
+            start, stop = cls._buckets_range(
+                sampling, first_timestamp, last_timestamp)
+            points = ts.ts.iloc[
+                index.searchsorted(start):index.searchsorted(stop)]
+            pcts = []
+            for agg in aggs:
+                if sampling and agg.percentile is not None:
+                    pcts.append(agg)
+                else:
+                    agg._splice(start, stop, agg._aggregate(points))
+            if pcts:
+                for agg, resampled in six.moves.zip(
+                        pcts, cls._aggregate_percentiles(
+                            points, sampling,
+                            [agg.percentile for agg in pcts])):
+                    agg._splice(start, stop, resampled)
 
 
 class TimeSerieArchive(object):
@@ -363,39 +881,72 @@ class TimeSerieArchive(object):
                 and self.full_res_timeserie == other.full_res_timeserie
                 and self.agg_timeseries == other.agg_timeseries)
 
-    def _update_aggregated_timeseries(self, timeserie):
-        for agg in self.agg_timeseries:
-            agg.update(timeserie)
+    def update(self, timeserie, first_timestamp=None, last_timestamp=None):
+        """Update the aggregated time series from a raw time serie.
+
+        :param timeserie: The BoundTimeSerie holding the raw points.
+        :param first_timestamp: The first timestamp that changed.
+        :param last_timestamp: The last timestamp that changed.
+        """
+        AggregatedTimeSerie.update_all(self.agg_timeseries, timeserie,
+                                       first_timestamp, last_timestamp)
+
+    def _update_aggregated_timeseries(self, first_timestamp, last_timestamp,
+                                      timeserie):
+        self.update(timeserie, first_timestamp, last_timestamp)
 
     def set_values(self, values):
+        timestamps = list(map(operator.itemgetter(0), values))
         self.full_res_timeserie.set_values(
             values,
-            before_truncate_callback=self._update_aggregated_timeseries)
+            before_truncate_callback=functools.partial(
+                self._update_aggregated_timeseries,
+                min(timestamps), max(timestamps)))
 
-    def to_dict(self):
+    def to_dict(self, packed=False):
         return {
-            "timeserie": self.full_res_timeserie.to_dict(),
-            "archives": [ts.to_dict() for ts in self.agg_timeseries],
+            "timeserie": self.full_res_timeserie.to_dict(packed),
+            "archives": [ts.to_dict(packed) for ts in self.agg_timeseries],
         }
 
     @classmethod
-    def from_dict(cls, d):
-        return cls(BoundTimeSerie.from_dict(d['timeserie']),
-                   [AggregatedTimeSerie.from_dict(a) for a in d['archives']])
+    def from_dict(cls, d, from_timestamp=None, to_timestamp=None,
+                  timeserie_filter=None):
+        """Build an archive from a dict.
+
+        :param d: The dict.
+        :param from_timestamp: Only build the points after this timestamp.
+        :param to_timestamp: Only build the points before this timestamp.
+        :param timeserie_filter: A function to select the aggregated time
+                                 series to decode.
+        """
+        agg_timeseries = []
+        for a in d['archives']:
+            if timeserie_filter is not None and not timeserie_filter(
+                    AggregatedTimeSerie(
+                        sampling=a.get('sampling'),
+                        aggregation_method=a.get('aggregation_method',
+                                                 'mean'))):
+                continue
+            agg_timeseries.append(AggregatedTimeSerie.from_dict(
+                a, from_timestamp, to_timestamp))
+        return cls(BoundTimeSerie.from_dict(d['timeserie']), agg_timeseries)
 
     @classmethod
-    def unserialize(cls, data):
-        return cls.from_dict(msgpack.loads(data, encoding='utf-8'))
+    def unserialize(cls, data, from_timestamp=None, to_timestamp=None,
+                    timeserie_filter=None):
+        return cls.from_dict(TimeSerie._unpack(data),
+                             from_timestamp, to_timestamp, timeserie_filter)
 
     @classmethod
     def unserialize_from_file(cls, stream):
-        return cls.from_dict(msgpack.unpack(stream, encoding='utf-8'))
+        return cls.unserialize(stream.read())
 
-    def serialize(self):
-        return msgpack.dumps(self.to_dict())
+    def serialize(self, codec='none'):
+        return TimeSerie._pack(self.to_dict(packed=True), codec)
 
     def serialize_to_file(self, stream):
-        return msgpack.pack(self.to_dict(), stream)
+        return stream.write(self.serialize())
 
     @staticmethod
     def aggregated(timeseries, from_timestamp=None, to_timestamp=None,
@@ -428,22 +979,27 @@ class TimeSerieArchive(object):
             return []
 
         grouped = pandas.concat(dataframes).groupby(level=index)
-        left_boundary_ts = None
-        right_boundary_ts = None
-        maybe_next_timestamp_is_left_boundary = False
-        holes = 0
-        for (timestamp, __), group in grouped:
-            if group.count()['value'] != len(timeseries):
-                maybe_next_timestamp_is_left_boundary = True
-                holes += 1
-            elif maybe_next_timestamp_is_left_boundary:
-                left_boundary_ts = timestamp
-                maybe_next_timestamp_is_left_boundary = False
-            else:
-                right_boundary_ts = timestamp
+
+        # Number of time series having a value at each (timestamp,
+        # granularity), in timestamp order
+        counts = grouped['value'].count()
+        complete = counts.values == len(timeseries)
+        holes = int(len(complete) - complete.sum())
+        # A complete point right after a hole may be the left boundary,
+        # any other complete point may be the right boundary: both are the
+        # last of their kind.
+        after_hole = numpy.concatenate(([False], ~complete[:-1]))
+        timestamps = counts.index.get_level_values('timestamp')
+        left_boundaries = timestamps[complete & after_hole]
+        right_boundaries = timestamps[complete & ~after_hole]
+        left_boundary_ts = (left_boundaries[-1]
+                            if len(left_boundaries) else None)
+        right_boundary_ts = (right_boundaries[-1]
+                             if len(right_boundaries) else None)
+        maybe_next_timestamp_is_left_boundary = not complete[-1]
 
         if to_timestamp is not None and from_timestamp is not None:
-            maximum = len(grouped)
+            maximum = len(counts)
             percent_of_overlap = (float(maximum - holes) * 100.0 /
                                   float(maximum))
             if percent_of_overlap < needed_percent_of_overlap:
@@ -480,6 +1036,7 @@ class TimeSerieArchive(object):
 
 import argparse
 import datetime
+import time
 
 from oslo.utils import timeutils
 import prettytable
@@ -601,3 +1158,48 @@ def update_archive_file():
 
     args.filename[0].seek(0)
     ts.serialize_to_file(args.filename[0])
+    # NOTE(jd) The new payload may be shorter than the one it replaces, e.g.
+    # when migrating from the legacy format.
+    args.filename[0].truncate()
+
+
+def benchmark_archive_file():
+    parser = argparse.ArgumentParser(
+        description="Compare the compression codecs on Carbonara files",
+    )
+    parser.add_argument("--iterations",
+                        type=int,
+                        default=10,
+                        help="number of times each file is (un)compressed")
+    parser.add_argument("filename",
+                        nargs='+',
+                        type=argparse.FileType(mode="rb"),
+                        help="File names to read, each holding any "
+                        "Carbonara object: archive, split, split index or "
+                        "full resolution buffer")
+    args = parser.parse_args()
+
+    # NOTE(jd) Only (un)pack the payloads, so any object stored by the
+    # Carbonara based storage drivers can be benchmarked, whatever it holds.
+    dicts = [TimeSerie._unpack(f.read()) for f in args.filename]
+    size = sum(len(TimeSerie._pack(d)) for d in dicts)
+
+    table = prettytable.PrettyTable(("Codec", "Size", "Ratio",
+                                     "Serialize (ms)", "Unserialize (ms)"))
+    for codec in sorted(COMPRESSION_CODECS):
+        payloads = []
+        start = time.time()
+        for i in six.moves.range(args.iterations):
+            payloads = [TimeSerie._pack(d, codec) for d in dicts]
+        serialize_time = (time.time() - start) / args.iterations
+        start = time.time()
+        for i in six.moves.range(args.iterations):
+            for payload in payloads:
+                TimeSerie._unpack(payload)
+        unserialize_time = (time.time() - start) / args.iterations
+        compressed_size = sum(map(len, payloads))
+        table.add_row((codec, compressed_size,
+                       "%.2f" % (float(size) / compressed_size),
+                       "%.2f" % (serialize_time * 1000),
+                       "%.2f" % (unserialize_time * 1000)))
+    print(table.get_string())
@@ -13,9 +13,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from gnocchi.indexer import sqlalchemy as sql_db
+from gnocchi import metricd as metricd_service
 from gnocchi.rest import app
 from gnocchi import service
 from gnocchi import statsd as statsd_service
+from gnocchi import storage
 
 
 def storage_dbsync():
@@ -23,6 +25,7 @@ def storage_dbsync():
     indexer = sql_db.SQLAlchemyIndexer(conf)
     indexer.connect()
     indexer.upgrade()
+    storage.get_driver(conf).upgrade()
 
 
 def api():
@@ -31,3 +34,7 @@ def api():
 
 def statsd():
     statsd_service.start()
+
+
+def metricd():
+    metricd_service.start()
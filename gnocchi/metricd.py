@@ -0,0 +1,80 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2015 eNovance
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import time
+
+from oslo_log import log
+
+from gnocchi import archive_policy
+from gnocchi import indexer
+from gnocchi import service
+from gnocchi import storage
+
+
+LOG = log.getLogger(__name__)
+
+
+class MetricProcessor(object):
+    def __init__(self, conf):
+        self.conf = conf
+        self.storage = storage.get_driver(self.conf)
+        self.indexer = indexer.get_driver(self.conf)
+        self.indexer.connect()
+
+    def process(self):
+        metric_ids = self.storage.list_metric_with_measures_to_process()
+        if not metric_ids:
+            return
+        metrics = self.indexer.get_metrics(list(metric_ids), details=True)
+        # NOTE(jd) Measures can be queued for a metric while it is deleted:
+        # nobody will ever process them, so drop them.
+        for metric_id in set(metric_ids) - set(str(m['id']) for m in metrics):
+            LOG.debug("Deleting measures of deleted metric %s" % metric_id)
+            try:
+                self.storage.delete_measures_to_process(
+                    storage.Metric(metric_id, None))
+            except Exception as e:
+                LOG.error("Unable to delete measures of metric %s: %s"
+                          % (metric_id, e))
+        for m in metrics:
+            metric = storage.Metric(
+                str(m['id']),
+                archive_policy.ArchivePolicy.from_dict(m['archive_policy']))
+            try:
+                self.storage.process_measures(metric)
+            except Exception as e:
+                # NOTE(jd) The measures are kept, so they are processed
+                # again on the next run.
+                LOG.error("Unable to process measures of metric %s: %s"
+                          % (metric, e))
+        LOG.debug("Processed measures of %d metrics" % len(metrics))
+
+
+def start():
+    conf = service.prepare_service()
+    processor = MetricProcessor(conf)
+    try:
+        while True:
+            try:
+                processor.process()
+            except Exception as e:
+                LOG.error("Unable to process measures: %s" % e)
+            time.sleep(conf.metricd.metric_processing_delay)
+    finally:
+        processor.storage.stop()
+
+
+if __name__ == "__main__":
+    start()
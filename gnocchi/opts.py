@@ -24,6 +24,7 @@ import gnocchi.openstack.common.policy
 import gnocchi.storage
 import gnocchi.storage.ceph
 import gnocchi.storage.file
+import gnocchi.storage.sqlite
 import gnocchi.storage.swift
 
 
@@ -48,11 +49,22 @@ def list_opts():
             cfg.Opt('workers', type=types.Integer(min=1),
                     help='Number of workers for Gnocchi API server. '
                     'By default the available number of CPU is used.'),
+            cfg.BoolOpt('asynchronous_measures',
+                        default=False,
+                        help='Only queue the measures posted, and let '
+                        'gnocchi-metricd process them.'),
+        )),
+        ("metricd", (
+            cfg.IntOpt('metric_processing_delay',
+                       default=5,
+                       help="How many seconds to wait between "
+                       "processing the queued measures"),
         )),
         ("storage", itertools.chain(gnocchi.storage._carbonara.OPTS,
                                     gnocchi.storage.OPTS,
                                     gnocchi.storage.ceph.OPTS,
                                     gnocchi.storage.file.OPTS,
+                                    gnocchi.storage.sqlite.OPTS,
                                     gnocchi.storage.swift.OPTS)),
         ("statsd", (
             cfg.StrOpt(
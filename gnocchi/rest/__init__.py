@@ -17,6 +17,7 @@ import functools
 import json
 import uuid
 
+import numpy
 from oslo.utils import strutils
 from oslo.utils import timeutils
 from oslo_log import log
@@ -131,12 +132,116 @@ def vexpose(schema, *vargs, **vkwargs):
     return expose
 
 
+# Content types returning the timestamps, granularities and values of the
+# measures as arrays, rather than as a list of (timestamp, granularity, value)
+MEASURES_MSGPACK = "application/x-msgpack"
+MEASURES_PACKED = "application/x-gnocchi-measures"
+# Content type streaming lists with one JSON document per line
+NDJSON = "application/x-ndjson"
+
+
+def expose_measures(f):
+    """Expose a controller returning measures in every supported format."""
+    f = pecan.expose('ndjson:', content_type=NDJSON)(f)
+    f = pecan.expose('packed:', content_type=MEASURES_PACKED)(f)
+    f = pecan.expose('msgpack:', content_type=MEASURES_MSGPACK)(f)
+    return pecan.expose('json')(f)
+
+
+TIMESTAMP_FORMATS = ('iso8601', 'epoch')
+
+
+def check_timestamp_format(timestamp_format):
+    if timestamp_format not in TIMESTAMP_FORMATS:
+        pecan.abort(400, 'Invalid timestamp_format value %s, must be one '
+                    'of %s' % (timestamp_format, TIMESTAMP_FORMATS))
+
+
+def get_measures_method():
+    """Return the storage method to get the measures of a metric with.
+
+    The measures are retrieved as they are sent if the response is streamed.
+    """
+    if pecan.request.pecan['content_type'] == NDJSON:
+        return pecan.request.storage.iter_measures
+    return pecan.request.storage.get_measures
+
+
+def measures_to_response(measures, timestamp_format='iso8601'):
+    """Format measures for the content type negotiated with the client."""
+    content_type = pecan.request.pecan['content_type']
+    if content_type in (MEASURES_MSGPACK, MEASURES_PACKED):
+        if measures:
+            timestamps, granularities, values = six.moves.zip(*measures)
+        else:
+            timestamps = granularities = values = ()
+        return {
+            "timestamps": utils.to_epochs(timestamps),
+            "granularities": numpy.array(granularities, dtype=float),
+            "values": numpy.array(values, dtype=float),
+        }
+    if content_type == 'application/json':
+        # NOTE(jd) The measures are only made of strings and numbers, so
+        # there is no need for the generic conversions of the JSON renderer.
+        pecan.override_template('measures_json:')
+    if timestamp_format == 'epoch':
+        if content_type == NDJSON:
+            measures = ((float(utils.to_epochs([timestamp])[0]), offset, v)
+                        for timestamp, offset, v in measures)
+        elif measures:
+            timestamps, granularities, values = six.moves.zip(*measures)
+            measures = six.moves.zip(utils.to_epochs(timestamps).tolist(),
+                                     granularities, values)
+    else:
+        # Replace timestamp keys by their string versions
+        measures = ((timeutils.isotime(timestamp, subsecond=True), offset, v)
+                    for timestamp, offset, v in measures)
+    if content_type == NDJSON:
+        # NOTE(jd) Only format each measure when it is sent
+        return measures
+    return list(measures)
+
+
 def Timestamp(v):
     if v is None:
         return v
     return utils.to_timestamp(v)
 
 
+def MeasuresColumns(value):
+    """Validate measures sent as a list of timestamps and a list of values.
+
+    Both lists are checked and converted at once, which is much faster than
+    validating each measure.
+    """
+    if not isinstance(value, dict) or set(value) != set(['timestamps',
+                                                         'values']):
+        raise voluptuous.Invalid("expected timestamps and values")
+    timestamps = value['timestamps']
+    values = value['values']
+    if not isinstance(timestamps, list) or not isinstance(values, list):
+        raise voluptuous.Invalid("expected lists of timestamps and values")
+    if len(timestamps) != len(values):
+        raise voluptuous.Invalid(
+            "timestamps and values must have the same length")
+    try:
+        timestamps_array = numpy.asarray(timestamps)
+        values_array = numpy.asarray(values)
+    except ValueError:
+        # Lists of lists of different lengths
+        raise voluptuous.Invalid("expected lists of timestamps and values")
+    if timestamps_array.ndim != 1 or values_array.ndim != 1:
+        raise voluptuous.Invalid("expected lists of timestamps and values")
+    if values and values_array.dtype.kind not in 'iuf':
+        raise voluptuous.Invalid("values must be numbers")
+    try:
+        timestamps = utils.to_timestamps(timestamps)
+    except Exception as e:
+        raise voluptuous.Invalid("invalid timestamp: %s" % e)
+    return storage.MeasureColumns(timestamps,
+                                  values_array.astype(float))
+
+
 def convert_metric_list(metrics, created_by_user_id, created_by_project_id):
     # Replace an archive policy as value for an metric by a brand
     # a new metric
@@ -278,15 +383,18 @@ class AggregatedMetricController(rest.RestController):
     def __init__(self, metric_ids):
         self.metric_ids = metric_ids
 
-    @pecan.expose('json')
+    @expose_measures
     def get_measures(self, start=None, stop=None, aggregation='mean',
-                     needed_overlap=100.0):
+                     needed_overlap=100.0, timestamp_format='iso8601'):
         return self.get_cross_metric_measures(self.metric_ids, start, stop,
-                                              aggregation, needed_overlap)
+                                              aggregation, needed_overlap,
+                                              timestamp_format)
 
     @staticmethod
     def get_cross_metric_measures(metric_ids, start=None, stop=None,
-                                  aggregation='mean', needed_overlap=100.0):
+                                  aggregation='mean', needed_overlap=100.0,
+                                  timestamp_format='iso8601'):
+        check_timestamp_format(timestamp_format)
         if (aggregation
            not in archive_policy.ArchivePolicy.VALID_AGGREGATION_METHODS):
             pecan.abort(
@@ -313,7 +421,7 @@ class AggregatedMetricController(rest.RestController):
                 # metric
                 # NOTE(jd): set the archive policy to None as it's not really
                 # used and it has a cost to request it from the indexer
-                measures = pecan.request.storage.get_measures(
+                measures = get_measures_method()(
                     storage.Metric(metric_ids[0], None),
                     start, stop, aggregation)
             else:
@@ -322,9 +430,7 @@ class AggregatedMetricController(rest.RestController):
                 measures = pecan.request.storage.get_cross_metric_measures(
                     [storage.Metric(m, None) for m in metric_ids],
                     start, stop, aggregation, needed_overlap)
-            # Replace timestamp keys by their string versions
-            return [(timeutils.isotime(timestamp, subsecond=True), offset, v)
-                    for timestamp, offset, v in measures]
+            return measures_to_response(measures, timestamp_format)
         except storage.MetricUnaggregatable:
             pecan.abort(400, "One of the metric to aggregated doesn't have "
                         "matching granularity")
@@ -343,11 +449,14 @@ class MetricController(rest.RestController):
                                          invoke_on_load=True)
         self.custom_agg = dict((x.name, x.obj) for x in mgr)
 
-    Measures = voluptuous.Schema([{
-        voluptuous.Required("timestamp"):
-        Timestamp,
-        voluptuous.Required("value"): voluptuous.Any(float, int),
-    }])
+    Measures = voluptuous.Schema(voluptuous.Any(
+        MeasuresColumns,
+        voluptuous.All([{
+            voluptuous.Required("timestamp"):
+            Timestamp,
+            voluptuous.Required("value"): voluptuous.Any(float, int),
+        }], lambda measures: [storage.Measure(m['timestamp'], m['value'])
+                              for m in measures])))
 
     def enforce_metric(self, rule, details=False):
         metrics = pecan.request.indexer.get_metrics((self.metric_id,),
@@ -372,15 +481,17 @@ class MetricController(rest.RestController):
     @vexpose(Measures)
     def post_measures(self, body):
         metric = self.enforce_metric("post measures", details=True)[0]
+        metric = storage.Metric(
+            name=self.metric_id,
+            archive_policy=archive_policy.ArchivePolicy.from_dict(
+                metric['archive_policy']))
+        measures = body
+        if pecan.request.conf.api.asynchronous_measures:
+            pecan.request.storage.queue_measures(metric, measures)
+            pecan.response.status = 202
+            return
         try:
-            pecan.request.storage.add_measures(
-                storage.Metric(
-                    name=self.metric_id,
-                    archive_policy=archive_policy.ArchivePolicy.from_dict(
-                        metric['archive_policy'])),
-                (storage.Measure(
-                    m['timestamp'],
-                    m['value']) for m in body))
+            pecan.request.storage.add_measures(metric, measures)
         except storage.MetricDoesNotExist as e:
             pecan.abort(404, str(e))
         except storage.NoDeloreanAvailable as e:
@@ -390,10 +501,13 @@ class MetricController(rest.RestController):
                         "It can only go back to %s."
                         % (e.bad_timestamp, e.first_timestamp))
 
-    @pecan.expose('json')
+    @expose_measures
     @pecan.expose('measures.j2')
-    def get_measures(self, start=None, stop=None, aggregation='mean', **param):
+    def get_measures(self, start=None, stop=None, aggregation='mean',
+                     timestamp_format='iso8601', granularity=None,
+                     resample=None, **param):
         self.enforce_metric("get measures")
+        check_timestamp_format(timestamp_format)
         if not (aggregation
                 in archive_policy.ArchivePolicy.VALID_AGGREGATION_METHODS
                 or aggregation in self.custom_agg):
@@ -416,25 +530,47 @@ class MetricController(rest.RestController):
             except Exception:
                 pecan.abort(400, "Invalid value for stop")
 
+        if granularity is not None:
+            try:
+                granularity = Timespan(granularity)
+            except ValueError:
+                pecan.abort(400, "Invalid value for granularity")
+
+        if resample is not None:
+            if granularity is None:
+                pecan.abort(400, "A granularity must be specified to resample")
+            try:
+                resample = Timespan(resample)
+            except ValueError:
+                pecan.abort(400, "Invalid value for resample")
+            if resample % granularity:
+                pecan.abort(400, "The resample value must be a multiple of "
+                            "the granularity")
+
+        if aggregation in self.custom_agg and (granularity is not None
+                                               or resample is not None):
+            pecan.abort(400, "Granularity and resample cannot be used with "
+                        "a custom aggregation")
+
         try:
             if aggregation in self.custom_agg:
                 measures = self.custom_agg[aggregation].compute(
                     pecan.request.storage, self.metric_id, start, stop,
                     **param)
             else:
-                measures = pecan.request.storage.get_measures(
+                measures = get_measures_method()(
                     # NOTE(jd) We don't set the archive policy in the object
                     # here because it's not used; but we could do it if needed
                     # by requesting the metric details from the indexer, for
                     # example in the enforce_metric() call above.
                     storage.Metric(name=self.metric_id, archive_policy=None),
-                    start, stop, aggregation)
-            # Replace timestamp keys by their string versions
-            return [(timeutils.isotime(timestamp, subsecond=True), offset, v)
-                    for timestamp, offset, v in measures]
-        except storage.MetricDoesNotExist as e:
+                    start, stop, aggregation, granularity, resample)
+            return measures_to_response(measures, timestamp_format)
+        except (storage.MetricDoesNotExist,
+                storage.GranularityDoesNotExist) as e:
             pecan.abort(404, str(e))
-        except aggregates.CustomAggFailure as e:
+        except (storage.AggregationUnresamplable,
+                aggregates.CustomAggFailure) as e:
             pecan.abort(400, str(e))
 
     @pecan.expose()
@@ -536,6 +672,49 @@ Metrics = voluptuous.Schema({
 })
 
 
+class MeasuresBatchController(rest.RestController):
+    MeasuresBatchSchema = voluptuous.Schema({
+        UUID: MetricController.Measures,
+    })
+
+    @vexpose(MeasuresBatchSchema)
+    def post(self, body):
+        body = dict((str(metric_id), measures)
+                    for metric_id, measures in six.iteritems(body))
+        metrics = pecan.request.indexer.get_metrics(list(body),
+                                                    details=True)
+        unknown_metrics = set(body) - set(str(m['id']) for m in metrics)
+        if unknown_metrics:
+            pecan.abort(400, "Unknown metrics: %s"
+                        % ", ".join(sorted(unknown_metrics)))
+        metrics_and_measures = {}
+        for metric in metrics:
+            enforce("post measures", metric)
+            metrics_and_measures[storage.Metric(
+                name=str(metric['id']),
+                archive_policy=archive_policy.ArchivePolicy.from_dict(
+                    metric['archive_policy']))] = body[str(metric['id'])]
+        if pecan.request.conf.api.asynchronous_measures:
+            for metric, measures in six.iteritems(metrics_and_measures):
+                pecan.request.storage.queue_measures(metric, measures)
+            pecan.response.status = 202
+            return
+        try:
+            pecan.request.storage.add_measures_batch(metrics_and_measures)
+        except storage.MetricDoesNotExist as e:
+            pecan.abort(404, str(e))
+        except storage.NoDeloreanAvailable as e:
+            pecan.abort(400,
+                        "The measure for %s is too old considering the "
+                        "archive policy used by this metric. "
+                        "It can only go back to %s."
+                        % (e.bad_timestamp, e.first_timestamp))
+
+
+class BatchController(rest.RestController):
+    measures = MeasuresBatchController()
+
+
 class NamedMetricController(rest.RestController):
     def __init__(self, resource_id, resource_type):
         self.resource_id = resource_id
@@ -790,6 +969,7 @@ class GenericResourcesController(rest.RestController):
         return resource
 
     @pecan.expose('json')
+    @pecan.expose('ndjson:', content_type=NDJSON)
     def get_all(self, **kwargs):
         details = get_details(kwargs)
 
@@ -871,6 +1051,7 @@ class SearchResourceTypeController(rest.RestController):
     )
 
     @pecan.expose('json')
+    @pecan.expose('ndjson:', content_type=NDJSON)
     def post(self, **kwargs):
         if pecan.request.body:
             attr_filter = deserialize(self.SearchSchema)
@@ -916,6 +1097,7 @@ class V1Controller(rest.RestController):
     search = SearchController()
 
     archive_policy = ArchivePoliciesController()
+    batch = BatchController()
     metric = MetricsController()
     resource = ResourcesController()
 
@@ -934,10 +1116,11 @@ class V1Controller(rest.RestController):
                 namespace='gnocchi.aggregates'))
         return dict(aggregation_methods=aggregation_methods)
 
-    @pecan.expose('json')
+    @expose_measures
     def get_metric_aggregation(self, metric=None, start=None,
                                stop=None, aggregation='mean',
-                               needed_overlap=100.0):
+                               needed_overlap=100.0,
+                               timestamp_format='iso8601'):
         if isinstance(metric, list):
             metrics = metric
         elif metric:
@@ -945,7 +1128,8 @@ class V1Controller(rest.RestController):
         else:
             metrics = []
         return AggregatedMetricController.get_cross_metric_measures(
-            metrics, start, stop, aggregation, needed_overlap)
+            metrics, start, stop, aggregation, needed_overlap,
+            timestamp_format)
 
 
 class RootController(object):
@@ -14,11 +14,15 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import json
 import os
+import struct
 import uuid
 
 from flask import json as flask_json
 import keystonemiddleware.auth_token
+import msgpack
+import numpy
 from oslo.utils import importutils
 from oslo_log import log
 from oslo_serialization import jsonutils
@@ -68,6 +72,87 @@ class OsloJSONRenderer(object):
         return jsonutils.dumps(namespace, default=self.to_primitive)
 
 
+class MeasuresJSONRenderer(object):
+    """Render a list of measures without any conversion of its items."""
+
+    @staticmethod
+    def __init__(path, extra_vars):
+        pass
+
+    @staticmethod
+    def default(value):
+        if isinstance(value, numpy.generic):
+            return value.item()
+        raise TypeError("%r is not JSON serializable" % value)
+
+    def render(self, template_path, namespace):
+        return json.dumps(namespace, default=self.default,
+                          separators=(',', ':'))
+
+
+class NDJSONRenderer(object):
+    """Stream a list as one JSON document per line.
+
+    Each item is only serialized when it is sent, so the whole response is
+    never held in memory.
+    """
+
+    @staticmethod
+    def __init__(path, extra_vars):
+        pass
+
+    @staticmethod
+    def _lines(items):
+        # NOTE(jd) Pecan turns a response whose generator yields nothing into
+        # a 204 No Content, while an empty list is still a list.
+        yield b""
+        for item in items:
+            yield (jsonutils.dumps(item, default=OsloJSONRenderer.to_primitive)
+                   + "\n").encode('utf-8')
+
+    def render(self, template_path, namespace):
+        # NOTE(jd) Pecan only sets the body if something is returned, so the
+        # response can be streamed with a chunked transfer encoding.
+        pecan.response.app_iter = self._lines(namespace)
+
+
+class MsgpackRenderer(object):
+    @staticmethod
+    def __init__(path, extra_vars):
+        pass
+
+    @staticmethod
+    def default(value):
+        if isinstance(value, numpy.ndarray):
+            return value.tolist()
+        return OsloJSONRenderer.to_primitive(value)
+
+    def render(self, template_path, namespace):
+        return msgpack.dumps(namespace, default=self.default,
+                             use_bin_type=True)
+
+
+class PackedMeasuresRenderer(object):
+    """Render measures as packed arrays.
+
+    The response is the number of measures as a little-endian unsigned 32
+    bits integer, followed by the arrays of timestamps, granularities and
+    values as little-endian 64 bits floats.
+    """
+
+    COLUMNS = ("timestamps", "granularities", "values")
+
+    @staticmethod
+    def __init__(path, extra_vars):
+        pass
+
+    def render(self, template_path, namespace):
+        return b"".join(
+            [struct.pack("<I", len(namespace["values"]))]
+            + [numpy.asarray(namespace[column], dtype="<f8").tobytes()
+               for column in self.COLUMNS])
+
+
 class GnocchiJinjaRenderer(templating.JinjaRenderer):
     def __init__(self, *args, **kwargs):
         super(GnocchiJinjaRenderer, self).__init__(*args, **kwargs)
@@ -127,6 +212,10 @@ def setup_app(config=PECAN_CONFIG, cfg=None):
         hooks=(GnocchiHook(s, i, cfg),),
         guess_content_type_from_ext=False,
         custom_renderers={'json': OsloJSONRenderer,
+                          'measures_json': MeasuresJSONRenderer,
+                          'msgpack': MsgpackRenderer,
+                          'ndjson': NDJSONRenderer,
+                          'packed': PackedMeasuresRenderer,
                           'gnocchi_jinja': GnocchiJinjaRenderer},
         default_renderer='gnocchi_jinja',
         template_path=root_dir + "/templates",
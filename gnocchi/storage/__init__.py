@@ -18,6 +18,7 @@
 import collections
 
 from oslo.config import cfg
+import six
 from stevedore import driver
 
 from gnocchi import exceptions
@@ -32,6 +33,10 @@ OPTS = [
 
 Measure = collections.namedtuple('Measure', ['timestamp', 'value'])
 
+# Measures given as an array of timestamps and an array of values
+MeasureColumns = collections.namedtuple('MeasureColumns',
+                                        ['timestamps', 'values'])
+
 
 class Metric(object):
     __slots__ = ['name', 'archive_policy']
@@ -43,6 +48,9 @@ class Metric(object):
     def __eq__(self, other):
         return isinstance(other, self.__class__) and other.name == self.name
 
+    def __hash__(self):
+        return hash(self.name)
+
     def __repr__(self):
         return '<%s %s>' % (self.__class__.__name__, self.name)
 
@@ -59,6 +67,26 @@ class MetricDoesNotExist(Exception):
             "Metric %s does not exist" % metric)
 
 
+class GranularityDoesNotExist(Exception):
+    """Error raised when the granularity does not exist for a metric."""
+
+    def __init__(self, metric, granularity):
+        self.metric = metric
+        self.granularity = granularity
+        super(GranularityDoesNotExist, self).__init__(
+            "Granularity '%s' for metric %s does not exist"
+            % (granularity, metric))
+
+
+class AggregationUnresamplable(Exception):
+    """Error raised when the measures of an aggregation can't be resampled."""
+
+    def __init__(self, aggregation):
+        self.aggregation = aggregation
+        super(AggregationUnresamplable, self).__init__(
+            "Measures aggregated with %s cannot be resampled" % aggregation)
+
+
 class MetricAlreadyExists(Exception):
     """Error raised when this metric already exists."""
 
@@ -111,6 +139,14 @@ class StorageDriver(object):
     def __init__(conf):
         pass
 
+    @staticmethod
+    def upgrade():
+        """Upgrade the layout of the data stored to the current one."""
+
+    @staticmethod
+    def stop():
+        """Release the resources held by the driver, e.g. its workers."""
+
     @staticmethod
     def create_metric(metric):
         """Create a metric.
@@ -124,22 +160,75 @@ class StorageDriver(object):
         """Add a measure to a metric.
 
         :param metric: The metric measured.
-        :param measures: The actual measures.
+        :param measures: The actual measures, as Measure or MeasureColumns.
+        """
+        raise exceptions.NotImplementedError
+
+    def add_measures_batch(self, metrics_and_measures):
+        """Add a batch of measures for some metrics.
+
+        :param metrics_and_measures: A dict where keys are metrics and
+                                     values are the measures to add.
+        """
+        for metric, measures in six.iteritems(metrics_and_measures):
+            self.add_measures(metric, measures)
+
+    @staticmethod
+    def queue_measures(metric, measures):
+        """Queue measures of a metric, to be processed later.
+
+        :param metric: The metric measured.
+        :param measures: The actual measures, as Measure or MeasureColumns.
+        """
+        raise exceptions.NotImplementedError
+
+    @staticmethod
+    def list_metric_with_measures_to_process():
+        """Return the names of the metrics having measures queued."""
+        raise exceptions.NotImplementedError
+
+    @staticmethod
+    def process_measures(metric):
+        """Add the measures queued for a metric.
+
+        :param metric: The metric measured.
+        """
+        raise exceptions.NotImplementedError
+
+    @staticmethod
+    def delete_measures_to_process(metric):
+        """Delete the measures queued for a metric without adding them.
+
+        :param metric: The metric measured, e.g. one that has been deleted.
         """
         raise exceptions.NotImplementedError
 
     @staticmethod
     def get_measures(metric, from_timestamp=None, to_timestamp=None,
-                     aggregation='mean'):
+                     aggregation='mean', granularity=None, resample=None):
         """Get a measure to a metric.
 
         :param metric: The metric measured.
         :param from timestamp: The timestamp to get the measure from.
         :param to timestamp: The timestamp to get the measure to.
         :param aggregation: The type of aggregation to retrieve.
+        :param granularity: The granularity to retrieve, all of them if None.
+        :param resample: The granularity to aggregate the measures of
+                         `granularity` to, only for the aggregation methods
+                         whose aggregates can be aggregated again exactly.
         """
         raise exceptions.NotImplementedError
 
+    def iter_measures(self, metric, from_timestamp=None, to_timestamp=None,
+                      aggregation='mean', granularity=None, resample=None):
+        """Get the measures of a metric as they are retrieved.
+
+        Same as `get_measures`, but returns an iterator. The errors about
+        the metric itself are raised by this call, not while iterating.
+        """
+        return iter(self.get_measures(metric, from_timestamp, to_timestamp,
+                                      aggregation, granularity, resample))
+
     @staticmethod
     def delete_metric(metric):
         raise exceptions.NotImplementedError
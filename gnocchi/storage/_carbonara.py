@@ -15,12 +15,21 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import copy
+import datetime
+import itertools
 import multiprocessing
 import random
+import threading
+import time
 import uuid
 
+import cachetools
 from concurrent import futures
 from oslo.config import cfg
+from oslo_log import log
+import pandas
+import six
 from tooz import coordination
 
 from gnocchi import carbonara
@@ -34,9 +43,121 @@ OPTS = [
     cfg.StrOpt('coordination_url',
                help='Coordination driver URL',
                default="file:///var/lib/gnocchi/locks"),
-
+    cfg.IntOpt('aggregation_processes_number',
+               default=0,
+               help='Number of processes to compute the aggregates in when '
+                    'adding new measures. If 0, they are computed by the '
+                    'workers.'),
+    cfg.IntOpt('cache_size',
+               default=0,
+               help='Size in bytes of the cache of the objects read from '
+                    'the storage, counted on their serialized form. Objects '
+                    'are kept decoded, so reading an object that did not '
+                    'change neither downloads nor decodes it again; its '
+                    'version is still checked against the storage. The '
+                    'cache is disabled if 0.'),
+    cfg.StrOpt('compression',
+               default='none',
+               choices=sorted(carbonara.COMPRESSION_CODECS),
+               help='Compression codec used to store measures. Objects '
+                    'stored with another codec stay readable.'),
+    cfg.BoolOpt('optimistic_concurrency',
+                default=False,
+                help='Update the archives of a metric with compare-and-swap '
+                     'writes, retried on conflict, rather than holding a '
+                     'lock. Ignored by the Swift driver, which cannot '
+                     'replace an object conditionally.'),
 ]
 
+LOG = log.getLogger(__name__)
+
+# Version of an object that does not exist
+ABSENT = object()
+
+
+class ConcurrentUpdate(Exception):
+    """Error raised when an object has been written by someone else."""
+
+    def __init__(self, metric, key):
+        self.metric = metric
+        self.key = key
+        super(ConcurrentUpdate, self).__init__(
+            "Object %s of metric %s has been updated concurrently"
+            % (key, metric))
+
+
+def _measures_to_series(measures):
+    """Return measures as a Series of values indexed by timestamp.
+
+    Only the last value given for a timestamp is kept.
+
+    :param measures: A list of Measure, or a MeasureColumns.
+    """
+    if isinstance(measures, storage.MeasureColumns):
+        series = pandas.Series(measures.values,
+                               pandas.DatetimeIndex(measures.timestamps))
+    else:
+        measures = list(measures)
+        series = pandas.Series(
+            [m.value for m in measures],
+            pandas.DatetimeIndex([m.timestamp for m in measures]))
+    return _last_values(series)
+
+
+def _last_values(series):
+    """Only keep the last value of each timestamp of a Series."""
+    if series.index.is_unique:
+        return series
+    return series.groupby(level=0).last()
+
+
+def _update_timeseries(compression, timeserie_data, series, measures,
+                       first_timestamp, last_timestamp):
+    """Add measures to the time series of a metric.
+
+    This is the CPU-bound part of adding measures: it only takes and returns
+    bytes, so it can be run in another process.
+
+    :param compression: The codec to serialize the time series with.
+    :param timeserie_data: The serialized full resolution buffer.
+    :param series: A list of (serialized aggregated time serie, list of its
+                   serialized splits), the splits replacing the points of
+                   the time serie unless None.
+    :param measures: The measures to add, as a Series of values indexed by
+                     timestamp.
+    :param first_timestamp: The first timestamp of the measures.
+    :param last_timestamp: The last timestamp of the measures.
+    :return: A tuple with the serialized full resolution buffer and, for
+             each aggregated time serie, a dict of its splits, as
+             {split key: (serialized split, number of points)}.
+    """
+    timeserie = carbonara.BoundTimeSerie.unserialize(timeserie_data)
+    timeseries = []
+    for data, splits in series:
+        ts = carbonara.AggregatedTimeSerie.unserialize(data)
+        if splits is not None:
+            # NOTE(jd) Only the splits covering the measures are given, but
+            # a point with max_size more recent points among them is beyond
+            # the retention anyway, so the ring buffer can drop it.
+            ts = carbonara.AggregatedTimeSerie.from_timeseries(
+                [carbonara.AggregatedTimeSerie.unserialize(split)
+                 for split in splits],
+                ts.sampling, ts.aggregation_method, ts.max_size)
+        timeseries.append(ts)
+
+    def _update_archives(ts):
+        # NOTE(jd) Update all the archives at once, so buckets are
+        # computed once per granularity and percentiles in one pass.
+        carbonara.AggregatedTimeSerie.update_all(
+            timeseries, ts, first_timestamp, last_timestamp)
+
+    timeserie.set_values(measures,
+                         before_truncate_callback=_update_archives)
+    return (timeserie.serialize(compression),
+            [dict((key, (split.serialize(compression), len(split)))
+                  for key, split in ts.split())
+             for ts in timeseries])
+
 
 class CarbonaraBasedStorageToozLock(object):
     def __init__(self, conf):
@@ -55,11 +176,66 @@ class CarbonaraBasedStorageToozLock(object):
 
 
 class CarbonaraBasedStorage(storage.StorageDriver):
+    # Name of the object storing the full resolution buffer of a metric
+    UNAGGREGATED = "none"
+    # Prefix of the objects storing the measures to process
+    MEASURE_PREFIX = "measure"
+    # Number of attempts to add measures with compare-and-swap, and the
+    # maximum time to wait before the first retry, doubled on each attempt
+    CONCURRENT_UPDATE_ATTEMPTS = 10
+    CONCURRENT_UPDATE_DELAY = 0.05
+
     def __init__(self, conf):
         super(CarbonaraBasedStorage, self).__init__(conf)
+        self.compression = conf.compression
+        self.optimistic_concurrency = conf.optimistic_concurrency
+        self.aggregation_workers_number = (conf.aggregation_workers_number or
+                                           multiprocessing.cpu_count())
         self.executor = futures.ThreadPoolExecutor(
-            max_workers=(conf.aggregation_workers_number or
-                         multiprocessing.cpu_count()))
+            max_workers=self.aggregation_workers_number)
+        self.aggregation_processes_number = conf.aggregation_processes_number
+        # Started on first use, as most processes using the driver never
+        # add measures
+        self._process_executor = None
+        self._process_executor_lock = threading.Lock()
+        self._in_executor = threading.local()
+        # Batches of measures waiting for the metric to be updated
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        if conf.cache_size:
+            self.cache = cachetools.LRUCache(
+                maxsize=conf.cache_size,
+                getsizeof=lambda cached: len(cached[1]))
+            self.cache_lock = threading.Lock()
+        else:
+            self.cache = None
+
+    def stop(self):
+        self.executor.shutdown()
+        with self._process_executor_lock:
+            if self._process_executor is not None:
+                self._process_executor.shutdown()
+                self._process_executor = None
+
+    @property
+    def process_executor(self):
+        """The executor computing the aggregates, or None to do it here."""
+        if not self.aggregation_processes_number:
+            return None
+        with self._process_executor_lock:
+            if self._process_executor is None:
+                # NOTE(jd) Forking would copy the threads and the locks of
+                # this process as they are, so start the workers from
+                # scratch when the executor allows it.
+                try:
+                    self._process_executor = futures.ProcessPoolExecutor(
+                        max_workers=self.aggregation_processes_number,
+                        mp_context=multiprocessing.get_context('spawn'))
+                except (AttributeError, TypeError):
+                    # Python < 3.7
+                    self._process_executor = futures.ProcessPoolExecutor(
+                        max_workers=self.aggregation_processes_number)
+            return self._process_executor
 
     @staticmethod
     def _create_metric_container(metric, archive_policy):
@@ -71,17 +247,23 @@ class CarbonaraBasedStorage(storage.StorageDriver):
 
     def create_metric(self, metric):
         self._create_metric_container(metric)
+        archive = None
+        objects = []
         for aggregation in metric.archive_policy.aggregation_methods:
-            # TODO(jd) Having the TimeSerieArchive.full_res_timeserie duped in
-            # each archive isn't the most efficient way of doing things. We
-            # may want to store it as its own object.
             archive = carbonara.TimeSerieArchive.from_definitions(
                 [(v.granularity, v.points)
                  for v in metric.archive_policy.definition],
                 back_window=metric.archive_policy.back_window,
                 aggregation_method=aggregation)
-            self._store_metric_measures(metric, aggregation,
-                                        archive.serialize())
+            objects.append((aggregation,
+                            archive.serialize(self.compression)))
+        if archive is not None:
+            # The full resolution buffer is shared by all the aggregation
+            # methods, so it is stored once as its own object.
+            objects.append(
+                (self.UNAGGREGATED,
+                 archive.full_res_timeserie.serialize(self.compression)))
+        self._store_objects(metric, objects)
 
     @staticmethod
     def _get_measures(metric, aggregation):
@@ -89,60 +271,818 @@ class CarbonaraBasedStorage(storage.StorageDriver):
 
     @staticmethod
     def _store_metric_measures(metric, aggregation, data):
+        """Store an object.
+
+        :return: The version of the object written, as returned by
+                 `_get_measures_version`, or None if it cannot be known.
+        """
         raise NotImplementedError
 
+    @staticmethod
+    def _delete_metric_measures(metric, aggregation):
+        raise NotImplementedError
+
+    @staticmethod
+    def _get_measures_version(metric, aggregation):
+        """Return an identifier of the version of a stored object.
+
+        It must change each time the object is written. It may be None if
+        it cannot be known, only if the driver does not support
+        `optimistic_concurrency`.
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def _store_metric_measures_if_version(metric, aggregation, data,
+                                          version):
+        """Store an object only if its version has not changed.
+
+        :param version: The version the object must have, or ABSENT if it
+                        must not exist.
+        :raise ConcurrentUpdate: If the object has another version.
+        :return: The version of the object written, or None if it cannot be
+                 known.
+        """
+        raise NotImplementedError
+
+    def _get_object(self, metric, key, versions=None, decode=None):
+        """Return an object, from the cache if it is still up to date.
+
+        :param versions: A dict where to record the version of the object,
+                         taken before it is read.
+        :param decode: A function to decode the object with. If set, the
+                       decoded object is returned, and kept in the cache so
+                       it is only decoded once per version. Every caller
+                       gets its own copy, which it is free to modify.
+        """
+        if self.cache is None and versions is None:
+            data = self._get_measures(metric, key)
+            return data if decode is None else decode(data)
+        # NOTE(jd) The version is checked against the backend, so objects
+        # written by other processes are never served from the cache.
+        try:
+            version = self._get_measures_version(metric, key)
+        except storage.MetricDoesNotExist:
+            if versions is not None:
+                versions[key] = ABSENT
+            raise
+        if versions is not None:
+            versions[key] = version
+        if self.cache is None:
+            data = self._get_measures(metric, key)
+            return data if decode is None else decode(data)
+        cached = None
+        if version is not None:
+            with self.cache_lock:
+                cached = self.cache.get((metric.name, key))
+            if cached is not None and cached[0] != version:
+                cached = None
+        if cached is None:
+            data = self._get_measures(metric, key)
+            decoded = None
+        else:
+            __, data, decoded = cached
+        if decode is None:
+            if cached is None:
+                self._cache_object(metric, key, version, data)
+            return data
+        if decoded is None:
+            decoded = decode(data)
+            self._cache_object(metric, key, version, data, decoded)
+        return copy.deepcopy(decoded)
+
+    def _store_object(self, metric, key, data, versions=None):
+        """Store an object.
+
+        :param versions: A dict of the versions of the objects read, or None.
+                         If set, the object is only written if it still has
+                         the version recorded, or does not exist if none is.
+        """
+        if versions is None:
+            version = self._store_metric_measures(metric, key, data)
+        else:
+            version = self._store_metric_measures_if_version(
+                metric, key, data, versions.get(key, ABSENT))
+        if self.cache is not None:
+            # NOTE(jd) Use the version returned by the write itself: asking
+            # for it again could return the one of a more recent write.
+            self._cache_object(metric, key, version, data)
+
+    def _store_objects(self, metric, objects, versions=None):
+        """Store several objects of a metric.
+
+        :param objects: A list of (key, data).
+        :param versions: A dict of the versions of the objects read, or None.
+        """
+        self._map_in_thread(self._store_object,
+                            [(metric, key, data, versions)
+                             for key, data in objects])
+
+    def _cache_object(self, metric, key, version, data, decoded=None):
+        """Cache an object under its version.
+
+        :param decoded: The object decoded, if it has been.
+        """
+        with self.cache_lock:
+            if version is None:
+                self.cache.pop((metric.name, key), None)
+            elif len(data) <= self.cache.maxsize:
+                self.cache[(metric.name, key)] = (version, data, decoded)
+
+    @staticmethod
+    def _store_measures(metric, data):
+        raise NotImplementedError
+
+    @staticmethod
+    def _list_metric_with_measures_to_process():
+        raise NotImplementedError
+
+    @staticmethod
+    def _list_measures_to_process(metric):
+        raise NotImplementedError
+
+    @staticmethod
+    def _get_unprocessed_measures(metric, name):
+        raise NotImplementedError
+
+    @staticmethod
+    def _delete_unprocessed_measures(metric, names):
+        raise NotImplementedError
+
+    @staticmethod
+    def _new_measures_name():
+        # NOTE(jd) Names sort in the order the measures have been queued, so
+        # that the most recent value wins for a given timestamp.
+        return "%s_%s" % (
+            datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S%f"),
+            uuid.uuid4())
+
+    @staticmethod
+    def _split_key(aggregation, granularity, split_key=None):
+        key = "%s_%s" % (aggregation, float(granularity))
+        if split_key is None:
+            return key
+        return "%s_%s" % (key, split_key.value / 10e8)
+
+    def _object_keys(self, metric):
+        """Return the names of all the objects stored for a metric."""
+        keys = [self.UNAGGREGATED]
+        indexes = []
+        for aggregation in metric.archive_policy.aggregation_methods:
+            keys.append(aggregation)
+            for d in metric.archive_policy.definition:
+                keys.append(self._split_key(aggregation, d.granularity))
+                indexes.append((metric, aggregation, d.granularity))
+        for (__, aggregation, granularity), index in six.moves.zip(
+                indexes, self._map_in_thread(self._get_split_index,
+                                             indexes)):
+            keys.extend(self._split_key(aggregation, granularity, key)
+                        for key in index.ts.index)
+        return keys
+
     def get_measures(self, metric, from_timestamp=None, to_timestamp=None,
-                     aggregation='mean'):
-        archive = self._get_measures_archive(metric, aggregation)
+                     aggregation='mean', granularity=None, resample=None):
+        if (resample is not None
+           and aggregation not in carbonara.RESAMPLE_METHODS):
+            raise storage.AggregationUnresamplable(aggregation)
+        if granularity is None:
+            timeserie_filter = None
+        else:
+            # NOTE(jd) Only retrieve the splits of the granularity asked for
+            def timeserie_filter(ts):
+                return ts.sampling.nanos / 10e8 == granularity
+        archives, __ = self._get_archives([(metric, aggregation)],
+                                          timeserie_filter,
+                                          from_timestamp=from_timestamp,
+                                          to_timestamp=to_timestamp)
+        archive = archives[0]
+        if granularity is not None:
+            if not archive.agg_timeseries:
+                raise storage.GranularityDoesNotExist(metric, granularity)
+            if resample is not None:
+                archive.agg_timeseries = [ts.resample(resample)
+                                          for ts in archive.agg_timeseries]
         return archive.fetch(from_timestamp, to_timestamp)
 
-    def _get_measures_archive(self, metric, aggregation):
-        contents = self._get_measures(metric, aggregation)
-        return carbonara.TimeSerieArchive.unserialize(contents)
+    def iter_measures(self, metric, from_timestamp=None, to_timestamp=None,
+                      aggregation='mean', granularity=None, resample=None):
+        if resample is not None:
+            # NOTE(jd) Resampling needs all the points of the granularity
+            return super(CarbonaraBasedStorage, self).iter_measures(
+                metric, from_timestamp, to_timestamp, aggregation,
+                granularity, resample)
+        archive = self._get_archive_header(metric, aggregation)
+        timeseries = archive.agg_timeseries
+        if granularity is not None:
+            timeseries = [ts for ts in timeseries
+                          if ts.sampling.nanos / 10e8 == granularity]
+            if not timeseries:
+                raise storage.GranularityDoesNotExist(metric, granularity)
 
-    def _add_measures(self, aggregation, metric, measures):
-        with self._lock(metric, aggregation):
-            contents = self._get_measures(metric, aggregation)
-            archive = carbonara.TimeSerieArchive.unserialize(contents)
-            try:
-                archive.set_values([(m.timestamp, m.value)
-                                    for m in measures])
-            except carbonara.NoDeloreanAvailable as e:
-                raise storage.NoDeloreanAvailable(e.first_timestamp,
-                                                  e.bad_timestamp)
-            self._store_metric_measures(metric, aggregation,
-                                        archive.serialize())
+        # NOTE(jd) Like TimeSerieArchive.fetch, a time serie only returns
+        # the points older than the first point of the finer ones, and the
+        # coarser ones come first. So read the first split holding points of
+        # each time serie, finest first, before returning anything: this
+        # also raises the errors before the caller starts sending measures.
+        chunks = []
+        end_timestamp = to_timestamp
+        for ts in timeseries:
+            splits = self._iter_points(metric, aggregation, ts,
+                                       from_timestamp, end_timestamp,
+                                       to_timestamp)
+            head = []
+            for points in splits:
+                head.append(points)
+                if len(points):
+                    end_timestamp = points.index[0]
+                    break
+            chunks.append((ts.sampling.nanos / 10e8,
+                           itertools.chain(head, splits)))
+
+        def measures():
+            for granularity, splits in reversed(chunks):
+                for points in splits:
+                    for timestamp, value in six.iteritems(points):
+                        yield timestamp, granularity, value
+        return measures()
+
+    def _iter_points(self, metric, aggregation, ts, from_timestamp,
+                     to_timestamp, excluded_timestamp):
+        """Return the points of an aggregated time serie, split by split.
+
+        :param ts: The aggregated time serie of the archive header.
+        :param excluded_timestamp: A timestamp whose point is left out.
+        :return: An iterator of Series, in timestamp order.
+        """
+        if len(ts):
+            # Archives written before aggregated time series were split
+            # still embed their points.
+            splits = [ts.ts]
+        else:
+            granularity = ts.sampling.nanos / 10e8
+            index = self._get_split_index(metric, aggregation, granularity)
+            retained, excess = self._retained_splits(index, ts.max_size)
+            split_keys = retained
+            if from_timestamp is not None:
+                first = carbonara.AggregatedTimeSerie.get_split_key(
+                    from_timestamp, ts.sampling)
+                split_keys = [key for key in split_keys if key >= first]
+            if to_timestamp is not None:
+                last = carbonara.AggregatedTimeSerie.get_split_key(
+                    to_timestamp, ts.sampling)
+                split_keys = [key for key in split_keys if key <= last]
+            if not split_keys or split_keys[0] != retained[0]:
+                excess = 0
+            splits = (self._get_split_points(
+                metric, aggregation, granularity, key,
+                excess if i == 0 else 0, from_timestamp, to_timestamp)
+                for i, key in enumerate(split_keys))
+        for points in splits:
+            points = points[from_timestamp:to_timestamp]
+            if excluded_timestamp is not None:
+                points = points[points.index != excluded_timestamp]
+            yield points
+
+    def _get_split_points(self, metric, aggregation, granularity, key,
+                          excess, from_timestamp, to_timestamp):
+        """Return the points of a split.
+
+        :param excess: The number of points to drop at its beginning.
+        """
+        if excess or self.cache is not None:
+            decode = carbonara.AggregatedTimeSerie.unserialize
+        else:
+            # The payload is still fully decoded, but only the points in the
+            # requested range are built
+            def decode(data):
+                return carbonara.AggregatedTimeSerie.unserialize(
+                    data, from_timestamp, to_timestamp)
+        split = self._get_split(metric, aggregation, granularity, key,
+                                decode=decode)
+        return split.ts.iloc[excess:]
+
+    def _get_archive_header(self, metric, aggregation, versions=None):
+        return self._get_object(metric, aggregation, versions,
+                                carbonara.TimeSerieArchive.unserialize)
+
+    @staticmethod
+    def _archive_header(archive):
+        """Return a copy of an archive without any point."""
+        return carbonara.TimeSerieArchive(
+            carbonara.BoundTimeSerie(
+                block_size=archive.full_res_timeserie.block_size,
+                back_window=archive.full_res_timeserie.back_window),
+            [carbonara.AggregatedTimeSerie(
+                max_size=ts.max_size,
+                sampling=ts.sampling,
+                aggregation_method=ts.aggregation_method)
+             for ts in archive.agg_timeseries])
+
+    def _get_split_index(self, metric, aggregation, granularity,
+                         versions=None):
+        """Return the index of the splits of an aggregated time serie.
+
+        The index is a TimeSerie whose timestamps are the split keys and
+        values the number of points stored in each split.
+        """
+        try:
+            return self._get_object(
+                metric, self._split_key(aggregation, granularity), versions,
+                carbonara.TimeSerie.unserialize)
+        except storage.MetricDoesNotExist:
+            # Nothing has been stored for this granularity yet
+            return carbonara.TimeSerie()
+
+    def _get_split(self, metric, aggregation, granularity, key,
+                   versions=None, decode=None):
+        return self._get_object(
+            metric, self._split_key(aggregation, granularity, key), versions,
+            decode)
+
+    def _delete_split(self, metric, aggregation, granularity, key):
+        key = self._split_key(aggregation, granularity, key)
+        self._delete_metric_measures(metric, key)
+        if self.cache is not None:
+            with self.cache_lock:
+                self.cache.pop((metric.name, key), None)
+
+    @staticmethod
+    def _retained_splits(index, max_size):
+        """Return the splits holding the last `max_size` points of a serie.
+
+        :param index: The split index.
+        :param max_size: The maximum number of points of the time serie.
+        :return: A tuple with the list of split keys, and the number of points
+                 of the oldest split that are beyond `max_size`.
+        """
+        keys = list(index.ts.index)
+        if max_size is not None:
+            total = 0
+            for i in six.moves.range(len(keys) - 1, -1, -1):
+                total += int(index.ts.values[i])
+                if total >= max_size:
+                    return keys[i:], total - max_size
+        return keys, 0
+
+    def _get_archives(self, keys, timeserie_filter=None, archives=None,
+                      from_timestamp=None, to_timestamp=None, trim=True,
+                      versions=None, unserialize=True):
+        """Retrieve the archives of several metric/aggregation pairs.
+
+        The archive header is stored under the aggregation name. Each of its
+        aggregated time series is stored as splits of POINTS_PER_SPLIT points
+        listed in a split index, so only the splits matching
+        `timeserie_filter` and overlapping the requested time range are
+        retrieved.
+
+        :param keys: A list of (metric, aggregation) tuples.
+        :param timeserie_filter: A function to select the aggregated time
+                                 series to retrieve.
+        :param archives: The archive headers, if already retrieved.
+        :param from_timestamp: The first timestamp needed.
+        :param to_timestamp: The last timestamp needed.
+        :param trim: Whether to drop the points stored beyond the maximum
+                     size of the time series.
+        :param versions: A dict where to record the versions of the objects
+                         read.
+        :param unserialize: Whether to replace the aggregated time series of
+                            the archives by the points of their splits. If
+                            not, only the payloads of the splits are
+                            returned.
+        :return: A tuple with the list of archives and, for each archive, a
+                 list of (split index, {split key: payload}) for its
+                 aggregated time series. The split index is None if the
+                 time serie has not been stored as splits yet. The payloads
+                 are decoded if the splits have been unserialized through
+                 the cache.
+        """
+        if archives is None:
+            archives = self._map_in_thread(self._get_archive_header, keys)
+
+        series = []
+        for (metric, aggregation), archive in six.moves.zip(keys, archives):
+            if timeserie_filter is not None:
+                archive.agg_timeseries = list(
+                    filter(timeserie_filter, archive.agg_timeseries))
+            series.extend((metric, aggregation, ts)
+                          for ts in archive.agg_timeseries)
+
+        indexes = self._map_in_thread(
+            self._get_split_index,
+            [(metric, aggregation, ts.sampling.nanos / 10e8, versions)
+             for metric, aggregation, ts in series])
+
+        # NOTE(jd) Cached splits are decoded once and for all, so get them
+        # whole and slice them; otherwise only build the points of the
+        # requested range out of their payloads.
+        if unserialize and self.cache is not None:
+            decode = carbonara.AggregatedTimeSerie.unserialize
+        else:
+            decode = None
+
+        wanted = []
+        splits = []
+        for (metric, aggregation, ts), index in six.moves.zip(series,
+                                                              indexes):
+            if len(ts):
+                # NOTE(jd) Archives written before aggregated time series
+                # were split still embed their points.
+                wanted.append(([], 0))
+                continue
+            retained, excess = self._retained_splits(index, ts.max_size)
+            split_keys = retained
+            if from_timestamp is not None:
+                first = carbonara.AggregatedTimeSerie.get_split_key(
+                    from_timestamp, ts.sampling)
+                split_keys = [key for key in split_keys if key >= first]
+            if to_timestamp is not None:
+                last = carbonara.AggregatedTimeSerie.get_split_key(
+                    to_timestamp, ts.sampling)
+                split_keys = [key for key in split_keys if key <= last]
+            if not trim or not split_keys or split_keys[0] != retained[0]:
+                # Only the oldest split may hold points beyond max_size
+                excess = 0
+            wanted.append((split_keys, excess))
+            splits.extend((metric, aggregation, ts.sampling.nanos / 10e8, key,
+                           versions, decode)
+                          for key in split_keys)
+
+        payloads = iter(self._map_in_thread(self._get_split, splits))
+
+        series = iter(six.moves.zip(indexes, wanted))
+        splits = []
+        for archive in archives:
+            archive_splits = []
+            for i, ts in enumerate(archive.agg_timeseries):
+                index, (split_keys, excess) = next(series)
+                if len(ts):
+                    archive_splits.append((None, {}))
+                    continue
+                split_payloads = {}
+                points = []
+                for key in split_keys:
+                    split_payloads[key] = next(payloads)
+                    if not unserialize:
+                        continue
+                    if decode is not None:
+                        split = split_payloads[key]
+                        if trim and not (excess and key == split_keys[0]):
+                            split.ts = split.ts[from_timestamp:to_timestamp]
+                        points.append(split)
+                    elif not trim or (excess and key == split_keys[0]):
+                        points.append(
+                            carbonara.AggregatedTimeSerie.unserialize(
+                                split_payloads[key]))
+                    else:
+                        # Only build the points in the requested range
+                        points.append(
+                            carbonara.AggregatedTimeSerie.unserialize(
+                                split_payloads[key],
+                                from_timestamp, to_timestamp))
+                archive_splits.append((index, split_payloads))
+                if not unserialize:
+                    continue
+                if points and excess:
+                    points[0].ts = points[0].ts.iloc[excess:]
+                archive.agg_timeseries[i] = (
+                    carbonara.AggregatedTimeSerie.from_timeseries(
+                        points, ts.sampling, ts.aggregation_method))
+            splits.append(archive_splits)
+        return archives, splits
+
+    def _store_splits(self, metric, aggregation, granularity, new_splits,
+                      index, payloads, max_size):
+        """Return the splits that changed and the ones to delete.
+
+        :param new_splits: The splits of the time serie, as
+                           {split key: (payload, number of points)}.
+        :param index: The split index of the time serie, or None if it has
+                      not been stored as splits yet.
+        :param payloads: The payloads of the splits that have been retrieved.
+        :param max_size: The maximum number of points of the time serie.
+        :return: A tuple with the list of (key, data) of the objects to
+                 store, and the list of the arguments of `_delete_split` for
+                 the splits to delete.
+        """
+        if index is None:
+            stored = set()
+            counts = {}
+        else:
+            stored = set(index.ts.index)
+            counts = index.ts.to_dict()
+        original_counts = dict(counts)
+
+        changed = {}
+        for key in payloads:
+            if key not in new_splits:
+                del counts[key]
+        for key, (data, count) in six.iteritems(new_splits):
+            if data != payloads.get(key):
+                changed[key] = data
+                counts[key] = count
+
+        split_keys = sorted(counts)
+        index = carbonara.TimeSerie(pandas.to_datetime(split_keys),
+                                    [counts[key] for key in split_keys])
+        retained, __ = self._retained_splits(index, max_size)
+        index.ts = index.ts.iloc[len(index) - len(retained):]
+        retained = set(retained)
+
+        objects = [(self._split_key(aggregation, granularity, key), data)
+                   for key, data in six.iteritems(changed)
+                   if key in retained]
+        if index.ts.to_dict() != original_counts or not stored:
+            objects.append((self._split_key(aggregation, granularity),
+                            index.serialize(self.compression)))
+        return objects, [(metric, aggregation, granularity, key)
+                         for key in stored - retained]
 
     def add_measures(self, metric, measures):
-        # We are going to iterate multiple time over measures, so if it's a
-        # generator we need to build a list out of it right now.
-        measures = list(measures)
-        # NOTE(jd) So this is a (smart?) optimization: since we're going to
-        # lock for each of this aggregation type, if we are using running
-        # Gnocchi with multiple processes, let's randomize what we iter
-        # over so there are less chances we fight for the same lock!
-        agg_methods = list(metric.archive_policy.aggregation_methods)
-        random.shuffle(agg_methods)
-        self._map_in_thread(self._add_measures,
-                            list((aggregation, metric, measures)
-                                 for aggregation
-                                 in agg_methods))
+        self._add_series(metric, _measures_to_series(measures))
+
+    def _add_series(self, metric, measures):
+        """Add measures given as a Series of values indexed by timestamp."""
+        if measures.empty:
+            return
+        if getattr(self._in_executor, 'value', False):
+            # NOTE(jd) Never wait for another thread from a worker of the
+            # executor: the thread updating the metric might need that worker
+            # to finish its own update.
+            return self._apply_measures(metric, measures)
+        batch = futures.Future()
+        with self._pending_lock:
+            pending = self._pending.get(metric.name)
+            if pending is None:
+                # Nobody is updating this metric, so do it
+                self._pending[metric.name] = []
+            else:
+                # NOTE(jd) Leave the measures to the thread already updating
+                # this metric: it applies all the batches queued in the
+                # meantime in a single update once it is done.
+                pending.append((measures, batch))
+        if pending is not None:
+            return batch.result()
+        batches = [(measures, batch)]
+        try:
+            while batches:
+                self._apply_batches(metric, batches)
+                with self._pending_lock:
+                    batches = self._pending[metric.name]
+                    if batches:
+                        self._pending[metric.name] = []
+                    else:
+                        del self._pending[metric.name]
+        except BaseException as e:
+            # NOTE(jd) Do not leave the metric marked as being updated, nor
+            # the threads that queued their measures waiting forever.
+            with self._pending_lock:
+                batches.extend(self._pending.pop(metric.name, []))
+            for __, queued in batches:
+                if not queued.done():
+                    queued.set_exception(e)
+            raise
+        return batch.result()
+
+    def _apply_batches(self, metric, batches):
+        """Apply batches of measures to a metric in a single update.
+
+        :param batches: A list of (measures, future), the future being set
+                        with the outcome of adding the measures.
+        """
+        if len(batches) == 1:
+            measures = batches[0][0]
+        else:
+            # The most recent batch wins for a given timestamp
+            measures = _last_values(pandas.concat(
+                [batch_measures for batch_measures, __ in batches]))
+        try:
+            self._apply_measures(metric, measures)
+        except storage.NoDeloreanAvailable as e:
+            if len(batches) == 1:
+                batches[0][1].set_exception(e)
+                return
+            # Only fail the batches holding measures too old
+            for batch_measures, batch in batches:
+                try:
+                    self._apply_measures(metric, batch_measures)
+                except Exception as error:
+                    batch.set_exception(error)
+                else:
+                    batch.set_result(None)
+        except Exception as e:
+            for __, batch in batches:
+                batch.set_exception(e)
+        else:
+            for __, batch in batches:
+                batch.set_result(None)
+
+    def _apply_measures(self, metric, measures):
+        if self.optimistic_concurrency:
+            # NOTE(jd) Each attempt reads everything it needs before writing
+            # anything, and every write fails if the object changed since it
+            # has been read, so an attempt that went through has not missed
+            # any concurrent update. Measures are applied again by the next
+            # attempt, which is harmless.
+            for attempt in six.moves.range(self.CONCURRENT_UPDATE_ATTEMPTS):
+                if attempt:
+                    # Jitter the delay so that the writers that conflicted
+                    # do not conflict again
+                    time.sleep(random.uniform(
+                        0, self.CONCURRENT_UPDATE_DELAY * 2 ** (attempt - 1)))
+                try:
+                    return self._add_measures(metric, measures, {})
+                except ConcurrentUpdate as e:
+                    LOG.debug("Retrying to add measures: %s" % e)
+                    conflict = e
+            raise conflict
+        with self._lock(metric, self.UNAGGREGATED):
+            self._add_measures(metric, measures)
+
+    def _add_measures(self, metric, measures, versions=None):
+        """Add measures to the archives of a metric.
+
+        :param versions: A dict to record the versions of the objects read,
+                         to write them with compare-and-swap, or None if
+                         the metric is locked.
+        """
+        first_timestamp = measures.index.min()
+        last_timestamp = measures.index.max()
+        keys = [(metric, aggregation)
+                for aggregation in metric.archive_policy.aggregation_methods]
+        try:
+            timeserie_data = self._get_object(metric, self.UNAGGREGATED,
+                                              versions)
+        except storage.MetricDoesNotExist:
+            # NOTE(jd) Metrics created before the full resolution buffer
+            # was stored on its own carry a copy of it, and their points, in
+            # the archive of each aggregation method: migrate them.
+            headers = self._map_in_thread(
+                self._get_archive_header,
+                [(metric, aggregation, versions)
+                 for metric, aggregation in keys])
+            if not headers:
+                raise
+            timeserie_data = headers[0].full_res_timeserie.serialize()
+            legacy = True
+        else:
+            # NOTE(jd) The archive headers only hold the definition of the
+            # archive policy, so there is no need to read them.
+            headers = [
+                carbonara.TimeSerieArchive.from_definitions(
+                    [(d.granularity, d.points)
+                     for d in metric.archive_policy.definition],
+                    aggregation_method=aggregation)
+                for __, aggregation in keys]
+            legacy = False
+        max_sizes = [[ts.max_size for ts in header.agg_timeseries]
+                     for header in headers]
+        # Only the splits covering the new measures are needed
+        archives, splits = self._get_archives(
+            keys, archives=headers,
+            from_timestamp=first_timestamp,
+            to_timestamp=last_timestamp,
+            trim=False, versions=versions, unserialize=False)
+
+        series = []
+        for archive, archive_splits in six.moves.zip(archives, splits):
+            for ts, (index, payloads) in six.moves.zip(
+                    archive.agg_timeseries, archive_splits):
+                if index is None:
+                    series.append((ts.serialize(), None))
+                else:
+                    series.append((ts.serialize(),
+                                   [payloads[key]
+                                    for key in sorted(payloads)]))
+        args = (self.compression, timeserie_data, series, measures,
+                first_timestamp, last_timestamp)
+        try:
+            process_executor = self.process_executor
+            if process_executor is None:
+                timeserie_data, new_splits = _update_timeseries(*args)
+            else:
+                timeserie_data, new_splits = process_executor.submit(
+                    _update_timeseries, *args).result()
+        except carbonara.NoDeloreanAvailable as e:
+            raise storage.NoDeloreanAvailable(e.first_timestamp,
+                                              e.bad_timestamp)
+
+        # Only write the splits that actually changed
+        objects = []
+        deleted = []
+        new_splits = iter(new_splits)
+        for (__, aggregation), archive, archive_splits, sizes in (
+                six.moves.zip(keys, archives, splits, max_sizes)):
+            for ts, (index, payloads), max_size in six.moves.zip(
+                    archive.agg_timeseries, archive_splits, sizes):
+                split_objects, split_deleted = self._store_splits(
+                    metric, aggregation, ts.sampling.nanos / 10e8,
+                    next(new_splits), index, payloads, max_size)
+                objects.extend(split_objects)
+                deleted.extend(split_deleted)
+
+        # NOTE(jd) Write the headers of legacy archives only once their
+        # points have been stored in their own objects, and the full
+        # resolution buffer last, as its presence marks a migrated metric.
+        if legacy:
+            headers = [
+                (aggregation,
+                 self._archive_header(archive).serialize(self.compression))
+                for (__, aggregation), archive in six.moves.zip(keys,
+                                                                archives)]
+        else:
+            headers = []
+        self._store_update(metric, objects, deleted,
+                           [headers, [(self.UNAGGREGATED, timeserie_data)]],
+                           versions)
+
+    def _store_update(self, metric, splits, deleted, objects, versions=None):
+        """Store an update of the archives of a metric.
+
+        :param splits: A list of (key, data) of the splits to write.
+        :param deleted: A list of the arguments of `_delete_split` for the
+                        splits to delete once the new ones are written.
+        :param objects: A list of lists of (key, data) to write after the
+                        splits, each list once the previous one is written.
+        :param versions: A dict of the versions of the objects read, or None.
+        """
+        self._store_objects(metric, splits, versions)
+        self._map_in_thread(self._delete_split, deleted)
+        for batch in objects:
+            self._store_objects(metric, batch, versions)
+
+    def queue_measures(self, metric, measures):
+        measures = _measures_to_series(measures)
+        if measures.empty:
+            return
+        self._store_measures(metric, carbonara.TimeSerie(
+            measures.index, measures.values).serialize(self.compression))
+
+    def list_metric_with_measures_to_process(self):
+        return self._list_metric_with_measures_to_process()
+
+    def process_measures(self, metric):
+        names = self._list_measures_to_process(metric)
+        if not names:
+            return
+        # NOTE(jd) The measures queued last win for a given timestamp
+        measures = _last_values(pandas.concat([
+            carbonara.TimeSerie.unserialize(data).ts
+            for data in self._map_in_thread(
+                self._get_unprocessed_measures,
+                [(metric, name) for name in names])]))
+        try:
+            self._add_series(metric, measures)
+        except storage.NoDeloreanAvailable as e:
+            # NOTE(jd) Nobody is waiting for an answer anymore, so only drop
+            # the measures that are too old rather than the whole batch.
+            LOG.warning("Dropping measures of metric %s: %s" % (metric, e))
+            self._add_series(
+                metric, measures[measures.index >= e.first_timestamp])
+        self._delete_unprocessed_measures(metric, names)
+
+    def delete_measures_to_process(self, metric):
+        self._delete_unprocessed_measures(
+            metric, self._list_measures_to_process(metric))
 
     def get_cross_metric_measures(self, metrics, from_timestamp=None,
                                   to_timestamp=None, aggregation='mean',
                                   needed_overlap=100.0):
-
-        tss = self._map_in_thread(self._get_measures_archive,
-                                  [(metric, aggregation)
-                                   for metric in metrics])
+        keys = [(metric, aggregation) for metric in metrics]
+        headers = self._map_in_thread(self._get_archive_header, keys)
+        if headers:
+            # Only retrieve the granularities that can be aggregated
+            granularities = [set(ts.sampling for ts in header.agg_timeseries)
+                             for header in headers]
+            granularities = granularities[0].intersection(*granularities[1:])
+            tss, __ = self._get_archives(
+                keys, lambda ts: ts.sampling in granularities, headers,
+                from_timestamp, to_timestamp)
+        else:
+            tss = headers
         try:
             return carbonara.TimeSerieArchive.aggregated(
                 tss, from_timestamp, to_timestamp, aggregation, needed_overlap)
         except carbonara.UnAggregableTimeseries as e:
             raise storage.MetricUnaggregatable(metrics, e.reason)
 
+    def add_measures_batch(self, metrics_and_measures):
+        self._map_in_thread(self.add_measures,
+                            list(six.iteritems(metrics_and_measures)))
+
     def _map_in_thread(self, method, list_of_args):
+        if getattr(self._in_executor, 'value', False):
+            # NOTE(jd) We are already running in the executor, e.g. adding
+            # measures of a batch: waiting for other tasks to be run by the
+            # executor could deadlock once all its workers do the same.
+            return [method(*args) for args in list_of_args]
+
+        def _call(args):
+            self._in_executor.value = True
+            try:
+                return method(*args)
+            finally:
+                self._in_executor.value = False
+
         # We use 'list' to iterate all threads here to raise the first
         # exception now , not much choice
-        return list(self.executor.map(lambda args: method(*args),
-                                      list_of_args))
+        return list(self.executor.map(_call, list_of_args))
@@ -20,6 +20,7 @@ import contextlib
 import ctypes
 import errno
 import time
+import uuid
 
 from oslo.config import cfg
 from oslo.utils import importutils
@@ -45,8 +46,20 @@ OPTS = [
                help='Ceph configuration file.'),
 ]
 
+# Constants of librados.h
+LIBRADOS_CREATE_EXCLUSIVE = 1
+LIBRADOS_CMPXATTR_OP_EQ = 1
+
 
 class CephStorage(_carbonara.CarbonaraBasedStorage):
+    VERSION_XATTR = "gnocchi.version"
+    # NOTE(jd) Listing the objects of a pool iterates over all of them, so
+    # the measures to process are kept in the omap of this object, indexed
+    # by name.
+    MEASURE_INDEX = "gnocchi_measure"
+    # Number of keys of an omap listed per request
+    OMAP_PAGE_SIZE = 1000
+
     def __init__(self, conf):
         super(CephStorage, self).__init__(conf)
         self.pool = conf.ceph_pool
@@ -62,6 +75,9 @@ class CephStorage(_carbonara.CarbonaraBasedStorage):
                                  rados_id=conf.ceph_username,
                                  conf=options)
         self.rados.connect()
+        # NOTE(jd) An ioctx is thread-safe, so use a single one for the
+        # whole life of the driver rather than opening one per request.
+        self.ioctx = self.rados.open_ioctx(self.pool)
 
     @contextlib.contextmanager
     def _lock(self, metric, lock_name):
@@ -73,33 +89,29 @@ class CephStorage(_carbonara.CarbonaraBasedStorage):
         # - ctx.lock_exclusive(name, 'lock', 'gnocchi')
         # - ctx.unlock(name, 'lock', 'gnocchi')
         name = self._get_object_name(metric, lock_name)
-        with self._get_ioctx() as ctx:
-            while True:
-                ret = rados.run_in_thread(
-                    ctx.librados.rados_lock_exclusive,
-                    (ctx.io, ctypes.c_char_p(name.encode('ascii')),
-                     ctypes.c_char_p(b"lock"),
-                     ctypes.c_char_p(b"gnocchi"),
-                     ctypes.c_char_p(b""), None, ctypes.c_int8(0)))
-                if ret in [errno.EBUSY, errno.EEXIST]:
-                    time.sleep(0.1)
-                elif ret < 0:
-                    rados.make_ex(ret, "Error while getting lock of %s" % name)
-                else:
-                    break
-            try:
-                yield
-            finally:
-                ret = rados.run_in_thread(
-                    ctx.librados.rados_unlock,
-                    (ctx.io, ctypes.c_char_p(name.encode('ascii')),
-                     ctypes.c_char_p(b"lock"), ctypes.c_char_p(b"gnocchi")))
-                if ret < 0:
-                    rados.make_ex(ret,
-                                  "Error while releasing lock of %s" % name)
-
-    def _get_ioctx(self):
-        return self.rados.open_ioctx(self.pool)
+        while True:
+            ret = rados.run_in_thread(
+                self.ioctx.librados.rados_lock_exclusive,
+                (self.ioctx.io, ctypes.c_char_p(name.encode('ascii')),
+                 ctypes.c_char_p(b"lock"),
+                 ctypes.c_char_p(b"gnocchi"),
+                 ctypes.c_char_p(b""), None, ctypes.c_int8(0)))
+            if ret in [errno.EBUSY, errno.EEXIST]:
+                time.sleep(0.1)
+            elif ret < 0:
+                rados.make_ex(ret, "Error while getting lock of %s" % name)
+            else:
+                break
+        try:
+            yield
+        finally:
+            ret = rados.run_in_thread(
+                self.ioctx.librados.rados_unlock,
+                (self.ioctx.io, ctypes.c_char_p(name.encode('ascii')),
+                 ctypes.c_char_p(b"lock"), ctypes.c_char_p(b"gnocchi")))
+            if ret < 0:
+                rados.make_ex(ret,
+                              "Error while releasing lock of %s" % name)
 
     @staticmethod
     def _get_object_name(metric, lock_name):
@@ -107,56 +119,283 @@ class CephStorage(_carbonara.CarbonaraBasedStorage):
 
     def _create_metric_container(self, metric):
         name = self._get_object_name(metric, 'container')
-        with self._get_ioctx() as ioctx:
-            not_yet_exist = False
-            try:
-                size, mtime = ioctx.stat(name)
-                # NOTE(sileht: the object have been created by
-                # the lock code
-                if size == 0:
-                    not_yet_exist = True
-            except rados.ObjectNotFound:
+        not_yet_exist = False
+        try:
+            size, mtime = self.ioctx.stat(name)
+            # NOTE(sileht: the object have been created by
+            # the lock code
+            if size == 0:
                 not_yet_exist = True
-            if not_yet_exist:
-                ioctx.write_full(name, "metric created")
-            else:
-                raise storage.MetricAlreadyExists(metric)
+        except rados.ObjectNotFound:
+            not_yet_exist = True
+        if not_yet_exist:
+            self.ioctx.write_full(name, "metric created")
+        else:
+            raise storage.MetricAlreadyExists(metric)
 
     def _store_metric_measures(self, metric, aggregation, data):
+        return self._write_metric_measures(metric, aggregation, data)
+
+    def _store_metric_measures_if_version(self, metric, aggregation, data,
+                                          version):
+        return self._write_metric_measures(metric, aggregation, data,
+                                           version)
+
+    def _write_metric_measures(self, metric, aggregation, data,
+                               version=None):
+        """Write an object and tag it with a new version atomically.
+
+        :param data: The content of the object, or None to only set a new
+                     version on the object, which must exist.
+        :param version: The version the object must have to be written,
+                        ABSENT if it must not exist, or None to write it
+                        unconditionally.
+        :return: The new version of the object.
+        """
+        # NOTE(jd) Like for locks, the python binding doesn't expose write
+        # operations, so build one with ctypes. The mtime of objects only
+        # has a one second resolution, so tag each write with a version to
+        # know when an object changed.
+        name = self._get_object_name(metric, aggregation).encode('ascii')
+        librados = self.ioctx.librados
+        librados.rados_create_write_op.restype = ctypes.c_void_p
+        op = ctypes.c_void_p(librados.rados_create_write_op())
+        try:
+            if version is _carbonara.ABSENT:
+                librados.rados_write_op_create(
+                    op, ctypes.c_int(LIBRADOS_CREATE_EXCLUSIVE), None)
+            elif version is not None:
+                librados.rados_write_op_cmpxattr(
+                    op, ctypes.c_char_p(self.VERSION_XATTR.encode('ascii')),
+                    ctypes.c_uint8(LIBRADOS_CMPXATTR_OP_EQ),
+                    ctypes.c_char_p(version), ctypes.c_size_t(len(version)))
+            if data is None:
+                librados.rados_write_op_assert_exists(op)
+            else:
+                librados.rados_write_op_write_full(
+                    op, ctypes.c_char_p(data), ctypes.c_size_t(len(data)))
+            new_version = uuid.uuid4().hex.encode('ascii')
+            librados.rados_write_op_setxattr(
+                op, ctypes.c_char_p(self.VERSION_XATTR.encode('ascii')),
+                ctypes.c_char_p(new_version),
+                ctypes.c_size_t(len(new_version)))
+            ret = rados.run_in_thread(
+                librados.rados_write_op_operate,
+                (op, self.ioctx.io, ctypes.c_char_p(name), None,
+                 ctypes.c_int(0)))
+        finally:
+            librados.rados_release_write_op(op)
+        if ret in (-errno.ECANCELED, -errno.EEXIST):
+            raise _carbonara.ConcurrentUpdate(metric, aggregation)
+        elif ret == -errno.ENOENT:
+            raise storage.MetricDoesNotExist(metric)
+        elif ret < 0:
+            raise rados.make_ex(ret, "Error while writing %s" % name)
+        return new_version
+
+    def _get_measures_version(self, metric, aggregation):
         name = self._get_object_name(metric, aggregation)
-        with self._get_ioctx() as ioctx:
-            ioctx.write_full(name, data)
+        try:
+            return self.ioctx.get_xattr(name, self.VERSION_XATTR)
+        except rados.ObjectNotFound:
+            raise storage.MetricDoesNotExist(metric)
+        except rados.NoData:
+            # NOTE(jd) Objects written before versions were tracked have
+            # none: give them one, so they can be written with
+            # compare-and-swap too. If the object is written in the meantime
+            # its version is overwritten, which only makes its writer retry.
+            return self._write_metric_measures(metric, aggregation, None)
+
+    def _delete_metric_measures(self, metric, aggregation):
+        name = self._get_object_name(metric, aggregation)
+        try:
+            self.ioctx.remove_object(name)
+        except rados.ObjectNotFound:
+            pass
+
+    def _build_measure_prefix(self, metric_name=""):
+        return "gnocchi_%s_%s" % (self.MEASURE_PREFIX, metric_name)
+
+    def _write_omap(self, name, keys, values=None):
+        """Set keys of the omap of an object, or remove them.
+
+        :param values: The values of the keys, or None to remove them.
+        """
+        # NOTE(jd) Like for locks, the python binding (0.80.X) doesn't expose
+        # omap operations, so build them with ctypes.
+        librados = self.ioctx.librados
+        librados.rados_create_write_op.restype = ctypes.c_void_p
+        op = ctypes.c_void_p(librados.rados_create_write_op())
+        try:
+            c_keys = (ctypes.c_char_p * len(keys))(
+                *[key.encode('ascii') for key in keys])
+            if values is None:
+                librados.rados_write_op_omap_rm_keys(
+                    op, c_keys, ctypes.c_size_t(len(keys)))
+            else:
+                librados.rados_write_op_omap_set(
+                    op, c_keys, (ctypes.c_char_p * len(values))(*values),
+                    (ctypes.c_size_t * len(values))(*map(len, values)),
+                    ctypes.c_size_t(len(keys)))
+            ret = rados.run_in_thread(
+                librados.rados_write_op_operate,
+                (op, self.ioctx.io, ctypes.c_char_p(name.encode('ascii')),
+                 None, ctypes.c_int(0)))
+        finally:
+            librados.rados_release_write_op(op)
+        if ret < 0:
+            raise rados.make_ex(ret, "Error while writing omap of %s" % name)
+
+    def _read_omap(self, name, keys=None, start_after=None):
+        """Read entries of the omap of an object.
+
+        :param keys: The keys to read the values of. If None, list the keys
+                     after `start_after`, OMAP_PAGE_SIZE at most, without
+                     their values.
+        :return: A list of (key, value), empty if the object does not exist.
+        """
+        librados = self.ioctx.librados
+        librados.rados_create_read_op.restype = ctypes.c_void_p
+        op = ctypes.c_void_p(librados.rados_create_read_op())
+        omap_iter = ctypes.c_void_p()
+        prval = ctypes.c_int()
+        try:
+            if keys is None:
+                librados.rados_read_op_omap_get_keys(
+                    op, ctypes.c_char_p(start_after.encode('ascii')),
+                    ctypes.c_uint64(self.OMAP_PAGE_SIZE),
+                    ctypes.byref(omap_iter), ctypes.byref(prval))
+            else:
+                librados.rados_read_op_omap_get_vals_by_keys(
+                    op, (ctypes.c_char_p * len(keys))(
+                        *[key.encode('ascii') for key in keys]),
+                    ctypes.c_size_t(len(keys)),
+                    ctypes.byref(omap_iter), ctypes.byref(prval))
+            ret = rados.run_in_thread(
+                librados.rados_read_op_operate,
+                (op, self.ioctx.io, ctypes.c_char_p(name.encode('ascii')),
+                 ctypes.c_int(0)))
+            if ret == -errno.ENOENT:
+                return []
+            if ret >= 0:
+                ret = prval.value
+            if ret < 0:
+                raise rados.make_ex(ret,
+                                    "Error while reading omap of %s" % name)
+            entries = []
+            key = ctypes.c_char_p()
+            value = ctypes.c_char_p()
+            length = ctypes.c_size_t()
+            while True:
+                ret = librados.rados_omap_get_next(
+                    omap_iter, ctypes.byref(key), ctypes.byref(value),
+                    ctypes.byref(length))
+                if ret < 0:
+                    raise rados.make_ex(
+                        ret, "Error while reading omap of %s" % name)
+                if key.value is None:
+                    return entries
+                entries.append((
+                    key.value.decode('ascii'),
+                    ctypes.string_at(value, length.value)
+                    if length.value else b""))
+        finally:
+            if omap_iter.value is not None:
+                librados.rados_omap_get_end(omap_iter)
+            librados.rados_release_read_op(op)
+
+    def _store_measures(self, metric, data):
+        # NOTE(jd) Store the measures in the index itself, so they are queued
+        # with a single atomic write and nothing is left behind on failure.
+        name = (self._build_measure_prefix(metric.name) + "_"
+                + self._new_measures_name())
+        self._write_omap(self.MEASURE_INDEX, [name], [data])
+
+    def _list_object_names(self, prefix):
+        names = []
+        # Keys are sorted, and all the ones starting with prefix come after it
+        start_after = prefix
+        while True:
+            keys = [key for key, __ in self._read_omap(
+                self.MEASURE_INDEX, start_after=start_after)]
+            for key in keys:
+                if not key.startswith(prefix):
+                    return names
+                names.append(key)
+            if len(keys) < self.OMAP_PAGE_SIZE:
+                return names
+            start_after = keys[-1]
+
+    def _list_metric_with_measures_to_process(self):
+        prefix = self._build_measure_prefix()
+        return set(name[len(prefix):].split("_", 1)[0]
+                   for name in self._list_object_names(prefix))
+
+    def _list_measures_to_process(self, metric):
+        return sorted(self._list_object_names(
+            self._build_measure_prefix(metric.name) + "_"))
+
+    def _get_unprocessed_measures(self, metric, name):
+        for __, data in self._read_omap(self.MEASURE_INDEX, [name]):
+            if data:
+                return data
+        # NOTE(jd) Measures queued before they were stored in the index have
+        # their own object.
+        return self._read_object(name)
+
+    def _delete_unprocessed_measures(self, metric, names):
+        if not names:
+            return
+        entries = self._read_omap(self.MEASURE_INDEX, names)
+        legacy = [name for name, data in entries if not data]
+        # NOTE(jd) Unindex the measures first: an object left behind only
+        # wastes space, while an index entry left behind would make
+        # processing the metric fail forever.
+        self._write_omap(self.MEASURE_INDEX, names)
+        for name in legacy:
+            try:
+                self.ioctx.remove_object(name)
+            except rados.ObjectNotFound:
+                pass
 
     def delete_metric(self, metric):
-        with self._get_ioctx() as ioctx:
-            name = self._get_object_name(metric, 'container')
+        self._delete_unprocessed_measures(
+            metric, self._list_measures_to_process(metric))
+        name = self._get_object_name(metric, 'container')
+        try:
+            self.ioctx.remove_object(name)
+        except rados.ObjectNotFound:
+            raise storage.MetricDoesNotExist(metric)
+        for key in self._object_keys(metric):
+            name = self._get_object_name(metric, key)
             try:
-                ioctx.remove_object(name)
+                self.ioctx.remove_object(name)
             except rados.ObjectNotFound:
-                raise storage.MetricDoesNotExist(metric)
-            for aggregation in metric.archive_policy.aggregation_methods:
-                name = self._get_object_name(metric, aggregation)
-                try:
-                    ioctx.remove_object(name)
-                except rados.ObjectNotFound:
-                    pass
+                pass
+
+    def _read_object(self, name):
+        size, mtime = self.ioctx.stat(name)
+        # NOTE(jd) Ask for one more byte than the object size: if we get
+        # it, the object has grown since the stat and we need to read the
+        # rest, otherwise the whole object has been read in one call.
+        chunks = [self.ioctx.read(name, length=size + 1)]
+        offset = len(chunks[0])
+        while offset > size:
+            data = self.ioctx.read(name, length=size + 1, offset=offset)
+            if not data:
+                break
+            chunks.append(data)
+            offset += len(data)
+        return b''.join(chunks)
 
     def _get_measures(self, metric, aggregation):
         try:
-            with self._get_ioctx() as ioctx:
-                name = self._get_object_name(metric, aggregation)
-                offset = 0
-                content = b''
-                while True:
-                    data = ioctx.read(name, offset=offset)
-                    if not data:
-                        break
-                    content += data
-                    offset += len(content)
-                if len(content) == 0:
-                    # NOTE(sileht: the object have been created by
-                    # the lock code
-                    raise storage.MetricDoesNotExist(metric)
-                return content
+            name = self._get_object_name(metric, aggregation)
+            content = self._read_object(name)
+            if len(content) == 0:
+                # NOTE(sileht: the object have been created by
+                # the lock code
+                raise storage.MetricDoesNotExist(metric)
+            return content
         except rados.ObjectNotFound:
             raise storage.MetricDoesNotExist(metric)
@@ -15,11 +15,17 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import ctypes
+import ctypes.util
 import errno
+import fcntl
 import os
 import shutil
+import tempfile
+import uuid
 
 from oslo.config import cfg
+from oslo_log import log
 
 from gnocchi import storage
 from gnocchi.storage import _carbonara
@@ -29,23 +35,128 @@ OPTS = [
     cfg.StrOpt('file_basepath',
                default='/var/lib/gnocchi',
                help='Path used to store gnocchi data files.'),
+    cfg.StrOpt('file_fsync',
+               default='batched',
+               choices=['always', 'batched', 'never'],
+               help='When to flush the files written to the disk: '
+                    '"always" flushes each file and its directory, '
+                    '"batched" flushes each file and the directory of a '
+                    'metric once per update of its archives, but not the '
+                    'directories of the measures queued, and "never" '
+                    'leaves it to the operating system.'),
 ]
 
+# Number of levels of directories sharding the metrics, each named after
+# two more characters of the metric name
+SHARD_DEPTH = 2
+
+LOG = log.getLogger(__name__)
+
+
+if hasattr(os, 'getxattr'):
+    _getxattr = os.getxattr
+    _setxattr = os.setxattr
+else:
+    # NOTE(jd) Python 2 does not expose extended attributes, so call the C
+    # library with ctypes.
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+    def _getxattr(path, attribute):
+        value = ctypes.create_string_buffer(256)
+        size = _libc.getxattr(ctypes.c_char_p(path.encode('utf-8')),
+                              ctypes.c_char_p(attribute.encode('ascii')),
+                              value, ctypes.c_size_t(len(value)))
+        if size < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        return value.raw[:size]
+
+    def _setxattr(path, attribute, value):
+        # Like os.setxattr, path is either a file name or a file descriptor
+        if isinstance(path, int):
+            setxattr, path = _libc.fsetxattr, ctypes.c_int(path)
+        else:
+            setxattr, path = (_libc.setxattr,
+                              ctypes.c_char_p(path.encode('utf-8')))
+        ret = setxattr(path, ctypes.c_char_p(attribute.encode('ascii')),
+                       ctypes.c_char_p(value), ctypes.c_size_t(len(value)),
+                       ctypes.c_int(0))
+        if ret < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
 
 class FileStorage(_carbonara.CarbonaraBasedStorage):
+    VERSION_XATTR = "user.gnocchi.version"
+
     def __init__(self, conf):
         super(FileStorage, self).__init__(conf)
         self.basepath = conf.file_basepath
+        self.basepath_tmp = os.path.join(self.basepath, 'tmp')
+        self.measure_path = os.path.join(self.basepath, self.MEASURE_PREFIX)
+        self.fsync = conf.file_fsync
         self._lock = _carbonara.CarbonaraBasedStorageToozLock(conf)
+        for path in (self.basepath_tmp, self.measure_path):
+            try:
+                os.mkdir(path, 0o750)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self.xattr = self._xattr_supported()
+        if not self.xattr:
+            LOG.warning("%s does not support extended attributes: versions "
+                        "of the files are based on their inode, mtime and "
+                        "size, and may be reused" % self.basepath)
+
+    def _xattr_supported(self):
+        with tempfile.NamedTemporaryFile(prefix='gnocchi',
+                                         dir=self.basepath_tmp) as f:
+            try:
+                _setxattr(f.fileno(), self.VERSION_XATTR, b"")
+            except OSError as e:
+                if e.errno in (errno.ENOTSUP, errno.EOPNOTSUPP):
+                    return False
+                raise
+        return True
+
+    def upgrade(self):
+        # NOTE(jd) Metrics used to be stored directly in the base path, so
+        # move them to their shard. Only move what is named after a metric:
+        # the base path also holds e.g. the measures, the temporary files or
+        # the locks of the coordinator.
+        for name in os.listdir(self.basepath):
+            try:
+                uuid.UUID(name)
+            except ValueError:
+                continue
+            if not os.path.isdir(os.path.join(self.basepath, name)):
+                continue
+            path = self._build_metric_path(storage.Metric(name, None))
+            try:
+                os.makedirs(os.path.dirname(path), 0o750)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            os.rename(os.path.join(self.basepath, name), path)
 
     def _build_metric_path(self, metric, aggregation=None):
-        path = os.path.join(self.basepath, metric.name)
+        # NOTE(jd) Shard the metrics in sub-directories, so directories do
+        # not hold millions of entries.
+        path = os.path.join(
+            self.basepath,
+            *[metric.name[i * 2:i * 2 + 2] for i in range(SHARD_DEPTH)]
+            + [metric.name])
         if aggregation:
             return os.path.join(path, aggregation)
         return path
 
     def _create_metric_container(self, metric):
         path = self._build_metric_path(metric)
+        try:
+            os.makedirs(os.path.dirname(path), 0o750)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
         try:
             os.mkdir(path, 0o750)
         except OSError as e:
@@ -53,12 +164,182 @@ class FileStorage(_carbonara.CarbonaraBasedStorage):
                 raise storage.MetricAlreadyExists(metric)
             raise
 
+    def _write_tmpfile(self, data):
+        """Write data in a temporary file, to be renamed in place.
+
+        :return: The name of the file, and the version it has once renamed.
+        """
+        tmpfile = tempfile.NamedTemporaryFile(
+            prefix='gnocchi', dir=self.basepath_tmp, delete=False)
+        with tmpfile:
+            tmpfile.write(data)
+            tmpfile.flush()
+            # NOTE(jd) An inode can be reused once its file is deleted, so
+            # tag each file with a version of its own. Renaming a file keeps
+            # its extended attributes, so it gets its version atomically.
+            if self.xattr:
+                version = uuid.uuid4().hex.encode('ascii')
+                _setxattr(tmpfile.fileno(), self.VERSION_XATTR, version)
+            if self.fsync != 'never':
+                os.fsync(tmpfile.fileno())
+            if not self.xattr:
+                version = self._version(os.fstat(tmpfile.fileno()))
+        return tmpfile.name, version
+
+    @staticmethod
+    def _version(stat):
+        return stat.st_ino, stat.st_mtime, stat.st_size
+
+    @staticmethod
+    def _fsync_dir(path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _rename(self, tmpfile, path):
+        os.rename(tmpfile, path)
+        if self.fsync == 'always':
+            self._fsync_dir(os.path.dirname(path))
+
     def _store_metric_measures(self, metric, aggregation, data):
+        # NOTE(jd) Never overwrite an object in place, so it is not left
+        # half written on crash.
+        tmpfile, version = self._write_tmpfile(data)
+        try:
+            self._rename(tmpfile,
+                         self._build_metric_path(metric, aggregation))
+        except OSError:
+            os.unlink(tmpfile)
+            raise
+        return version
+
+    def _store_metric_measures_if_version(self, metric, aggregation, data,
+                                          version):
+        tmpfile, new_version = self._write_tmpfile(data)
+        # NOTE(jd) The metric directory is only locked the time to check the
+        # version and rename the new object over the old one. The renaming
+        # also gives the new object another inode, and so another version.
+        try:
+            fd = os.open(self._build_metric_path(metric), os.O_RDONLY)
+        except OSError as e:
+            os.unlink(tmpfile)
+            if e.errno == errno.ENOENT:
+                raise storage.MetricDoesNotExist(metric)
+            raise
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                current = self._get_measures_version(metric, aggregation)
+            except storage.MetricDoesNotExist:
+                current = _carbonara.ABSENT
+            if current != version:
+                os.unlink(tmpfile)
+                raise _carbonara.ConcurrentUpdate(metric, aggregation)
+            self._rename(tmpfile,
+                         self._build_metric_path(metric, aggregation))
+        finally:
+            os.close(fd)
+        return new_version
+
+    def _store_update(self, metric, splits, deleted, objects, versions=None):
+        super(FileStorage, self)._store_update(metric, splits, deleted,
+                                               objects, versions)
+        if self.fsync == 'batched':
+            self._fsync_dir(self._build_metric_path(metric))
+
+    def _get_measures_version(self, metric, aggregation):
         path = self._build_metric_path(metric, aggregation)
-        with open(path, 'wb') as aggregation_file:
-            aggregation_file.write(data)
+        try:
+            if self.xattr:
+                return _getxattr(path, self.VERSION_XATTR)
+            return self._version(os.stat(path))
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                raise storage.MetricDoesNotExist(metric)
+            if e.errno != errno.ENODATA:
+                raise
+        # NOTE(jd) Files written before versions were tracked have none:
+        # give them one. If the file is replaced in the meantime its version
+        # is overwritten, which only makes its writer retry.
+        version = uuid.uuid4().hex.encode('ascii')
+        try:
+            _setxattr(path, self.VERSION_XATTR, version)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                raise storage.MetricDoesNotExist(metric)
+            raise
+        return version
+
+    def _delete_metric_measures(self, metric, aggregation):
+        try:
+            os.unlink(self._build_metric_path(metric, aggregation))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _build_measure_path(self, metric, name=None):
+        path = os.path.join(self.measure_path, metric.name)
+        if name:
+            return os.path.join(path, name)
+        return path
+
+    def _store_measures(self, metric, data):
+        # NOTE(jd) Write in a temporary file and rename it, so the measures
+        # are never processed while being written.
+        tmpfile, __ = self._write_tmpfile(data)
+        path = self._build_measure_path(metric, self._new_measures_name())
+        while True:
+            try:
+                os.rename(tmpfile, path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # The directory does not exist yet, or has just been removed
+                # after processing the previous measures
+                try:
+                    os.mkdir(self._build_measure_path(metric), 0o750)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            else:
+                break
+        if self.fsync == 'always':
+            try:
+                self._fsync_dir(self._build_measure_path(metric))
+            except OSError as e:
+                # The measures may have been processed already
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def _list_metric_with_measures_to_process(self):
+        return set(os.listdir(self.measure_path))
+
+    def _list_measures_to_process(self, metric):
+        try:
+            return sorted(os.listdir(self._build_measure_path(metric)))
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return []
+            raise
+
+    def _get_unprocessed_measures(self, metric, name):
+        with open(self._build_measure_path(metric, name), 'rb') as f:
+            return f.read()
+
+    def _delete_unprocessed_measures(self, metric, names):
+        for name in names:
+            os.unlink(self._build_measure_path(metric, name))
+        try:
+            os.rmdir(self._build_measure_path(metric))
+        except OSError as e:
+            # Some measures may have been queued in the meantime
+            if e.errno not in (errno.ENOENT, errno.ENOTEMPTY):
+                raise
 
     def delete_metric(self, metric):
+        shutil.rmtree(self._build_measure_path(metric), ignore_errors=True)
         path = self._build_metric_path(metric)
         try:
             shutil.rmtree(path)
@@ -0,0 +1,262 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2015 eNovance
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import contextlib
+import sqlite3
+import threading
+import uuid
+
+from oslo.config import cfg
+from oslo_log import log
+
+from gnocchi import storage
+from gnocchi.storage import _carbonara
+
+
+OPTS = [
+    cfg.StrOpt('sqlite_path',
+               default='/var/lib/gnocchi/gnocchi.sqlite',
+               help='Path of the SQLite database storing the measures.'),
+    cfg.IntOpt('sqlite_timeout',
+               default=30,
+               help='Number of seconds to wait for the database to be '
+                    'unlocked by another writer.'),
+    cfg.StrOpt('sqlite_synchronous',
+               default='normal',
+               choices=['off', 'normal', 'full'],
+               help='When to flush the database to the disk: "full" flushes '
+                    'each transaction, "normal" only flushes the write-ahead '
+                    'log when it is copied to the database, so the last '
+                    'transactions may be lost on power failure, and "off" '
+                    'leaves it to the operating system.'),
+]
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS metric ("
+    "name TEXT PRIMARY KEY)",
+    "CREATE TABLE IF NOT EXISTS object ("
+    "metric TEXT NOT NULL, name TEXT NOT NULL, version TEXT NOT NULL, "
+    "data BLOB NOT NULL, PRIMARY KEY (metric, name))",
+    "CREATE TABLE IF NOT EXISTS measure ("
+    "metric TEXT NOT NULL, name TEXT NOT NULL, data BLOB NOT NULL, "
+    "PRIMARY KEY (metric, name))",
+]
+
+
+LOG = log.getLogger(__name__)
+
+
+class SQLiteStorage(_carbonara.CarbonaraBasedStorage):
+    def __init__(self, conf):
+        super(SQLiteStorage, self).__init__(conf)
+        self.path = conf.sqlite_path
+        self.timeout = conf.sqlite_timeout
+        self.synchronous = conf.sqlite_synchronous
+        # NOTE(jd) Objects are only updated if their version did not change,
+        # so there is no need to lock the metrics.
+        if not self.optimistic_concurrency:
+            LOG.warning("The SQLite driver only supports optimistic "
+                        "concurrency, metrics are not locked")
+            self.optimistic_concurrency = True
+        self._connections = threading.local()
+        # All the connections opened, to close them once stopped
+        self._all_connections = []
+        self._all_connections_lock = threading.Lock()
+        with self._transaction() as conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+
+    def _connection(self):
+        """Return the connection of the current thread."""
+        conn = getattr(self._connections, 'value', None)
+        if conn is None:
+            # NOTE(jd) Each connection is only used by the thread that opened
+            # it, but is closed by the one stopping the driver.
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+            # NOTE(jd) With the write-ahead log, readers do not block
+            # writers, and writers do not block readers.
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=%s" % self.synchronous.upper())
+            self._connections.value = conn
+            with self._all_connections_lock:
+                self._all_connections.append(conn)
+        return conn
+
+    def stop(self):
+        super(SQLiteStorage, self).stop()
+        with self._all_connections_lock:
+            for conn in self._all_connections:
+                conn.close()
+            self._all_connections = []
+            self._connections = threading.local()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _create_metric_container(self, metric):
+        try:
+            self._connection().execute(
+                "INSERT INTO metric (name) VALUES (?)", (metric.name,))
+        except sqlite3.IntegrityError:
+            raise storage.MetricAlreadyExists(metric)
+
+    @staticmethod
+    def _write_object(conn, metric, key, data, version=None):
+        """Write an object and return its new version.
+
+        :param version: The version the object must have, ABSENT if it must
+                        not exist, or None to overwrite it whatsoever.
+        """
+        new_version = uuid.uuid4().hex
+        data = sqlite3.Binary(data)
+        if version is None:
+            conn.execute(
+                "INSERT OR REPLACE INTO object (metric, name, version, data) "
+                "VALUES (?, ?, ?, ?)", (metric.name, key, new_version, data))
+        elif version is _carbonara.ABSENT:
+            try:
+                conn.execute(
+                    "INSERT INTO object (metric, name, version, data) "
+                    "VALUES (?, ?, ?, ?)",
+                    (metric.name, key, new_version, data))
+            except sqlite3.IntegrityError:
+                raise _carbonara.ConcurrentUpdate(metric, key)
+        elif conn.execute(
+                "UPDATE object SET version = ?, data = ? "
+                "WHERE metric = ? AND name = ? AND version = ?",
+                (new_version, data, metric.name, key, version)
+        ).rowcount != 1:
+            raise _carbonara.ConcurrentUpdate(metric, key)
+        return new_version
+
+    def _store_metric_measures(self, metric, aggregation, data):
+        return self._write_object(self._connection(), metric, aggregation,
+                                  data)
+
+    def _store_metric_measures_if_version(self, metric, aggregation, data,
+                                          version):
+        return self._write_object(self._connection(), metric, aggregation,
+                                  data, version)
+
+    def _write_objects(self, conn, metric, objects, versions=None):
+        """Write objects in a transaction.
+
+        :return: A list of (key, new version, data), to cache once the
+                 transaction is committed.
+        """
+        written = []
+        for key, data in objects:
+            version = None
+            if versions is not None:
+                version = versions.get(key, _carbonara.ABSENT)
+            written.append((key, self._write_object(
+                conn, metric, key, data, version), data))
+        return written
+
+    def _cache_objects(self, metric, written):
+        if self.cache is not None:
+            for key, version, data in written:
+                self._cache_object(metric, key, version, data)
+
+    def _store_objects(self, metric, objects, versions=None):
+        # NOTE(jd) Write all the objects in a single transaction, so they
+        # are either stored as a whole or not at all.
+        with self._transaction() as conn:
+            written = self._write_objects(conn, metric, objects, versions)
+        self._cache_objects(metric, written)
+
+    def _store_update(self, metric, splits, deleted, objects, versions=None):
+        # NOTE(jd) Write and delete all the objects of an update in a single
+        # transaction, so it is either stored as a whole or not at all.
+        with self._transaction() as conn:
+            written = self._write_objects(conn, metric, splits, versions)
+            conn.executemany(
+                "DELETE FROM object WHERE metric = ? AND name = ?",
+                [(metric.name, self._split_key(aggregation, granularity, key))
+                 for __, aggregation, granularity, key in deleted])
+            for batch in objects:
+                written.extend(
+                    self._write_objects(conn, metric, batch, versions))
+        if self.cache is not None:
+            with self.cache_lock:
+                for __, aggregation, granularity, key in deleted:
+                    self.cache.pop((metric.name, self._split_key(
+                        aggregation, granularity, key)), None)
+        self._cache_objects(metric, written)
+
+    def _get_measures_version(self, metric, aggregation):
+        row = self._connection().execute(
+            "SELECT version FROM object WHERE metric = ? AND name = ?",
+            (metric.name, aggregation)).fetchone()
+        if row is None:
+            raise storage.MetricDoesNotExist(metric)
+        return row[0]
+
+    def _get_measures(self, metric, aggregation):
+        row = self._connection().execute(
+            "SELECT data FROM object WHERE metric = ? AND name = ?",
+            (metric.name, aggregation)).fetchone()
+        if row is None:
+            raise storage.MetricDoesNotExist(metric)
+        return bytes(row[0])
+
+    def _delete_metric_measures(self, metric, aggregation):
+        self._connection().execute(
+            "DELETE FROM object WHERE metric = ? AND name = ?",
+            (metric.name, aggregation))
+
+    def _store_measures(self, metric, data):
+        self._connection().execute(
+            "INSERT INTO measure (metric, name, data) VALUES (?, ?, ?)",
+            (metric.name, self._new_measures_name(), sqlite3.Binary(data)))
+
+    def _list_metric_with_measures_to_process(self):
+        return set(row[0] for row in self._connection().execute(
+            "SELECT DISTINCT metric FROM measure"))
+
+    def _list_measures_to_process(self, metric):
+        return [row[0] for row in self._connection().execute(
+            "SELECT name FROM measure WHERE metric = ? ORDER BY name",
+            (metric.name,))]
+
+    def _get_unprocessed_measures(self, metric, name):
+        return bytes(self._connection().execute(
+            "SELECT data FROM measure WHERE metric = ? AND name = ?",
+            (metric.name, name)).fetchone()[0])
+
+    def _delete_unprocessed_measures(self, metric, names):
+        with self._transaction() as conn:
+            conn.executemany(
+                "DELETE FROM measure WHERE metric = ? AND name = ?",
+                [(metric.name, name) for name in names])
+
+    def delete_metric(self, metric):
+        with self._transaction() as conn:
+            if conn.execute("DELETE FROM metric WHERE name = ?",
+                            (metric.name,)).rowcount != 1:
+                raise storage.MetricDoesNotExist(metric)
+            for table in ("object", "measure"):
+                conn.execute("DELETE FROM %s WHERE metric = ?" % table,
+                             (metric.name,))
@@ -15,7 +15,11 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import contextlib
+
 from oslo.config import cfg
+from oslo_log import log
+import six
 from swiftclient import client as swclient
 
 from gnocchi import storage
@@ -45,11 +49,47 @@ OPTS = [
                help='Swift tenant name, only used in v2 auth.'),
 ]
 
+LOG = log.getLogger(__name__)
+
+
+class SwiftConnectionPool(object):
+    def __init__(self, size, **kwargs):
+        """A pool of Swift connections.
+
+        A swiftclient Connection is not thread-safe, so each call checks out
+        a connection of the pool for its own use. Connections keep their
+        HTTP connection alive between calls, and re-authenticate by
+        themselves when their token expires.
+
+        :param size: The number of connections.
+        :param kwargs: The arguments to create the connections with.
+        """
+        self.connections = six.moves.queue.Queue()
+        for i in six.moves.range(size):
+            self.connections.put(swclient.Connection(**kwargs))
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.connections.get()
+        try:
+            yield conn
+        finally:
+            self.connections.put(conn)
+
+    def __getattr__(self, name):
+        def _call(*args, **kwargs):
+            with self.connection() as conn:
+                return getattr(conn, name)(*args, **kwargs)
+        return _call
+
 
 class SwiftStorage(_carbonara.CarbonaraBasedStorage):
     def __init__(self, conf):
         super(SwiftStorage, self).__init__(conf)
-        self.swift = swclient.Connection(
+        # NOTE(jd) One connection per worker, so all the requests done in
+        # parallel by the executor have their own connection.
+        self.swift = SwiftConnectionPool(
+            self.aggregation_workers_number,
             auth_version=conf.swift_auth_version,
             authurl=conf.swift_authurl,
             preauthtoken=conf.swift_preauthtoken,
@@ -57,6 +97,11 @@ class SwiftStorage(_carbonara.CarbonaraBasedStorage):
             key=conf.swift_key,
             tenant_name=conf.swift_tenant_name)
         self._lock = _carbonara.CarbonaraBasedStorageToozLock(conf)
+        self.swift.put_container(self.MEASURE_PREFIX)
+        if self.optimistic_concurrency:
+            LOG.warning("Optimistic concurrency is not supported by the "
+                        "Swift driver, metrics are locked instead")
+            self.optimistic_concurrency = False
 
     def _create_metric_container(self, metric):
         # TODO(jd) A container per user in their account?
@@ -68,13 +113,62 @@ class SwiftStorage(_carbonara.CarbonaraBasedStorage):
             raise storage.MetricAlreadyExists(metric)
 
     def _store_metric_measures(self, metric, aggregation, data):
-        self.swift.put_object(metric.name, aggregation, data)
+        # NOTE(jd) The ETag of the response is the one of the object written
+        return self.swift.put_object(metric.name, aggregation, data)
+
+    def _get_measures_version(self, metric, aggregation):
+        try:
+            headers = self.swift.head_object(metric.name, aggregation)
+        except swclient.ClientException as e:
+            if e.http_status == 404:
+                raise storage.MetricDoesNotExist(metric)
+            raise
+        return headers.get('etag')
+
+    def _delete_metric_measures(self, metric, aggregation):
+        try:
+            self.swift.delete_object(metric.name, aggregation)
+        except swclient.ClientException as e:
+            if e.http_status != 404:
+                raise
+
+    def _store_measures(self, metric, data):
+        self.swift.put_object(
+            self.MEASURE_PREFIX,
+            metric.name + "/" + self._new_measures_name(),
+            data)
+
+    def _list_metric_with_measures_to_process(self):
+        headers, files = self.swift.get_container(self.MEASURE_PREFIX,
+                                                  delimiter='/',
+                                                  full_listing=True)
+        return set(f['subdir'][:-1] for f in files if 'subdir' in f)
+
+    def _list_measures_to_process(self, metric):
+        headers, files = self.swift.get_container(self.MEASURE_PREFIX,
+                                                  prefix=metric.name + "/",
+                                                  full_listing=True)
+        return sorted(f['name'] for f in files)
+
+    def _get_unprocessed_measures(self, metric, name):
+        headers, contents = self.swift.get_object(self.MEASURE_PREFIX, name)
+        return contents
+
+    def _delete_unprocessed_measures(self, metric, names):
+        for name in names:
+            try:
+                self.swift.delete_object(self.MEASURE_PREFIX, name)
+            except swclient.ClientException as e:
+                if e.http_status != 404:
+                    raise
 
     def delete_metric(self, metric):
+        self._delete_unprocessed_measures(
+            metric, self._list_measures_to_process(metric))
         try:
-            for aggregation in metric.archive_policy.aggregation_methods:
+            for key in self._object_keys(metric):
                 try:
-                    self.swift.delete_object(metric.name, aggregation)
+                    self.swift.delete_object(metric.name, key)
                 except swclient.ClientException as e:
                     if e.http_status != 404:
                         raise
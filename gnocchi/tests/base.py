@@ -13,7 +13,11 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import ctypes
+import errno
 import functools
+import hashlib
+import itertools
 import os
 import uuid
 
@@ -58,11 +62,34 @@ class FakeRadosModule(object):
     class ObjectNotFound(Exception):
         pass
 
+    class NoData(Exception):
+        pass
+
+    class Function(object):
+        """A C function of librados, whose return type can be set."""
+
+        def __init__(self, func):
+            self.func = func
+            self.restype = None
+
+        def __call__(self, *args):
+            return self.func(*args)
+
     class ioctx(object):
-        def __init__(self, kvs):
+        def __init__(self, kvs, xattrs, omaps):
             self.kvs = kvs
+            self.xattrs = xattrs
+            self.omaps = omaps
             self.librados = self
             self.io = self
+            self.write_ops = {}
+            self.write_op_ids = itertools.count(1)
+            self.rados_create_write_op = FakeRadosModule.Function(
+                self._create_write_op)
+            self.read_ops = {}
+            self.rados_create_read_op = FakeRadosModule.Function(
+                self._create_read_op)
+            self.omap_iters = {}
 
         def __enter__(self):
             return self
@@ -88,6 +115,124 @@ class FakeRadosModule(object):
                 self.kvs[key] = ""
             return 0
 
+        def _create_write_op(self):
+            op = next(self.write_op_ids)
+            self.write_ops[op] = []
+            return op
+
+        def rados_release_write_op(self, op):
+            del self.write_ops[op.value]
+
+        def rados_write_op_create(self, op, exclusive, category):
+            self.write_ops[op.value].append(('create', None, None))
+
+        def rados_write_op_cmpxattr(self, op, name, comparison_operator,
+                                    value, value_len):
+            self.write_ops[op.value].append(
+                ('cmpxattr', name.value.decode('ascii'), value.value))
+
+        def rados_write_op_assert_exists(self, op):
+            self.write_ops[op.value].append(('assert_exists', None, None))
+
+        def rados_write_op_write_full(self, op, data, data_len):
+            self.write_ops[op.value].append(
+                ('write_full', None, ctypes.string_at(data, data_len.value)))
+
+        def rados_write_op_setxattr(self, op, name, value, value_len):
+            self.write_ops[op.value].append(
+                ('setxattr', name.value.decode('ascii'), value.value))
+
+        @staticmethod
+        def _strings(array, lengths=None):
+            # Read the strings of a C array, which may hold null bytes
+            pointers = ctypes.cast(array, ctypes.POINTER(ctypes.c_void_p))
+            if lengths is None:
+                return [array[i] for i in range(len(array))]
+            return [ctypes.string_at(pointers[i], lengths[i])
+                    for i in range(len(array))]
+
+        def rados_write_op_omap_set(self, op, keys, values, lengths, count):
+            self.write_ops[op.value].append(
+                ('omap_set', None, dict(zip(
+                    [key.decode('ascii') for key in self._strings(keys)],
+                    self._strings(values, lengths)))))
+
+        def rados_write_op_omap_rm_keys(self, op, keys, count):
+            self.write_ops[op.value].append(
+                ('omap_rm_keys', None,
+                 [key.decode('ascii') for key in self._strings(keys)]))
+
+        def rados_write_op_operate(self, op, io, oid, mtime, flags):
+            key = oid.value.decode('ascii')
+            for action, name, value in self.write_ops[op.value]:
+                if action == 'create' and key in self.kvs:
+                    return -errno.EEXIST
+                if action in ('assert_exists', 'omap_rm_keys') and (
+                        key not in self.kvs):
+                    return -errno.ENOENT
+                if action == 'cmpxattr' and (
+                        self.xattrs.get(key, {}).get(name) != value):
+                    return -errno.ECANCELED
+            for action, name, value in self.write_ops[op.value]:
+                if action == 'write_full':
+                    self.kvs[key] = value
+                elif action == 'setxattr':
+                    self.xattrs.setdefault(key, {})[name] = value
+                elif action == 'omap_set':
+                    self.kvs.setdefault(key, b"")
+                    self.omaps.setdefault(key, {}).update(value)
+                elif action == 'omap_rm_keys':
+                    for omap_key in value:
+                        self.omaps.get(key, {}).pop(omap_key, None)
+            return 0
+
+        def _create_read_op(self):
+            op = next(self.write_op_ids)
+            self.read_ops[op] = []
+            return op
+
+        def rados_release_read_op(self, op):
+            del self.read_ops[op.value]
+
+        def _read_omap(self, op, omap_iter, select):
+            omap_iter._obj.value = next(self.write_op_ids)
+            self.read_ops[op.value].append((omap_iter._obj.value, select))
+
+        def rados_read_op_omap_get_keys(self, op, start_after, max_return,
+                                        omap_iter, prval):
+            self._read_omap(op, omap_iter, lambda omap: [
+                (key, None) for key in sorted(omap)
+                if key > start_after.value.decode('ascii')
+            ][:max_return.value])
+
+        def rados_read_op_omap_get_vals_by_keys(self, op, keys, count,
+                                                omap_iter, prval):
+            keys = [key.decode('ascii') for key in self._strings(keys)]
+            self._read_omap(op, omap_iter, lambda omap: sorted(
+                (key, omap[key]) for key in keys if key in omap))
+
+        def rados_read_op_operate(self, op, io, oid, flags):
+            key = oid.value.decode('ascii')
+            if key not in self.kvs:
+                return -errno.ENOENT
+            for omap_iter, select in self.read_ops[op.value]:
+                self.omap_iters[omap_iter] = iter(
+                    select(self.omaps.get(key, {})))
+            return 0
+
+        def rados_omap_get_next(self, omap_iter, key, value, length):
+            try:
+                k, v = next(self.omap_iters[omap_iter.value])
+            except StopIteration:
+                k = v = None
+            key._obj.value = None if k is None else k.encode('ascii')
+            value._obj.value = v
+            length._obj.value = 0 if v is None else len(v)
+            return 0
+
+        def rados_omap_get_end(self, omap_iter):
+            self.omap_iters.pop(omap_iter.value, None)
+
         @staticmethod
         def close():
             pass
@@ -99,7 +244,7 @@ class FakeRadosModule(object):
             if key not in self.kvs:
                 raise FakeRadosModule.ObjectNotFound
             else:
-                return (1024, "timestamp")
+                return (len(self.kvs[key]), "timestamp")
 
         def read(self, key, length=8192, offset=0):
             if key not in self.kvs:
@@ -111,10 +256,27 @@ class FakeRadosModule(object):
             if key not in self.kvs:
                 raise FakeRadosModule.ObjectNotFound
             del self.kvs[key]
+            self.xattrs.pop(key, None)
+            self.omaps.pop(key, None)
+
+        def set_xattr(self, key, name, value):
+            if key not in self.kvs:
+                raise FakeRadosModule.ObjectNotFound
+            self.xattrs.setdefault(key, {})[name] = value
+
+        def get_xattr(self, key, name):
+            if key not in self.kvs:
+                raise FakeRadosModule.ObjectNotFound
+            try:
+                return self.xattrs[key][name]
+            except KeyError:
+                raise FakeRadosModule.NoData
 
     class FakeRados(object):
-        def __init__(self, kvs):
+        def __init__(self, kvs, xattrs, omaps):
             self.kvs = kvs
+            self.xattrs = xattrs
+            self.omaps = omaps
 
         @staticmethod
         def connect():
@@ -125,13 +287,15 @@ class FakeRadosModule(object):
             pass
 
         def open_ioctx(self, pool):
-            return FakeRadosModule.ioctx(self.kvs)
+            return FakeRadosModule.ioctx(self.kvs, self.xattrs, self.omaps)
 
     def __init__(self):
         self.kvs = {}
+        self.xattrs = {}
+        self.omaps = {}
 
     def Rados(self, *args, **kwargs):
-        return FakeRadosModule.FakeRados(self.kvs)
+        return FakeRadosModule.FakeRados(self.kvs, self.xattrs, self.omaps)
 
     @staticmethod
     def run_in_thread(method, args):
@@ -144,7 +308,8 @@ class FakeRadosModule(object):
 
 class FakeSwiftClient(object):
     def __init__(self, *args, **kwargs):
-        self.kvs = {}
+        # Connections of a pool share the same objects
+        self.kvs = kwargs.pop('kvs', {})
 
     def put_container(self, container, response_dict=None):
         if response_dict is not None:
@@ -152,7 +317,7 @@ class FakeSwiftClient(object):
                 response_dict['status'] = 204
             else:
                 response_dict['status'] = 201
-        self.kvs[container] = {}
+        self.kvs.setdefault(container, {})
 
     def put_object(self, container, key, obj):
         if hasattr(obj, "seek"):
@@ -160,6 +325,7 @@ class FakeSwiftClient(object):
             obj = obj.read()
             # TODO(jd) Maybe we should reset the seek(), but well…
         self.kvs[container][key] = obj
+        return hashlib.md5(obj).hexdigest()
 
     def get_object(self, container, key):
         try:
@@ -168,6 +334,35 @@ class FakeSwiftClient(object):
             raise swexc.ClientException("No such container/object",
                                         http_status=404)
 
+    def head_object(self, container, key):
+        try:
+            return {'etag': hashlib.md5(self.kvs[container][key]).hexdigest()}
+        except KeyError:
+            raise swexc.ClientException("No such container/object",
+                                        http_status=404)
+
+    def get_container(self, container, delimiter=None, prefix=None,
+                      full_listing=False):
+        if container not in self.kvs:
+            raise swexc.ClientException("No such container",
+                                        http_status=404)
+        files = []
+        directories = set()
+        for k, v in sorted(six.iteritems(self.kvs[container])):
+            if prefix:
+                if not k.startswith(prefix):
+                    continue
+                k_without_prefix = k[len(prefix):]
+            else:
+                k_without_prefix = k
+            if delimiter and delimiter in k_without_prefix:
+                directories.add(
+                    (prefix or "")
+                    + k_without_prefix.split(delimiter)[0] + delimiter)
+            else:
+                files.append({'name': k, 'bytes': len(v)})
+        return {}, files + [{'subdir': d} for d in sorted(directories)]
+
     def delete_object(self, container, obj):
         try:
             del self.kvs[container][obj]
@@ -252,6 +447,7 @@ class TestCase(base.BaseTestCase, testscenarios.TestWithScenarios):
         ('swift', dict(storage_engine='swift')),
         ('file', dict(storage_engine='file')),
         ('ceph', dict(storage_engine='ceph')),
+        ('sqlite', dict(storage_engine='sqlite')),
     ]
 
     @staticmethod
@@ -307,7 +503,7 @@ class TestCase(base.BaseTestCase, testscenarios.TestWithScenarios):
 
         self.useFixture(mockpatch.Patch(
             'swiftclient.client.Connection',
-            FakeSwiftClient))
+            functools.partial(FakeSwiftClient, kvs={})))
 
         self.useFixture(mockpatch.Patch('gnocchi.storage.ceph.rados',
                                         FakeRadosModule()))
@@ -317,6 +513,12 @@ class TestCase(base.BaseTestCase, testscenarios.TestWithScenarios):
             self.conf.set_override('file_basepath',
                                    tempdir.path,
                                    'storage')
+        elif self.storage_engine == 'sqlite':
+            tempdir = self.useFixture(fixtures.TempDir())
+            self.conf.set_override('sqlite_path',
+                                   os.path.join(tempdir.path,
+                                                'gnocchi.sqlite'),
+                                   'storage')
 
         self.conf.set_override('driver', self.storage_engine, 'storage')
         self.storage = storage.get_driver(self.conf)
@@ -326,5 +528,6 @@ class TestCase(base.BaseTestCase, testscenarios.TestWithScenarios):
         self.custom_agg = dict((x.name, x.obj) for x in self.mgr)
 
     def tearDown(self):
+        self.storage.stop()
         self.index.disconnect()
         super(TestCase, self).tearDown()
@@ -16,11 +16,15 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 import datetime
+import math
 import os
+import pickle
 import subprocess
 import tempfile
 
 import fixtures
+import msgpack
+import numpy
 from oslotest import base
 # TODO(jd) We shouldn't use pandas here
 import pandas
@@ -111,6 +115,36 @@ class TestAggregatedTimeSerie(base.BaseTestCase):
                            (datetime.datetime(2014, 1, 1, 12, 0, 4), 5),
                            (datetime.datetime(2014, 1, 1, 12, 0, 9), 6)])
 
+    def test_resample(self):
+        ts = carbonara.AggregatedTimeSerie(sampling='1Min',
+                                           aggregation_method='max')
+        ts.set_values(
+            [(datetime.datetime(2014, 1, 1, 12, 0, 0), 3),
+             (datetime.datetime(2014, 1, 1, 12, 1, 4), 5),
+             (datetime.datetime(2014, 1, 1, 12, 5, 9), 6)])
+        resampled = ts.resample(300)
+        self.assertEqual(2, len(resampled))
+        self.assertEqual(300, resampled.sampling.nanos / 10e8)
+        self.assertEqual(
+            5, resampled[datetime.datetime(2014, 1, 1, 12, 0, 0)])
+        self.assertEqual(
+            6, resampled[datetime.datetime(2014, 1, 1, 12, 5, 0)])
+
+    def test_resample_count(self):
+        ts = carbonara.AggregatedTimeSerie(sampling='1Min',
+                                           aggregation_method='count')
+        ts.set_values(
+            [(datetime.datetime(2014, 1, 1, 12, 0, 0), 3),
+             (datetime.datetime(2014, 1, 1, 12, 0, 4), 5),
+             (datetime.datetime(2014, 1, 1, 12, 1, 9), 6)])
+        resampled = ts.resample(300)
+        self.assertEqual(
+            3, resampled[datetime.datetime(2014, 1, 1, 12, 0, 0)])
+
+    def test_resample_mean(self):
+        ts = carbonara.AggregatedTimeSerie(sampling='1Min')
+        self.assertRaises(ValueError, ts.resample, 300)
+
     def test_74_percentile(self):
         ts = carbonara.AggregatedTimeSerie(sampling='1Min',
                                            aggregation_method='74pct')
@@ -134,6 +168,61 @@ class TestAggregatedTimeSerie(base.BaseTestCase):
         self.assertEqual(5.9000000000000004,
                          ts[datetime.datetime(2014, 1, 1, 12, 0, 0)])
 
+    def test_grouped_percentiles(self):
+        keys, values = carbonara.AggregatedTimeSerie._grouped_percentiles(
+            numpy.array([1, 1, 1, 2, 2, 3]),
+            numpy.array([6., 3., 5., 10., 2., 7.]),
+            [50, 74, 95])
+        self.assertEqual([1, 2, 3], list(keys))
+        for i, group in enumerate(([6., 3., 5.], [10., 2.], [7.])):
+            for j, q in enumerate([50, 74, 95]):
+                self.assertAlmostEqual(numpy.percentile(group, q),
+                                       values[i][j])
+
+    def test_update_all_percentiles(self):
+        raw = carbonara.BoundTimeSerie(
+            [datetime.datetime(2014, 1, 1, 12, 0, 0),
+             datetime.datetime(2014, 1, 1, 12, 0, 4),
+             datetime.datetime(2014, 1, 1, 12, 0, 9),
+             datetime.datetime(2014, 1, 1, 12, 1, 1)],
+            [3, 5, 6, 1])
+        tss = [carbonara.AggregatedTimeSerie(sampling='1Min',
+                                             aggregation_method=method)
+               for method in ('74pct', '95pct', 'max')]
+        carbonara.AggregatedTimeSerie.update_all(tss, raw)
+        self.assertAlmostEqual(
+            5.48, tss[0][datetime.datetime(2014, 1, 1, 12, 0, 0)])
+        self.assertAlmostEqual(
+            5.9, tss[1][datetime.datetime(2014, 1, 1, 12, 0, 0)])
+        self.assertEqual(6, tss[2][datetime.datetime(2014, 1, 1, 12, 0, 0)])
+        for ts in tss:
+            self.assertEqual(2, len(ts))
+            self.assertEqual(1, ts[datetime.datetime(2014, 1, 1, 12, 1, 0)])
+
+    def test_split(self):
+        sampling = 5
+        points = 100000
+        ts = carbonara.AggregatedTimeSerie(
+            timestamps=[datetime.datetime.utcfromtimestamp(t)
+                        for t in six.moves.range(0, points * sampling,
+                                                 sampling)],
+            values=list(six.moves.range(points)),
+            sampling=sampling)
+
+        splits = list(ts.split())
+        self.assertEqual(
+            math.ceil(float(points) / ts.POINTS_PER_SPLIT),
+            len(splits))
+        for key, split in splits:
+            self.assertEqual(
+                key,
+                carbonara.AggregatedTimeSerie.get_split_key(
+                    split.ts.index[0], ts.sampling))
+            self.assertLessEqual(len(split), ts.POINTS_PER_SPLIT)
+
+        self.assertEqual(ts, carbonara.AggregatedTimeSerie.from_timeseries(
+            [split for key, split in splits], sampling, 'mean'))
+
     def test_different_length_in_timestamps_and_data(self):
         self.assertRaises(ValueError,
                           carbonara.AggregatedTimeSerie,
@@ -154,6 +243,60 @@ class TestAggregatedTimeSerie(base.BaseTestCase):
         self.assertEqual(5, ts[0])
         self.assertEqual(6, ts[1])
 
+    def test_ring_buffer(self):
+        buf = carbonara.RingBuffer(3)
+        buf.extend(numpy.array([1, 2]), numpy.array([10., 20.]))
+        buf.extend(numpy.array([3, 4]), numpy.array([30., 40.]))
+        self.assertEqual(3, len(buf))
+        self.assertEqual([20., 30., 40.], list(buf.to_series().values))
+        # Replace points 3 and 4 across the end of the arrays
+        buf.splice(3, 5, numpy.array([3]), numpy.array([33.]))
+        self.assertEqual([20., 33.], list(buf.to_series().values))
+        buf.splice(2, 3, numpy.array([2]), numpy.array([22.]))
+        self.assertEqual([2, 3],
+                         list(buf.to_series().index.asi8))
+        self.assertEqual([22., 33.], list(buf.to_series().values))
+
+    def test_max_size_update(self):
+        ts = carbonara.AggregatedTimeSerie(sampling='1Min', max_size=2)
+        raw = carbonara.BoundTimeSerie(block_size='1Min')
+        for minute, value in enumerate([3, 5, 6, 8]):
+            raw.set_values(
+                [(datetime.datetime(2014, 1, 1, 12, minute, 0), value)],
+                before_truncate_callback=ts.update)
+        self.assertEqual(2, len(ts))
+        self.assertEqual(
+            [(pandas.Timestamp('2014-01-01 12:02:00'), 6.0),
+             (pandas.Timestamp('2014-01-01 12:03:00'), 8.0)],
+            list(six.iteritems(ts.ts)))
+
+    def test_max_size_buffer_reused(self):
+        ts = carbonara.AggregatedTimeSerie(
+            [datetime.datetime(2014, 1, 1, 12, 0, 0),
+             datetime.datetime(2014, 1, 1, 12, 1, 0)],
+            [3, 5], sampling='1Min', max_size=2)
+        buf = ts._buffer
+        self.assertIs(ts.ts, ts.ts)
+        ts.set_values([(datetime.datetime(2014, 1, 1, 12, 2, 0), 6)])
+        self.assertIs(buf, ts._buffer)
+        self.assertEqual([5.0, 6.0], list(ts.ts.values))
+        self.assertEqual(
+            [pandas.Timestamp('2014-01-01 12:00:00')],
+            [key for key, split in ts.split()])
+
+    def test_max_size_split_wrapped_buffer(self):
+        ts = carbonara.AggregatedTimeSerie(sampling='1Min', max_size=3)
+        for minute, value in enumerate([3, 5, 6, 8]):
+            ts.set_values(
+                [(datetime.datetime(2014, 1, 1, 12, minute, 0), value)])
+        # The points now span over the end of the arrays of the buffer
+        self.assertEqual(2, len(ts._buffer.segments()))
+        splits = list(ts.split())
+        self.assertEqual(1, len(splits))
+        self.assertEqual([5.0, 6.0, 8.0], list(splits[0][1].ts.values))
+        self.assertEqual(
+            ts, carbonara.AggregatedTimeSerie.from_dict(ts.to_dict(True)))
+
     def test_down_sampling(self):
         ts = carbonara.AggregatedTimeSerie(sampling='5Min')
         ts.set_values(list(zip(
@@ -207,9 +350,92 @@ class TestAggregatedTimeSerie(base.BaseTestCase):
         ts2 = carbonara.AggregatedTimeSerie.from_dict(ts.to_dict())
         self.assertEqual(ts, ts2)
 
+    def test_update_only_touched_buckets(self):
+        ts = carbonara.AggregatedTimeSerie(
+            [datetime.datetime(2014, 1, 1, 12, 0, 0),
+             datetime.datetime(2014, 1, 1, 12, 1, 0)],
+            [42, 43],
+            sampling='1Min')
+        raw = carbonara.BoundTimeSerie(
+            [datetime.datetime(2014, 1, 1, 12, 0, 3),
+             datetime.datetime(2014, 1, 1, 12, 2, 4),
+             datetime.datetime(2014, 1, 1, 12, 2, 9)],
+            [3, 5, 7])
+        ts.update(raw,
+                  datetime.datetime(2014, 1, 1, 12, 2, 4),
+                  datetime.datetime(2014, 1, 1, 12, 2, 9))
+        self.assertEqual(3, len(ts))
+        # Buckets outside of the updated range are left untouched
+        self.assertEqual(42, ts[datetime.datetime(2014, 1, 1, 12, 0, 0)])
+        self.assertEqual(43, ts[datetime.datetime(2014, 1, 1, 12, 1, 0)])
+        self.assertEqual(6, ts[datetime.datetime(2014, 1, 1, 12, 2, 0)])
+
+        # Without range, every bucket covered by the raw points is recomputed
+        ts.update(raw)
+        self.assertEqual(2, len(ts))
+        self.assertEqual(3, ts[datetime.datetime(2014, 1, 1, 12, 0, 0)])
+        self.assertEqual(6, ts[datetime.datetime(2014, 1, 1, 12, 2, 0)])
+
+    def test_serialize_unserialize(self):
+        ts = carbonara.AggregatedTimeSerie(
+            sampling='1Min',
+            max_size=2,
+            aggregation_method='max')
+        ts.set_values(list(zip(
+            [datetime.datetime(2014, 1, 1, 12, 0, 0),
+             datetime.datetime(2014, 1, 1, 12, 1, 4),
+             datetime.datetime(2014, 1, 1, 12, 1, 9),
+             datetime.datetime(2014, 1, 1, 12, 2, 12)],
+            [3, 5, 7, 1])))
+        ts2 = carbonara.AggregatedTimeSerie.unserialize(ts.serialize())
+        self.assertEqual(ts, ts2)
+        self.assertEqual(list(ts.ts.iteritems()), list(ts2.ts.iteritems()))
+
+    def test_unserialize_range(self):
+        ts = carbonara.AggregatedTimeSerie(sampling='1Min')
+        ts.set_values([
+            (datetime.datetime(2014, 1, 1, 12, minute, 0), minute)
+            for minute in six.moves.range(10)
+        ])
+        data = ts.serialize()
+        ts2 = carbonara.AggregatedTimeSerie.unserialize(
+            data,
+            datetime.datetime(2014, 1, 1, 12, 3, 0),
+            datetime.datetime(2014, 1, 1, 12, 5, 0))
+        self.assertEqual(
+            list(ts[datetime.datetime(2014, 1, 1, 12, 3, 0):
+                    datetime.datetime(2014, 1, 1, 12, 5, 0)].iteritems()),
+            list(ts2.ts.iteritems()))
+        self.assertEqual(0, len(carbonara.AggregatedTimeSerie.unserialize(
+            data, datetime.datetime(2014, 1, 1, 13, 0, 0))))
+        # Legacy dict payloads are filtered the same way
+        ts3 = carbonara.AggregatedTimeSerie.from_dict(
+            ts.to_dict(),
+            datetime.datetime(2014, 1, 1, 12, 3, 0),
+            datetime.datetime(2014, 1, 1, 12, 5, 0))
+        self.assertEqual(list(ts2.ts.iteritems()), list(ts3.ts.iteritems()))
+
 
 class TestTimeSerieArchive(base.BaseTestCase):
 
+    def test_unserialize_range(self):
+        tsc = carbonara.TimeSerieArchive.from_definitions(
+            [(60, 10),
+             (300, 6)])
+        tsc.set_values([
+            (datetime.datetime(2014, 1, 1, 12, minute, 0), minute)
+            for minute in six.moves.range(10)
+        ])
+        tsc2 = carbonara.TimeSerieArchive.unserialize(
+            tsc.serialize(),
+            datetime.datetime(2014, 1, 1, 12, 5, 0),
+            timeserie_filter=lambda ts: ts.sampling.nanos == 60 * 10e8)
+        self.assertEqual(1, len(tsc2.agg_timeseries))
+        self.assertEqual(
+            tsc.fetch(datetime.datetime(2014, 1, 1, 12, 5, 0),
+                      timeserie_filter=lambda ts: ts.sampling.nanos == 60e9),
+            tsc2.fetch(datetime.datetime(2014, 1, 1, 12, 5, 0)))
+
     def test_fetch(self):
         tsc = carbonara.TimeSerieArchive.from_definitions(
             [(60, 10),
@@ -415,6 +641,68 @@ class TestTimeSerieArchive(base.BaseTestCase):
                          carbonara.TimeSerieArchive.unserialize(
                              tsc.serialize()))
 
+    def test_serialize_binary_header(self):
+        tsc = carbonara.TimeSerieArchive.from_definitions(
+            [(60, 10)])
+        tsc.set_values([
+            (datetime.datetime(2014, 1, 1, 12, 0, 0), 3),
+            (datetime.datetime(2014, 1, 1, 12, 1, 4), 5),
+        ])
+        data = tsc.serialize()
+        self.assertTrue(data.startswith(carbonara.SERIALIZATION_MAGIC))
+        self.assertEqual(tsc.fetch(),
+                         carbonara.TimeSerieArchive.unserialize(data).fetch())
+
+    def test_unserialize_legacy_msgpack(self):
+        tsc = carbonara.TimeSerieArchive.from_definitions(
+            [(60, 10),
+             (300, 6)])
+        tsc.set_values([
+            (datetime.datetime(2014, 1, 1, 12, 0, 0), 3),
+            (datetime.datetime(2014, 1, 1, 12, 1, 4), 5),
+            (datetime.datetime(2014, 1, 1, 12, 7, 9), 7),
+        ])
+        legacy = msgpack.dumps(tsc.to_dict())
+        self.assertEqual(tsc.fetch(),
+                         carbonara.TimeSerieArchive.unserialize(
+                             legacy).fetch())
+
+    def test_serialize_compression(self):
+        tsc = carbonara.TimeSerieArchive.from_definitions(
+            [(60, 10)])
+        tsc.set_values([
+            (datetime.datetime(2014, 1, 1, 12, 0, 0), 3),
+            (datetime.datetime(2014, 1, 1, 12, 1, 4), 5),
+        ])
+        for codec in carbonara.COMPRESSION_CODECS:
+            data = tsc.serialize(codec)
+            self.assertEqual(
+                tsc.fetch(),
+                carbonara.TimeSerieArchive.unserialize(data).fetch())
+
+    def test_unserialize_version_1(self):
+        tsc = carbonara.TimeSerieArchive.from_definitions(
+            [(60, 10)])
+        tsc.set_values([
+            (datetime.datetime(2014, 1, 1, 12, 0, 0), 3),
+            (datetime.datetime(2014, 1, 1, 12, 1, 4), 5),
+        ])
+        data = (carbonara.SERIALIZATION_MAGIC + b"\x01"
+                + msgpack.dumps(tsc.to_dict(packed=True), use_bin_type=True))
+        self.assertEqual(tsc.fetch(),
+                         carbonara.TimeSerieArchive.unserialize(data).fetch())
+
+    def test_unserialize_unknown_codec(self):
+        data = (carbonara.SERIALIZATION_MAGIC
+                + six.int2byte(carbonara.SERIALIZATION_VERSION) + b"\xff")
+        self.assertRaises(ValueError,
+                          carbonara.TimeSerieArchive.unserialize, data)
+
+    def test_unserialize_unknown_version(self):
+        data = carbonara.SERIALIZATION_MAGIC + b"\xff"
+        self.assertRaises(ValueError,
+                          carbonara.TimeSerieArchive.unserialize, data)
+
     def test_from_dict_resampling_stddev(self):
         d = {'timeserie': {'values': {u'2013-01-01 23:45:01.182000': 1.0,
                                       u'2013-01-01 23:45:02.975000': 2.0,
@@ -518,6 +806,12 @@ class TestTimeSerieArchive(base.BaseTestCase):
                              e.bad_timestamp)
             self.assertEqual(datetime.datetime(2014, 1, 1, 12, 0, 3),
                              e.first_timestamp)
+            # It can be raised from another process
+            e = pickle.loads(pickle.dumps(e))
+            self.assertEqual(datetime.datetime(2014, 1, 1, 12, 0, 2, 99),
+                             e.bad_timestamp)
+            self.assertEqual(datetime.datetime(2014, 1, 1, 12, 0, 3),
+                             e.first_timestamp)
         else:
             self.fail("No exception raised")
 
@@ -813,3 +1107,26 @@ Number of measures: 2
 | 2014-12-23 23:23:24 |  8.5  |
 +---------------------+-------+
 """, out.decode('utf-8'))
+
+    def test_benchmark(self):
+        archive = tempfile.mktemp()
+        subp = subprocess.Popen(['carbonara-create',
+                                 '1,2',
+                                 archive])
+        subp.wait()
+        # Splits are benchmarked like archives
+        split = tempfile.mktemp()
+        with open(split, 'wb') as f:
+            f.write(carbonara.AggregatedTimeSerie(
+                [datetime.datetime(2014, 1, 1, 12, 0, 0)], [3],
+                sampling=60).serialize())
+        subp = subprocess.Popen(['carbonara-benchmark',
+                                 '--iterations', '1',
+                                 archive, split],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = subp.communicate()
+        subp.wait()
+        self.assertEqual(0, subp.returncode, err)
+        for codec in carbonara.COMPRESSION_CODECS:
+            self.assertIn(codec.encode('ascii'), out)
@@ -0,0 +1,82 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2015 eNovance
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import uuid
+
+import mock
+from oslotest import base
+
+from gnocchi import metricd
+from gnocchi import service
+from gnocchi import storage
+from gnocchi.tests import base as tests_base
+
+
+class TestMetricProcessor(base.BaseTestCase):
+    def setUp(self):
+        super(TestMetricProcessor, self).setUp()
+        conf = service.prepare_service([])
+        conf.set_override('driver', 'null', 'storage')
+        conf.set_override('url', 'null://', 'indexer')
+        self.processor = metricd.MetricProcessor(conf)
+        self.addCleanup(self.processor.storage.stop)
+
+    def test_process_nothing(self):
+        with mock.patch.object(
+                self.processor.storage,
+                'list_metric_with_measures_to_process',
+                return_value=set()):
+            with mock.patch.object(self.processor.indexer,
+                                   'get_metrics') as get_metrics:
+                self.processor.process()
+        self.assertFalse(get_metrics.called)
+
+    def test_process(self):
+        metric_id = str(uuid.uuid4())
+        deleted_metric_id = str(uuid.uuid4())
+        ap = tests_base.TestCase.ARCHIVE_POLICIES['low']
+        with mock.patch.multiple(
+                self.processor.storage,
+                list_metric_with_measures_to_process=mock.Mock(
+                    return_value=set([metric_id, deleted_metric_id])),
+                process_measures=mock.DEFAULT,
+                delete_measures_to_process=mock.DEFAULT) as s:
+            with mock.patch.object(
+                    self.processor.indexer, 'get_metrics',
+                    return_value=[{'id': uuid.UUID(metric_id),
+                                   'archive_policy': ap.to_dict()}]):
+                self.processor.process()
+        # The measures of the deleted metric are dropped, and only them
+        s['delete_measures_to_process'].assert_called_once_with(
+            storage.Metric(deleted_metric_id, None))
+        s['process_measures'].assert_called_once_with(
+            storage.Metric(metric_id, ap))
+
+    def test_process_error(self):
+        metric_id = str(uuid.uuid4())
+        ap = tests_base.TestCase.ARCHIVE_POLICIES['low']
+        with mock.patch.multiple(
+                self.processor.storage,
+                list_metric_with_measures_to_process=mock.Mock(
+                    return_value=set([metric_id])),
+                process_measures=mock.Mock(side_effect=Exception("boom")),
+                delete_measures_to_process=mock.DEFAULT) as s:
+            with mock.patch.object(
+                    self.processor.indexer, 'get_metrics',
+                    return_value=[{'id': uuid.UUID(metric_id),
+                                   'archive_policy': ap.to_dict()}]):
+                # NOTE(jd) The failure is logged and the measures are kept
+                self.processor.process()
+        self.assertFalse(s['delete_measures_to_process'].called)
@@ -18,9 +18,11 @@
 import contextlib
 import datetime
 import json
+import struct
 import uuid
 
 import mock
+import msgpack
 from oslo.utils import timeutils
 import pecan
 import six
@@ -758,6 +760,85 @@ class MetricTest(RestTest):
                      "value": 1234.2}],
             status=204)
 
+    def test_add_measures_columns(self):
+        result = self.app.post_json("/v1/metric",
+                                    params={"archive_policy_name": "high"})
+        metric = json.loads(result.text)
+        self.app.post_json(
+            "/v1/metric/%s/measures" % metric['id'],
+            params={"timestamps": ['2013-01-01 23:23:23',
+                                   '2013-01-01 23:23:24'],
+                    "values": [1234.2, 4]},
+            status=204)
+        result = self.app.get("/v1/metric/%s/measures" % metric['id'])
+        self.assertIn([u'2013-01-01T23:23:23.000000Z', 1.0, 1234.2],
+                      json.loads(result.text))
+        self.app.post_json(
+            "/v1/metric/%s/measures" % metric['id'],
+            params={"timestamps": ['2013-01-01 23:23:23'],
+                    "values": [1234.2, 4]},
+            status=400)
+        self.app.post_json(
+            "/v1/metric/%s/measures" % metric['id'],
+            params={"timestamps": ['2013-01-01 23:23:23'],
+                    "values": ["foo"]},
+            status=400)
+        self.app.post_json(
+            "/v1/metric/%s/measures" % metric['id'],
+            params={"timestamps": ['2013-01-01 23:23:23'],
+                    "values": [[1234.2, 4]]},
+            status=400)
+        self.app.post_json(
+            "/v1/metric/%s/measures" % metric['id'],
+            params={"timestamps": [[1356998400, 1356998401], [1356998402]],
+                    "values": [1234.2, 4]},
+            status=400)
+        # Dates in different ISO 8601 formats
+        self.app.post_json(
+            "/v1/metric/%s/measures" % metric['id'],
+            params={"timestamps": ['2013-01-01 23:23:25',
+                                   '2013-01-01T23:23:26Z'],
+                    "values": [1, 2]},
+            status=204)
+
+    def test_add_measure_asynchronous(self):
+        self.conf.set_override("asynchronous_measures", True, group="api")
+        result = self.app.post_json("/v1/metric",
+                                    params={"archive_policy_name": "high"})
+        metric = json.loads(result.text)
+        self.app.post_json(
+            "/v1/metric/%s/measures" % metric['id'],
+            params=[{"timestamp": '2013-01-01 23:23:23',
+                     "value": 1234.2}],
+            status=202)
+        self.assertEqual(
+            set([metric['id']]),
+            self.storage.list_metric_with_measures_to_process())
+
+    def test_add_measures_batch(self):
+        metrics = []
+        for i in six.moves.range(2):
+            result = self.app.post_json(
+                "/v1/metric", params={"archive_policy_name": "high"})
+            metrics.append(json.loads(result.text)['id'])
+        self.app.post_json(
+            "/v1/batch/measures",
+            params=dict((metric_id, [{"timestamp": '2013-01-01 23:23:23',
+                                      "value": 1234.2}])
+                        for metric_id in metrics),
+            status=204)
+        for metric_id in metrics:
+            result = self.app.get("/v1/metric/%s/measures" % metric_id)
+            self.assertIn([u'2013-01-01T23:23:23.000000Z', 1.0, 1234.2],
+                          json.loads(result.text))
+
+    def test_add_measures_batch_unknown_metric(self):
+        self.app.post_json(
+            "/v1/batch/measures",
+            params={str(uuid.uuid4()): [{"timestamp": '2013-01-01 23:23:23',
+                                         "value": 1234.2}]},
+            status=400)
+
     def test_add_measure_with_another_user(self):
         result = self.app.post_json("/v1/metric",
                                     params={"archive_policy_name": "high"})
@@ -880,6 +961,123 @@ class MetricTest(RestTest):
              [u'2013-01-01T23:20:00.000000Z', 300.0, 1234.2]],
             result)
 
+    def test_get_measure_epoch(self):
+        result = self.app.post_json("/v1/metric",
+                                    params={"archive_policy_name": "low"})
+        metric = json.loads(result.text)
+        self.app.post_json("/v1/metric/%s/measures" % metric['id'],
+                           params=[{"timestamp": '2013-01-01 23:23:23',
+                                    "value": 1234.2}])
+        ret = self.app.get("/v1/metric/%s/measures?timestamp_format=epoch"
+                           % metric['id'], status=200)
+        self.assertEqual(
+            [[1356998400.0, 86400.0, 1234.2],
+             [1357081200.0, 3600.0, 1234.2],
+             [1357082400.0, 300.0, 1234.2]],
+            json.loads(ret.text))
+        self.app.get("/v1/metric/%s/measures?timestamp_format=foo"
+                     % metric['id'], status=400)
+
+    def test_get_measure_granularity(self):
+        result = self.app.post_json("/v1/metric",
+                                    params={"archive_policy_name": "low"})
+        metric = json.loads(result.text)
+        self.app.post_json("/v1/metric/%s/measures" % metric['id'],
+                           params=[{"timestamp": '2013-01-01 23:23:23',
+                                    "value": 1234.2}])
+        ret = self.app.get("/v1/metric/%s/measures?granularity=3600"
+                           % metric['id'], status=200)
+        self.assertEqual(
+            [[u'2013-01-01T23:00:00.000000Z', 3600.0, 1234.2]],
+            json.loads(ret.text))
+        ret = self.app.get(
+            "/v1/metric/%s/measures?granularity=300&resample=7200"
+            "&aggregation=max" % metric['id'], status=200)
+        self.assertEqual(
+            [[u'2013-01-01T22:00:00.000000Z', 7200.0, 1234.2]],
+            json.loads(ret.text))
+        self.app.get("/v1/metric/%s/measures?granularity=300&resample=7200"
+                     % metric['id'], status=400)
+        self.app.get("/v1/metric/%s/measures?granularity=42"
+                     % metric['id'], status=404)
+        self.app.get("/v1/metric/%s/measures?granularity=300&resample=450"
+                     % metric['id'], status=400)
+        self.app.get("/v1/metric/%s/measures?resample=600"
+                     % metric['id'], status=400)
+        self.app.get("/v1/metric/%s/measures?granularity=300"
+                     "&aggregation=moving-average&window=600"
+                     % metric['id'], status=400)
+
+    def test_get_measure_ndjson(self):
+        result = self.app.post_json("/v1/metric",
+                                    params={"archive_policy_name": "low"})
+        metric = json.loads(result.text)
+        self.app.post_json("/v1/metric/%s/measures" % metric['id'],
+                           params=[{"timestamp": '2013-01-01 23:23:23',
+                                    "value": 1234.2}])
+        ret = self.app.get("/v1/metric/%s/measures" % metric['id'],
+                           headers={"Accept": "application/x-ndjson"},
+                           status=200)
+        self.assertEqual("application/x-ndjson", ret.content_type)
+        self.assertEqual(
+            [[u'2013-01-01T00:00:00.000000Z', 86400.0, 1234.2],
+             [u'2013-01-01T23:00:00.000000Z', 3600.0, 1234.2],
+             [u'2013-01-01T23:20:00.000000Z', 300.0, 1234.2]],
+            [json.loads(line) for line in ret.text.splitlines()])
+
+    def test_get_measure_ndjson_empty(self):
+        result = self.app.post_json("/v1/metric",
+                                    params={"archive_policy_name": "low"})
+        metric = json.loads(result.text)
+        ret = self.app.get("/v1/metric/%s/measures" % metric['id'],
+                           headers={"Accept": "application/x-ndjson"},
+                           status=200)
+        self.assertEqual("", ret.text)
+
+    def test_get_measure_ndjson_unknown_granularity(self):
+        result = self.app.post_json("/v1/metric",
+                                    params={"archive_policy_name": "low"})
+        metric = json.loads(result.text)
+        self.app.get("/v1/metric/%s/measures?granularity=42" % metric['id'],
+                     headers={"Accept": "application/x-ndjson"},
+                     status=404)
+
+    def test_get_measure_msgpack(self):
+        result = self.app.post_json("/v1/metric",
+                                    params={"archive_policy_name": "low"})
+        metric = json.loads(result.text)
+        self.app.post_json("/v1/metric/%s/measures" % metric['id'],
+                           params=[{"timestamp": '2013-01-01 23:23:23',
+                                    "value": 1234.2}])
+        ret = self.app.get("/v1/metric/%s/measures" % metric['id'],
+                           headers={"Accept": "application/x-msgpack"},
+                           status=200)
+        self.assertEqual("application/x-msgpack", ret.content_type)
+        self.assertEqual(
+            {u"timestamps": [1356998400.0, 1357081200.0, 1357082400.0],
+             u"granularities": [86400.0, 3600.0, 300.0],
+             u"values": [1234.2, 1234.2, 1234.2]},
+            msgpack.loads(ret.body, encoding='utf-8'))
+
+    def test_get_measure_packed(self):
+        result = self.app.post_json("/v1/metric",
+                                    params={"archive_policy_name": "low"})
+        metric = json.loads(result.text)
+        self.app.post_json("/v1/metric/%s/measures" % metric['id'],
+                           params=[{"timestamp": '2013-01-01 23:23:23',
+                                    "value": 1234.2}])
+        ret = self.app.get("/v1/metric/%s/measures" % metric['id'],
+                           headers={"Accept":
+                                    "application/x-gnocchi-measures"},
+                           status=200)
+        self.assertEqual("application/x-gnocchi-measures", ret.content_type)
+        self.assertEqual(
+            (3,
+             1356998400.0, 1357081200.0, 1357082400.0,
+             86400.0, 3600.0, 300.0,
+             1234.2, 1234.2, 1234.2),
+            struct.unpack("<I9d", ret.body))
+
     def test_get_measure_with_another_user(self):
         result = self.app.post_json("/v1/metric",
                                     params={"archive_policy_name": "low"})
@@ -1721,6 +1919,23 @@ class ResourceTest(RestTest):
                 "/v1/resource/generic",
                 headers={"Accept": "application/json; details=true"}))
 
+    def test_list_resources_ndjson(self):
+        result = self.app.post_json(
+            "/v1/resource/generic",
+            params={
+                "id": str(uuid.uuid4()),
+                "started_at": "2014-01-01 02:02:02",
+                "user_id": str(uuid.uuid4()),
+                "project_id": str(uuid.uuid4()),
+            })
+        g = json.loads(result.text)
+        result = self.app.get("/v1/resource/generic",
+                              headers={"Accept": "application/x-ndjson"})
+        self.assertEqual("application/x-ndjson", result.content_type)
+        resources = [json.loads(line)
+                     for line in result.text.splitlines()]
+        self.assertIn(g, resources)
+
     def test_search_resources_with_details(self):
         self._do_test_list_resources_with_detail(
             lambda: self.app.post("/v1/search/resource/generic?details=true"))
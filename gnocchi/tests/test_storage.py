@@ -14,11 +14,21 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 import datetime
+import os
+import sqlite3
+import threading
+import time
 import uuid
 
+import numpy
+from oslotest import mockpatch
+import pandas
+import six
 import testscenarios
 
+from gnocchi import carbonara
 from gnocchi import storage
+from gnocchi.storage import _carbonara
 from gnocchi.storage import null
 from gnocchi.tests import base as tests_base
 
@@ -35,6 +45,7 @@ class TestStorageDriver(tests_base.TestCase):
     def test_get_driver(self):
         self.conf.set_override('driver', 'null', 'storage')
         driver = storage.get_driver(self.conf)
+        self.addCleanup(driver.stop)
         self.assertIsInstance(driver, null.NullStorage)
 
     def test_create_metric(self):
@@ -116,6 +127,642 @@ class TestStorageDriver(tests_base.TestCase):
             from_timestamp=datetime.datetime(2014, 1, 1, 12, 0, 0),
             to_timestamp=datetime.datetime(2014, 1, 1, 12, 0, 2)))
 
+    def test_iter_measures(self):
+        self.storage.create_metric(self.metric)
+        self.storage.add_measures(self.metric, [
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 0, 1), 69),
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 7, 31), 42),
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 9, 31), 4),
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 12, 45), 44),
+        ])
+        for kwargs in ({},
+                       {'from_timestamp': datetime.datetime(2014, 1, 1, 12,
+                                                            10)},
+                       {'to_timestamp': datetime.datetime(2014, 1, 1, 12,
+                                                          6)},
+                       {'from_timestamp': datetime.datetime(2014, 1, 1, 12),
+                        'to_timestamp': datetime.datetime(2014, 1, 1, 12,
+                                                          0, 2)},
+                       {'granularity': 300},
+                       {'aggregation': 'max', 'granularity': 300,
+                        'resample': 600}):
+            self.assertEqual(self.storage.get_measures(self.metric, **kwargs),
+                             list(self.storage.iter_measures(self.metric,
+                                                             **kwargs)))
+        # Errors are raised before iterating
+        self.assertRaises(storage.GranularityDoesNotExist,
+                          self.storage.iter_measures,
+                          self.metric, granularity=42)
+        self.assertRaises(storage.MetricDoesNotExist,
+                          self.storage.iter_measures,
+                          storage.Metric(str(uuid.uuid4()), None))
+
+    def test_get_measures_granularity(self):
+        self.storage.create_metric(self.metric)
+        self.storage.add_measures(self.metric, [
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 0, 1), 69),
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 7, 31), 42),
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 9, 31), 4),
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 12, 45), 44),
+        ])
+
+        self.assertEqual([
+            (datetime.datetime(2014, 1, 1, 12), 300.0, 69.0),
+            (datetime.datetime(2014, 1, 1, 12, 5), 300.0, 23.0),
+            (datetime.datetime(2014, 1, 1, 12, 10), 300.0, 44.0),
+        ], self.storage.get_measures(self.metric, granularity=300))
+
+        self.assertEqual([
+            (datetime.datetime(2014, 1, 1, 12), 600.0, 69.0),
+            (datetime.datetime(2014, 1, 1, 12, 10), 600.0, 44.0),
+        ], self.storage.get_measures(self.metric, aggregation='max',
+                                     granularity=300, resample=600))
+
+        self.assertRaises(storage.AggregationUnresamplable,
+                          self.storage.get_measures,
+                          self.metric, granularity=300, resample=600)
+
+        self.assertRaises(storage.GranularityDoesNotExist,
+                          self.storage.get_measures,
+                          self.metric, granularity=42)
+
+    def test_add_measures_shared_unaggregated_timeserie(self):
+        self.storage.create_metric(self.metric)
+        self.storage.add_measures(self.metric, [
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 0, 1), 69),
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 7, 31), 42),
+        ])
+        timeserie = carbonara.BoundTimeSerie.unserialize(
+            self.storage._get_measures(self.metric,
+                                       self.storage.UNAGGREGATED))
+        self.assertEqual(2, len(timeserie))
+        for aggregation in self.metric.archive_policy.aggregation_methods:
+            archive = self.storage._get_archive_header(self.metric,
+                                                       aggregation)
+            self.assertEqual(0, len(archive.full_res_timeserie))
+
+    def test_add_measures_split_by_granularity(self):
+        self.storage.create_metric(self.metric)
+        self.storage.add_measures(self.metric, [
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 0, 1), 69),
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 7, 31), 42),
+        ])
+        archive = self.storage._get_archive_header(self.metric, 'mean')
+        self.assertEqual(3, len(archive.agg_timeseries))
+        for ts in archive.agg_timeseries:
+            # Points are not stored in the archive header
+            self.assertEqual(0, len(ts))
+        index = self.storage._get_split_index(self.metric, 'mean', 300)
+        self.assertEqual(1, len(index))
+        ts = carbonara.AggregatedTimeSerie.unserialize(
+            self.storage._get_split(self.metric, 'mean', 300,
+                                    index.ts.index[0]))
+        self.assertEqual(2, len(ts))
+
+    def test_add_measures_legacy_archives(self):
+        # Archives stored before the full resolution buffer and the points
+        # got their own objects hold all of them
+        self.storage._create_metric_container(self.metric)
+        for aggregation in self.metric.archive_policy.aggregation_methods:
+            archive = carbonara.TimeSerieArchive.from_definitions(
+                [(d.granularity, d.points)
+                 for d in self.metric.archive_policy.definition],
+                aggregation_method=aggregation)
+            archive.set_values([
+                (datetime.datetime(2014, 1, 1, 12, 0, 1), 69),
+            ])
+            self.storage._store_metric_measures(self.metric, aggregation,
+                                                archive.serialize())
+        self.storage.add_measures(self.metric, [
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 7, 31), 42),
+        ])
+        self.assertEqual([
+            (datetime.datetime(2014, 1, 1), 86400.0, 55.5),
+            (datetime.datetime(2014, 1, 1, 12), 3600.0, 55.5),
+            (datetime.datetime(2014, 1, 1, 12), 300.0, 69.0),
+            (datetime.datetime(2014, 1, 1, 12, 5), 300.0, 42.0),
+        ], self.storage.get_measures(self.metric))
+        timeserie = carbonara.BoundTimeSerie.unserialize(
+            self.storage._get_measures(self.metric,
+                                       self.storage.UNAGGREGATED))
+        self.assertEqual(2, len(timeserie))
+        archive = self.storage._get_archive_header(self.metric, 'mean')
+        self.assertEqual(0, len(archive.full_res_timeserie))
+
+    def test_add_measures_time_partitioned(self):
+        self.useFixture(mockpatch.PatchObject(
+            carbonara.AggregatedTimeSerie, 'POINTS_PER_SPLIT', 2))
+        self.storage.create_metric(self.metric)
+        self.storage.add_measures(self.metric, [
+            storage.Measure(datetime.datetime(2014, 1, 1, 12)
+                            + datetime.timedelta(minutes=5 * i), i)
+            for i in six.moves.range(25)
+        ])
+        # Only the splits holding the last 12 points are kept
+        index = self.storage._get_split_index(self.metric, 'mean', 300)
+        self.assertEqual(7, len(index))
+        self.assertRaises(storage.MetricDoesNotExist,
+                          self.storage._get_split,
+                          self.metric, 'mean', 300,
+                          pandas.Timestamp("2014-01-01 12:00:00"))
+        measures = [m for m in self.storage.get_measures(self.metric)
+                    if m[1] == 300.0]
+        self.assertEqual(12, len(measures))
+        self.assertEqual(datetime.datetime(2014, 1, 1, 13, 5),
+                         measures[0][0])
+        self.assertEqual([
+            (datetime.datetime(2014, 1, 1, 13, 50), 300.0, 22.0),
+            (datetime.datetime(2014, 1, 1, 13, 55), 300.0, 23.0),
+            (datetime.datetime(2014, 1, 1, 14, 0), 300.0, 24.0),
+        ], [m for m in self.storage.get_measures(
+            self.metric,
+            from_timestamp=datetime.datetime(2014, 1, 1, 13, 50))
+            if m[1] == 300.0])
+
+    def test_add_and_get_measures_compression(self):
+        self.storage.create_metric(self.metric)
+        self.storage.add_measures(self.metric, [
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 0, 1), 69),
+        ])
+        # Switching codec keeps the objects already stored readable
+        self.storage.compression = 'zlib'
+        self.storage.add_measures(self.metric, [
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 7, 31), 42),
+        ])
+        self.assertEqual([
+            (datetime.datetime(2014, 1, 1), 86400.0, 55.5),
+            (datetime.datetime(2014, 1, 1, 12), 3600.0, 55.5),
+            (datetime.datetime(2014, 1, 1, 12), 300.0, 69.0),
+            (datetime.datetime(2014, 1, 1, 12, 5), 300.0, 42.0),
+        ], self.storage.get_measures(self.metric))
+
+    def test_add_measures_batch(self):
+        metric2 = storage.Metric(str(uuid.uuid4()),
+                                 self.archive_policies['low'])
+        self.storage.create_metric(self.metric)
+        self.storage.create_metric(metric2)
+        self.storage.add_measures_batch({
+            self.metric: [
+                storage.Measure(datetime.datetime(2014, 1, 1, 12, 0, 1), 69),
+            ],
+            metric2: [
+                storage.Measure(datetime.datetime(2014, 1, 1, 12, 0, 1), 42),
+            ],
+        })
+        self.assertIn((datetime.datetime(2014, 1, 1, 12), 300.0, 69.0),
+                      self.storage.get_measures(self.metric))
+        self.assertIn((datetime.datetime(2014, 1, 1, 12), 300.0, 42.0),
+                      self.storage.get_measures(metric2))
+
+    def test_queue_and_process_measures(self):
+        self.storage.create_metric(self.metric)
+        self.storage.queue_measures(self.metric, [
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 0, 1), 69),
+        ])
+        self.storage.queue_measures(self.metric, [
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 7, 31), 42),
+        ])
+        self.assertEqual([], self.storage.get_measures(self.metric))
+        self.assertEqual(set([self.metric.name]),
+                         self.storage.list_metric_with_measures_to_process())
+        self.storage.process_measures(self.metric)
+        self.assertEqual(set(),
+                         self.storage.list_metric_with_measures_to_process())
+        self.assertEqual([
+            (datetime.datetime(2014, 1, 1), 86400.0, 55.5),
+            (datetime.datetime(2014, 1, 1, 12), 3600.0, 55.5),
+            (datetime.datetime(2014, 1, 1, 12), 300.0, 69.0),
+            (datetime.datetime(2014, 1, 1, 12, 5), 300.0, 42.0),
+        ], self.storage.get_measures(self.metric))
+
+    def test_delete_measures_to_process(self):
+        self.storage.create_metric(self.metric)
+        self.storage.queue_measures(self.metric, [
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 0, 1), 69),
+        ])
+        self.storage.delete_measures_to_process(self.metric)
+        self.assertEqual(set(),
+                         self.storage.list_metric_with_measures_to_process())
+        self.storage.process_measures(self.metric)
+        self.assertEqual([], self.storage.get_measures(self.metric))
+
+    def test_get_measures_cache(self):
+        self.conf.set_override('cache_size', 1024 * 1024, 'storage')
+        self.storage.stop()
+        self.storage = storage.get_driver(self.conf)
+        self.storage.create_metric(self.metric)
+        self.storage.add_measures(self.metric, [
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 0, 1), 69),
+        ])
+        # Objects written are cached under the version they have been
+        # written with
+        self.assertEqual(
+            self.storage._get_measures_version(self.metric,
+                                               self.storage.UNAGGREGATED),
+            self.storage.cache[(self.metric.name,
+                                self.storage.UNAGGREGATED)][0])
+        measures = self.storage.get_measures(self.metric)
+        self.assertEqual(measures, self.storage.get_measures(self.metric))
+        # Objects read are cached decoded, and each reader gets a copy
+        self.assertIsInstance(
+            self.storage.cache[(self.metric.name, 'mean')][2],
+            carbonara.TimeSerieArchive)
+        header = self.storage._get_archive_header(self.metric, 'mean')
+        header.agg_timeseries = []
+        self.assertNotEqual(
+            [], self.storage._get_archive_header(
+                self.metric, 'mean').agg_timeseries)
+        # Objects written behind the cache back are not served from it
+        data = carbonara.BoundTimeSerie().serialize()
+        self.storage._store_metric_measures(
+            self.metric, self.storage.UNAGGREGATED, data)
+        self.assertEqual(data, self.storage._get_object(
+            self.metric, self.storage.UNAGGREGATED))
+
+    def test_sqlite_add_measures_atomic(self):
+        if self.storage_engine != 'sqlite':
+            self.skipTest("SQLite specific test")
+        self.storage.create_metric(self.metric)
+        self.storage.add_measures(self.metric, [
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 0, 1), 69),
+        ])
+        measures = self.storage.get_measures(self.metric)
+        write_object = self.storage._write_object
+
+        def _write_object(conn, metric, key, data, version=None):
+            if key == self.storage.UNAGGREGATED:
+                raise Exception("boom")
+            return write_object(conn, metric, key, data, version)
+
+        self.useFixture(mockpatch.PatchObject(
+            self.storage, '_write_object', side_effect=_write_object))
+        self.assertRaises(Exception, self.storage.add_measures, self.metric,
+                          [storage.Measure(
+                              datetime.datetime(2014, 1, 1, 12, 7, 31), 42)])
+        # None of the splits of the failed update have been stored
+        self.assertEqual(measures, self.storage.get_measures(self.metric))
+
+    def test_sqlite_transaction_rollback(self):
+        if self.storage_engine != 'sqlite':
+            self.skipTest("SQLite specific test")
+        self.storage.create_metric(self.metric)
+
+        def interrupt():
+            with self.storage._transaction() as conn:
+                conn.execute("DELETE FROM metric")
+                raise KeyboardInterrupt
+
+        self.assertRaises(KeyboardInterrupt, interrupt)
+        self.assertRaises(storage.MetricAlreadyExists,
+                          self.storage.create_metric, self.metric)
+
+    def test_sqlite_stop(self):
+        if self.storage_engine != 'sqlite':
+            self.skipTest("SQLite specific test")
+        self.conf.set_override('sqlite_synchronous', 'full', 'storage')
+        self.storage.stop()
+        self.storage = storage.get_driver(self.conf)
+        conn = self.storage._connection()
+        # 2 is FULL
+        self.assertEqual(
+            2, conn.execute("PRAGMA synchronous").fetchone()[0])
+        self.storage.stop()
+        self.assertRaises(sqlite3.ProgrammingError, conn.execute,
+                          "SELECT 1")
+        # A new connection is opened if the driver is used again
+        self.storage.create_metric(self.metric)
+
+    def test_swift_connection_pool(self):
+        if self.storage_engine != 'swift':
+            self.skipTest("Swift specific test")
+        self.conf.set_override('aggregation_workers_number', 2, 'storage')
+        self.storage.stop()
+        self.storage = storage.get_driver(self.conf)
+        self.assertEqual(2, self.storage.swift.connections.qsize())
+        with self.storage.swift.connection() as conn:
+            self.assertEqual(1, self.storage.swift.connections.qsize())
+            conn.put_container('foobar')
+        self.assertEqual(2, self.storage.swift.connections.qsize())
+        # All the connections see the same objects
+        self.storage.swift.put_object('foobar', 'foo', b'bar')
+        self.assertEqual(b'bar',
+                         self.storage.swift.get_object('foobar', 'foo')[1])
+        self.storage.create_metric(self.metric)
+        self.storage.add_measures(self.metric, [
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 0, 1), 69),
+        ])
+        self.assertNotEqual([], self.storage.get_measures(self.metric))
+
+    def test_ceph_read_large_object(self):
+        if self.storage_engine != 'ceph':
+            self.skipTest("Ceph specific test")
+        data = os.urandom(100000)
+        self.storage.ioctx.write_full('foobar', data)
+        self.assertEqual(data, self.storage._read_object('foobar'))
+
+    def test_add_measures_optimistic_concurrency(self):
+        self.conf.set_override('optimistic_concurrency', True, 'storage')
+        self.storage.stop()
+        self.storage = storage.get_driver(self.conf)
+        if self.storage_engine == 'swift':
+            # Swift falls back to locking the metric
+            self.assertFalse(self.storage.optimistic_concurrency)
+            self.skipTest("Swift cannot replace an object conditionally")
+        other = storage.get_driver(self.conf)
+        self.addCleanup(other.stop)
+        self.storage.create_metric(self.metric)
+        store_objects = self.storage._store_objects
+        conflicts = []
+
+        def _store_objects(metric, objects, versions=None):
+            if not conflicts:
+                # Another writer updates the metric in the meantime
+                conflicts.append(objects)
+                other.add_measures(self.metric, [
+                    storage.Measure(datetime.datetime(2014, 1, 1, 12, 7, 31),
+                                    42),
+                ])
+            return store_objects(metric, objects, versions)
+
+        self.useFixture(mockpatch.PatchObject(
+            self.storage, '_store_objects', side_effect=_store_objects))
+        self.storage.add_measures(self.metric, [
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 0, 1), 69),
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 9, 31), 4),
+        ])
+        self.assertEqual(1, len(conflicts))
+
+        metric2 = storage.Metric(str(uuid.uuid4()),
+                                 self.archive_policies['low'])
+        other.create_metric(metric2)
+        other.add_measures(metric2, [
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 0, 1), 69),
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 7, 31), 42),
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 9, 31), 4),
+        ])
+        self.assertEqual(other.get_measures(metric2),
+                         other.get_measures(self.metric))
+
+    def test_add_measures_optimistic_concurrency_retries(self):
+        self.conf.set_override('optimistic_concurrency', True, 'storage')
+        self.storage.stop()
+        self.storage = storage.get_driver(self.conf)
+        if not getattr(self.storage, 'optimistic_concurrency', False):
+            self.skipTest("Optimistic concurrency is not supported")
+        self.storage.CONCURRENT_UPDATE_DELAY = 0
+        self.storage.create_metric(self.metric)
+        add_measures = self.useFixture(mockpatch.PatchObject(
+            self.storage, '_add_measures',
+            side_effect=_carbonara.ConcurrentUpdate(
+                self.metric, self.storage.UNAGGREGATED))).mock
+        self.assertRaises(_carbonara.ConcurrentUpdate,
+                          self.storage.add_measures, self.metric, [
+                              storage.Measure(
+                                  datetime.datetime(2014, 1, 1, 12, 0, 1),
+                                  69),
+                          ])
+        self.assertEqual(self.storage.CONCURRENT_UPDATE_ATTEMPTS,
+                         add_measures.call_count)
+
+    def test_ceph_queue_measures(self):
+        if self.storage_engine != 'ceph':
+            self.skipTest("Ceph specific test")
+        self.storage.OMAP_PAGE_SIZE = 1
+        self.storage.create_metric(self.metric)
+        kvs = set(self.storage.ioctx.kvs)
+        for i in six.moves.range(3):
+            self.storage.queue_measures(self.metric, [
+                storage.Measure(datetime.datetime(2014, 1, 1, 12, 0, i), 69),
+            ])
+        # The measures are only stored in the index
+        self.assertEqual(kvs | set([self.storage.MEASURE_INDEX]),
+                         set(self.storage.ioctx.kvs))
+        names = self.storage._list_measures_to_process(self.metric)
+        self.assertEqual(3, len(names))
+        # Measures queued before they were stored in the index
+        name = self.storage._build_measure_prefix(self.metric.name) + "_0"
+        self.storage.ioctx.write_full(name, carbonara.TimeSerie(
+            [datetime.datetime(2014, 1, 1, 12, 0, 3)], [42]).serialize())
+        self.storage._write_omap(self.storage.MEASURE_INDEX, [name], [b""])
+        self.storage.process_measures(self.metric)
+        self.assertEqual(set(),
+                         self.storage.list_metric_with_measures_to_process())
+        self.assertNotIn(name, self.storage.ioctx.kvs)
+        self.assertEqual([
+            (datetime.datetime(2014, 1, 1), 86400.0, 62.25),
+            (datetime.datetime(2014, 1, 1, 12), 3600.0, 62.25),
+            (datetime.datetime(2014, 1, 1, 12), 300.0, 62.25),
+        ], self.storage.get_measures(self.metric))
+
+    def test_ceph_add_measures_unversioned_object(self):
+        if self.storage_engine != 'ceph':
+            self.skipTest("Ceph specific test")
+        self.conf.set_override('optimistic_concurrency', True, 'storage')
+        self.storage.stop()
+        self.storage = storage.get_driver(self.conf)
+        self.storage.create_metric(self.metric)
+        self.storage.add_measures(self.metric, [
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 0, 1), 69),
+        ])
+        # Objects written before versions were tracked have none
+        name = self.storage._get_object_name(self.metric,
+                                             self.storage.UNAGGREGATED)
+        del self.storage.ioctx.xattrs[name][self.storage.VERSION_XATTR]
+        versions = {}
+        self.storage._get_object(self.metric, self.storage.UNAGGREGATED,
+                                 versions)
+        self.assertEqual(
+            self.storage.ioctx.get_xattr(name, self.storage.VERSION_XATTR),
+            versions[self.storage.UNAGGREGATED])
+        self.assertRaises(
+            _carbonara.ConcurrentUpdate,
+            self.storage._store_object, self.metric,
+            self.storage.UNAGGREGATED, b"", {self.storage.UNAGGREGATED: b"x"})
+
+    def test_add_measures_columns(self):
+        self.storage.create_metric(self.metric)
+        self.storage.add_measures(self.metric, storage.MeasureColumns(
+            pandas.DatetimeIndex([datetime.datetime(2014, 1, 1, 12, 0, 1),
+                                  datetime.datetime(2014, 1, 1, 12, 7, 31),
+                                  datetime.datetime(2014, 1, 1, 12, 7, 31)]),
+            numpy.array([69., 4., 42.])))
+        self.assertEqual([
+            (datetime.datetime(2014, 1, 1), 86400.0, 55.5),
+            (datetime.datetime(2014, 1, 1, 12), 3600.0, 55.5),
+            (datetime.datetime(2014, 1, 1, 12), 300.0, 69.0),
+            (datetime.datetime(2014, 1, 1, 12, 5), 300.0, 42.0),
+        ], self.storage.get_measures(self.metric))
+
+    def test_add_measures_in_processes(self):
+        self.conf.set_override('aggregation_processes_number', 2, 'storage')
+        self.storage.stop()
+        self.storage = storage.get_driver(self.conf)
+        self.storage.create_metric(self.metric)
+        # The processes are only started once measures are added
+        self.assertIsNone(self.storage._process_executor)
+        self.storage.add_measures(self.metric, [
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 0, 1), 69),
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 7, 31), 42),
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 9, 31), 4),
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 12, 45), 44),
+        ])
+        self.assertEqual([
+            (datetime.datetime(2014, 1, 1), 86400.0, 39.75),
+            (datetime.datetime(2014, 1, 1, 12), 3600.0, 39.75),
+            (datetime.datetime(2014, 1, 1, 12), 300.0, 69.0),
+            (datetime.datetime(2014, 1, 1, 12, 5), 300.0, 23.0),
+            (datetime.datetime(2014, 1, 1, 12, 10), 300.0, 44.0),
+        ], self.storage.get_measures(self.metric))
+        self.assertRaises(storage.NoDeloreanAvailable,
+                          self.storage.add_measures,
+                          self.metric,
+                          [storage.Measure(
+                              datetime.datetime(2013, 1, 1, 12, 0, 1), 69)])
+        self.storage.stop()
+        self.assertIsNone(self.storage._process_executor)
+
+    def test_add_measures_coalesced(self):
+        self.storage.create_metric(self.metric)
+        add_measures = self.storage._add_measures
+        calls = []
+        threads = []
+
+        def _add_measures(metric, measures, versions=None):
+            calls.append(measures)
+            if len(calls) == 1:
+                # Other measures are posted while this batch is applied
+                for measure in (
+                        storage.Measure(
+                            datetime.datetime(2014, 1, 1, 12, 7, 31), 42),
+                        storage.Measure(
+                            datetime.datetime(2014, 1, 1, 12, 9, 31), 4)):
+                    thread = threading.Thread(
+                        target=self.storage.add_measures,
+                        args=(self.metric, [measure]))
+                    thread.start()
+                    threads.append(thread)
+                while len(self.storage._pending[self.metric.name]) < 2:
+                    time.sleep(0.01)
+            return add_measures(metric, measures, versions)
+
+        self.useFixture(mockpatch.PatchObject(
+            self.storage, '_add_measures', side_effect=_add_measures))
+        self.storage.add_measures(self.metric, [
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 0, 1), 69),
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 12, 45), 44),
+        ])
+        for thread in threads:
+            thread.join()
+        # The measures posted in the meantime are added at once
+        self.assertEqual(2, len(calls))
+        self.assertEqual([
+            (datetime.datetime(2014, 1, 1), 86400.0, 39.75),
+            (datetime.datetime(2014, 1, 1, 12), 3600.0, 39.75),
+            (datetime.datetime(2014, 1, 1, 12), 300.0, 69.0),
+            (datetime.datetime(2014, 1, 1, 12, 5), 300.0, 23.0),
+            (datetime.datetime(2014, 1, 1, 12, 10), 300.0, 44.0),
+        ], self.storage.get_measures(self.metric))
+
+    def test_add_measures_interrupted(self):
+        self.storage.create_metric(self.metric)
+        self.useFixture(mockpatch.PatchObject(
+            self.storage, '_add_measures', side_effect=KeyboardInterrupt))
+        self.assertRaises(KeyboardInterrupt,
+                          self.storage.add_measures, self.metric,
+                          [storage.Measure(
+                              datetime.datetime(2014, 1, 1, 12), 69)])
+        self.assertNotIn(self.metric.name, self.storage._pending)
+
+    def test_add_measures_in_executor(self):
+        self.storage.create_metric(self.metric)
+        # Another thread is updating the metric
+        self.storage._pending[self.metric.name] = []
+        self.storage._in_executor.value = True
+        try:
+            self.storage.add_measures(self.metric, [
+                storage.Measure(datetime.datetime(2014, 1, 1, 12), 69)])
+        finally:
+            self.storage._in_executor.value = False
+            del self.storage._pending[self.metric.name]
+        self.assertEqual([
+            (datetime.datetime(2014, 1, 1), 86400.0, 69.0),
+            (datetime.datetime(2014, 1, 1, 12), 3600.0, 69.0),
+            (datetime.datetime(2014, 1, 1, 12), 300.0, 69.0),
+        ], self.storage.get_measures(self.metric))
+
+    def test_file_upgrade(self):
+        if self.storage_engine != 'file':
+            self.skipTest("File specific test")
+        self.storage.create_metric(self.metric)
+        self.storage.add_measures(self.metric, [
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 0, 1), 69),
+        ])
+        measures = self.storage.get_measures(self.metric)
+        path = self.storage._build_metric_path(self.metric)
+        self.assertEqual(os.path.join(self.storage.basepath,
+                                      self.metric.name[:2],
+                                      self.metric.name[2:4],
+                                      self.metric.name),
+                         path)
+        # Move the metric where metrics used to be stored
+        os.rename(path, os.path.join(self.storage.basepath,
+                                     self.metric.name))
+        self.assertRaises(storage.MetricDoesNotExist,
+                          self.storage.get_measures, self.metric)
+        os.mkdir(os.path.join(self.storage.basepath, 'locks'))
+        self.storage.upgrade()
+        self.assertTrue(os.path.isdir(path))
+        self.assertTrue(os.path.isdir(os.path.join(self.storage.basepath,
+                                                   'locks')))
+        self.assertEqual(measures, self.storage.get_measures(self.metric))
+
+    def test_file_version(self):
+        if self.storage_engine != 'file':
+            self.skipTest("File specific test")
+        if not self.storage.xattr:
+            self.skipTest("Extended attributes are not supported")
+        self.storage.create_metric(self.metric)
+        self.storage.add_measures(self.metric, [
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 0, 1), 69),
+        ])
+        unaggregated = self.storage.UNAGGREGATED
+        path = self.storage._build_metric_path(self.metric, unaggregated)
+        version = self.storage._get_measures_version(self.metric,
+                                                     unaggregated)
+        with open(path, 'rb') as f:
+            data = f.read()
+        # Writing the same content again gives another version
+        self.assertNotEqual(
+            version,
+            self.storage._store_metric_measures(self.metric, unaggregated,
+                                                data))
+        # Files written without a version are given one
+        os.unlink(path)
+        with open(path, 'wb') as f:
+            f.write(data)
+        version = self.storage._get_measures_version(self.metric,
+                                                     unaggregated)
+        self.assertEqual(version,
+                         self.storage._get_measures_version(self.metric,
+                                                            unaggregated))
+
+    def test_file_fsync_batched(self):
+        if self.storage_engine != 'file':
+            self.skipTest("File specific test")
+        self.assertEqual('batched', self.storage.fsync)
+        self.storage.create_metric(self.metric)
+        fsync_dir = self.useFixture(mockpatch.PatchObject(
+            self.storage, '_fsync_dir')).mock
+        self.storage.queue_measures(self.metric, [
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 0, 1), 69),
+        ])
+        self.assertEqual(0, fsync_dir.call_count)
+        self.storage.add_measures(self.metric, [
+            storage.Measure(datetime.datetime(2014, 1, 1, 12, 0, 1), 69),
+        ])
+        fsync_dir.assert_called_once_with(
+            self.storage._build_metric_path(self.metric))
+
     def test_get_measure_unknown_metric(self):
         self.assertRaises(storage.MetricDoesNotExist,
                           self.storage.get_measures,
@@ -15,7 +15,9 @@
 # under the License.
 import datetime
 
+import numpy
 from oslo.utils import timeutils
+import pandas
 from pytimeparse import timeparse
 import six
 
@@ -35,3 +37,47 @@ def to_timestamp(v):
                 raise ValueError("Unable to parse timestamp %s" % v)
             return timeutils.utcnow() + datetime.timedelta(seconds=delta)
     return datetime.datetime.utcfromtimestamp(v)
+
+
+def to_timestamps(values):
+    """Convert a list of timestamps to datetimes at once.
+
+    Epochs and ISO 8601 dates are converted in bulk, any other format
+    falls back to `to_timestamp`.
+
+    :param values: A list of epochs or dates.
+    :return: A DatetimeIndex of naive UTC timestamps.
+    """
+    if not values:
+        return pandas.DatetimeIndex([])
+    array = numpy.asarray(values)
+    if array.dtype.kind in 'iuf':
+        attempts = [dict(unit='s')]
+    elif array.dtype.kind in 'SU' and all(
+            v[:4].isdigit() and v[4:5] == '-' for v in values):
+        # NOTE(jd) Dates that pandas cannot parse at once, e.g. because they
+        # do not all have the same format, are parsed one by one.
+        attempts = [{}]
+    else:
+        attempts = []
+    timestamps = None
+    for kwargs in attempts:
+        try:
+            timestamps = pandas.to_datetime(array, utc=True, **kwargs)
+        except (ValueError, TypeError, OverflowError):
+            continue
+        if isinstance(timestamps, pandas.DatetimeIndex):
+            break
+    if not isinstance(timestamps, pandas.DatetimeIndex):
+        return pandas.DatetimeIndex([to_timestamp(v) for v in values])
+    return timestamps.tz_convert('UTC').tz_localize(None)
+
+
+def to_epochs(timestamps):
+    """Convert a list of naive UTC datetimes to an array of epochs.
+
+    :param timestamps: A list of datetimes.
+    :return: A numpy array of seconds since the epoch, as floats.
+    """
+    return (numpy.array(timestamps, dtype='datetime64[ns]')
+            .astype(numpy.int64) / 10.0 ** 9)